@@ -1,5 +1,116 @@
 import configparser
 import os
+import TimeUtils as TimeUtils
+from collections import ChainMap
+
+
+class ConfigValidationError(Exception):
+    """Exception raised when an option in the config ini file has an invalid value
+
+        Attributes:
+            section -- the section (item ID) of the option
+            option -- the option name
+            value -- the invalid value
+            message -- explanation of the error
+    """
+
+    def __init__(self, section, option, value, message="Invalid value"):
+        self.section = section
+        self.option = option
+        self.value = value
+        self.message = message
+
+    def __str__(self):
+        return f"\nSection: {self.section} \nOption: {self.option} = {self.value} \n{self.message}"
+
+
+def _parse_string(value: str = "") -> str:
+    return value.strip()
+
+
+def _parse_positive_int(value: str = "") -> int:
+    number = int(value)
+    if number < 1:
+        raise ValueError("Must be greater than 0")
+    return number
+
+
+def _parse_non_negative_int(value: str = "") -> int:
+    number = int(value)
+    if number < 0:
+        raise ValueError("Must not be negative")
+    return number
+
+
+def _parse_int(value: str = "") -> int:
+    return int(value)
+
+
+def _parse_float(value: str = "") -> float:
+    return float(value)
+
+
+def _parse_layer_ids(value: str = "") -> tuple:
+    # comma separated list of the IDs of the layers excluded from the feature count
+    return tuple(int(layer_id) for layer_id in value.split(",") if layer_id.strip())
+
+
+# Options of an item and the function that parses and validates them.  Parsers raise ValueError on an invalid value.
+# The exclusion options are compiled into the item's exclusion calendar (see EXCLUSION_OPTIONS).
+ITEM_OPTIONS = {
+    "profile": _parse_string,
+    "service_url": _parse_string,
+    "default_timeout": _parse_positive_int,
+    "default_retry_count": _parse_int,
+    "usage_data_range": _parse_string,
+    "exclusion": _parse_layer_ids,
+    "average_update_interval_factor": _parse_float,
+    "average_feed_interval_factor": _parse_float,
+    "average_elapsed_time_factor": _parse_float,
+    "consecutive_failures_threshold": _parse_int,
+    "percent_upper_bound": _parse_int,
+    "percent_lower_bound": _parse_int,
+    "rss_file_extension": _parse_string,
+    "rss_time_range": _parse_int,
+    "number_of_events_max": _parse_non_negative_int
+}
+
+# Value of the options an item may leave out (in the item and in [DEFAULT]), the other options of ITEM_OPTIONS are
+# required
+ITEM_OPTION_FALLBACKS = {
+    "rss_time_range": 0,
+    "number_of_events_max": 0
+}
+
+
+# Options compiled into the exclusion calendar of an item
+EXCLUSION_OPTIONS = ("exclude_time_ranges", "exclude_days", "exclude_specific_dates", "exclusion_timezone")
+
+
+class ItemConfig:
+    """
+    The configuration of a single item.  The options listed in ITEM_OPTIONS are parsed and validated once, when the
+    config file is loaded, all the other options (RSS template text, labels, ...) are available as strings through
+    `options`.  Values shared with the [DEFAULT] section are not copied, every item refers to the same parsed value.
+    """
+
+    __slots__ = ("id", "options", "exclusion_calendar") + tuple(ITEM_OPTIONS)
+
+    def __init__(self, item_id: str = "", options=None, values=None, exclusion_calendar=None):
+        """
+        :param item_id: The item ID (section name)
+        :param options: Mapping of option -> value (string) of the item
+        :param values: Dictionary of option -> parsed value of the options listed in ITEM_OPTIONS
+        :param exclusion_calendar: The item's TimeUtils.ExclusionCalendar
+        """
+        self.id = item_id
+        self.options = options
+        self.exclusion_calendar = exclusion_calendar
+        for option, value in values.items():
+            setattr(self, option, value)
+
+    def __repr__(self):
+        return f"ItemConfig({self.id})"
 
 
 class ConfigManager:
@@ -19,7 +130,11 @@ class ConfigManager:
         # path to ini file
         self.path = os.path.join(self.root, self.file_name)
         # instantiate config parser
-        self.parser = configparser.SafeConfigParser()
+        self.parser = configparser.ConfigParser()
+        # options of the [DEFAULT] section, and their parsed values (or the ConfigValidationError of an invalid value),
+        # shared by all the items
+        self._default_options = {}
+        self._default_values = {}
 
     def get_config_data(self, config_type):
         """
@@ -30,11 +145,42 @@ class ConfigManager:
         sections = self._get_sections_from_ini_file()
         # Prepare the script's input data model from the config file
         if config_type == "items":
+            self._load_defaults()
             input_data_model = list(map(self._load_item, sections))
         else:
             input_data_model = list(map(self._load_status_code, sections))
         return input_data_model
 
+    def get_default_boolean(self, option: str = "", fallback: bool = False) -> bool:
+        """
+        Retrieve a boolean option from the [DEFAULT] section of the ini file
+        :param option: The option name
+        :param fallback: Value returned if the option is missing or empty
+        :return: The option value
+        """
+        self.parser.read(self.path)
+        if not self.parser.defaults().get(option):
+            return fallback
+        return self.parser.getboolean(self.parser.default_section, option)
+
+    def get_defaults(self) -> dict:
+        """
+        Retrieve the options of the [DEFAULT] section of the ini file
+        :return: Dictionary of option -> value (string)
+        """
+        self.parser.read(self.path)
+        return dict(self.parser.defaults())
+
+    def get_default_value(self, option: str = "", fallback=None):
+        """
+        Retrieve an option from the [DEFAULT] section of the ini file
+        :param option: The option name
+        :param fallback: Value returned if the option is missing or empty
+        :return: The option value (string)
+        """
+        self.parser.read(self.path)
+        return self.parser.defaults().get(option) or fallback
+
     def _get_sections_from_ini_file(self):
         """
         :return: The ini file sections
@@ -45,12 +191,70 @@ class ConfigManager:
         sections = self.parser.sections()
         return sections
 
-    def _load_item(self, section: str = "") -> dict:
-        details_dict = dict(self.parser.items(section))
-        details_dict.update({
-            "id": section
-        })
-        return details_dict
+    def _load_defaults(self):
+        """
+        Parse the options of the [DEFAULT] section once.  Only the options present are parsed, and an invalid value is
+        only reported for the items that do not override it.
+        :return: None
+        """
+        self._default_options = dict(self.parser.defaults())
+        self._default_values = {}
+        for option in ITEM_OPTIONS:
+            if option in self._default_options:
+                try:
+                    self._default_values[option] = self._parse_option(self.parser.default_section, option,
+                                                                      self._default_options[option])
+                except ConfigValidationError as e:
+                    self._default_values[option] = e
+
+    def _load_item(self, section: str = "") -> ItemConfig:
+        # only the options the item sets (or overrides) are stored with the item
+        item_options = {
+            option: value for option, value in self.parser.items(section)
+            if self._default_options.get(option) != value
+        }
+        values = {}
+        for option in ITEM_OPTIONS:
+            if option in item_options:
+                values[option] = self._parse_option(section, option, item_options[option])
+            elif option in self._default_values:
+                values[option] = self._default_values[option]
+                if isinstance(values[option], ConfigValidationError):
+                    raise values[option]
+            elif option in ITEM_OPTION_FALLBACKS:
+                values[option] = ITEM_OPTION_FALLBACKS[option]
+            else:
+                raise ConfigValidationError(section, option, "", "Missing option (in the item and in [DEFAULT])")
+        options = ChainMap(item_options, self._default_options)
+        return ItemConfig(item_id=section,
+                          options=options,
+                          values=values,
+                          exclusion_calendar=self._load_exclusion_calendar(section, options))
+
+    @staticmethod
+    def _load_exclusion_calendar(section: str = "", options=None):
+        # items with the same exclusion options share the same compiled calendar
+        values = [options.get(option, "") for option in EXCLUSION_OPTIONS]
+        try:
+            return TimeUtils.get_exclusion_calendar(*values)
+        except ValueError:
+            # find the option at fault
+            for option, value, parse in zip(EXCLUSION_OPTIONS, values, (TimeUtils.parse_time_ranges,
+                                                                        TimeUtils.parse_days,
+                                                                        TimeUtils.parse_dates,
+                                                                        TimeUtils.parse_timezone)):
+                try:
+                    parse(value)
+                except ValueError as e:
+                    raise ConfigValidationError(section, option, value, str(e))
+            raise
+
+    @staticmethod
+    def _parse_option(section: str = "", option: str = "", value: str = ""):
+        try:
+            return ITEM_OPTIONS[option](value)
+        except ValueError as e:
+            raise ConfigValidationError(section, option, value, str(e))
 
     def _load_status_code(self, section: str = "") -> dict:
         details_dict = dict(self.parser.items(section))
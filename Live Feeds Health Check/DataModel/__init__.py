@@ -0,0 +1,222 @@
+"""
+The data model of an item during a run
+
+Every stage of the run (item, service and layer validation, usage statistics, feature counts, analysis and status)
+updates the same ItemRecord in place, rather than building a new dictionary of the item for each stage.
+
+This file can also be run as a module to measure the memory allocated by the checks with ItemRecord and with the
+dictionaries it replaced, on synthetic items
+
+    python -m DataModel [number of items]
+"""
+from datetime import datetime
+
+
+class ItemRecord:
+    """
+    An item's data model: its config, the results of its checks, its feed (ALFP) details and its status.
+
+    The objects the checks need (the ArcGIS item, the service response and the layers) are released by
+    :meth:`compact` once the checks are done, only the results are kept.
+    """
+
+    __slots__ = (
+        # config
+        "id", "config", "token",
+        # item meta-data
+        "title", "snippet", "service_url", "agol_item", "item_is_valid",
+        # service
+        "service_response",
+        # layers
+        "layers", "layer_query_params", "all_layers_are_valid", "layer_count", "layers_elapsed_times",
+        # counts and usage
+        "feature_count", "usage",
+        # feed (ALFP)
+        "last_update_timestamp", "last_run_timestamp", "avg_update_interval_mins", "avg_feed_interval_mins",
+        "consecutive_failures", "alfp_last_status",
+        # status
+        "comments", "last_build_time", "status", "timestamp"
+    )
+
+    def __init__(self, item_id: str = "", config=None, token: str = None):
+        """
+        :param item_id: The item ID
+        :param config: The item's ConfigManager.ItemConfig
+        :param token: The token of the GIS the item is checked with
+        """
+        self.id = item_id
+        self.config = config
+        self.token = token
+        # None until the item is validated (or carried over from the previous run)
+        self.title = None
+        self.snippet = None
+        self.service_url = None
+        self.agol_item = None
+        self.item_is_valid = False
+        # the RequestUtils.check_request response during the checks, {"success", "retryCount", "elapsedSeconds"}
+        # after compact()
+        self.service_response = None
+        self.layers = None
+        self.layer_query_params = None
+        self.all_layers_are_valid = False
+        self.layer_count = 0
+        self.layers_elapsed_times = []
+        self.feature_count = 0
+        self.usage = None
+        self.last_update_timestamp = 0
+        self.last_run_timestamp = 0
+        self.avg_update_interval_mins = 0
+        self.avg_feed_interval_mins = 0
+        self.consecutive_failures = 0
+        self.alfp_last_status = 0
+        self.comments = ""
+        self.last_build_time = 0
+        self.status = None
+        self.timestamp = None
+
+    def __repr__(self):
+        return f"ItemRecord({self.id})"
+
+    def merge_previous(self, status_record=None) -> None:
+        """
+        Carry over the meta-data, feature count and usage of the previous run, used when the item or its service
+        cannot be reached
+
+        :param status_record: The item's record in the previous status output, or the payload of a check job
+        :return: None
+        """
+        if "title" in status_record:
+            self.title = status_record["title"]
+        if "snippet" in status_record:
+            self.snippet = status_record["snippet"]
+        if "featureCount" in status_record:
+            self.feature_count = status_record["featureCount"]
+        if "usage" in status_record:
+            self.usage = status_record["usage"]
+
+    def check_payload(self) -> dict:
+        """ The fields of the previous run a worker needs to check the item (see :meth:`merge_previous`) """
+        payload = {"featureCount": self.feature_count, "usage": self.usage}
+        if self.title is not None:
+            payload["title"] = self.title
+        if self.snippet is not None:
+            payload["snippet"] = self.snippet
+        return payload
+
+    def compact(self, retry_count: int = 0, elapsed_seconds: float = 0) -> None:
+        """
+        Keep the results of the checks and release the ArcGIS item, the service response and the layers
+
+        :param retry_count: Number of retries of the service request
+        :param elapsed_seconds: Response time of the service
+        :return: None
+        """
+        self.service_response = {
+            "success": self.service_response["success"],
+            "retryCount": retry_count,
+            "elapsedSeconds": elapsed_seconds
+        }
+        self.layer_count = len(self.layers or [])
+        self.agol_item = None
+        self.layers = None
+        self.layer_query_params = None
+
+    def check_result(self) -> dict:
+        """ The results of the checks, after :meth:`compact`, as sent back by a worker (JSON) """
+        return {
+            "title": self.title,
+            "snippet": self.snippet,
+            "itemIsValid": self.item_is_valid,
+            "serviceResponse": self.service_response,
+            "allLayersAreValid": self.all_layers_are_valid,
+            "serviceLayersElapsedTimes": self.layers_elapsed_times,
+            "layerCount": self.layer_count,
+            "featureCount": self.feature_count,
+            "usage": self.usage
+        }
+
+    def apply_check_result(self, check_result=None) -> None:
+        """
+        Set the results of the checks done by a worker
+
+        :param check_result: The results (see :meth:`check_result`)
+        :return: None
+        """
+        self.title = check_result["title"]
+        self.snippet = check_result["snippet"]
+        self.item_is_valid = check_result["itemIsValid"]
+        self.service_response = check_result["serviceResponse"]
+        self.all_layers_are_valid = check_result["allLayersAreValid"]
+        self.layers_elapsed_times = check_result["serviceLayersElapsedTimes"]
+        self.layer_count = check_result["layerCount"]
+        self.feature_count = check_result["featureCount"]
+        self.usage = check_result["usage"]
+
+    def display_title(self) -> str:
+        """ The item's title, the missing_item_title option if the item has none """
+        return self.title if self.title is not None else self.config.options.get("missing_item_title")
+
+    def display_snippet(self) -> str:
+        """ The item's snippet, the missing_item_snippet option if the item has none """
+        return self.snippet if self.snippet is not None else self.config.options.get("missing_item_snippet")
+
+    def to_status_record(self) -> dict:
+        """ The item's record of the status output file """
+        return {
+            "id": self.id,
+            "title": self.display_title(),
+            "snippet": self.display_snippet(),
+            "comments": self.comments,
+            "lastUpdateTime": self.last_update_timestamp,
+            "updateRate": self.avg_update_interval_mins,
+            "featureCount": self.feature_count,
+            "usage": self.usage,
+            "status": {
+                "code": self.status["code"]
+            }
+        }
+
+    def to_event(self) -> dict:
+        """ An event of the item's event history, from its current status """
+        return {
+            "id": self.id,
+            "pubDate": datetime.now().strftime("%a, %d %b %Y %H:%M:%S +0000"),
+            "pubEventDate": self.timestamp or 0,
+            "title": self.display_title(),
+            "snippet": self.display_snippet(),
+            "comments": self.comments,
+            "lastBuildTime": self.last_build_time,
+            "updateRate": self.avg_update_interval_mins,
+            "featureCount": self.feature_count,
+            "usage": self.usage,
+            "status": self.status
+        }
+
+    def to_dict(self) -> dict:
+        """ The data model as a dictionary, keyed like the status output and the RSS templates (e.g. "itemIsValid") """
+        fields = {
+            "id": self.id,
+            "config": self.config,
+            "title": self.title,
+            "snippet": self.snippet,
+            "service_url": self.service_url,
+            "itemIsValid": self.item_is_valid,
+            "serviceResponse": self.service_response,
+            "allLayersAreValid": self.all_layers_are_valid,
+            "layerCount": self.layer_count,
+            "serviceLayersElapsedTimes": self.layers_elapsed_times,
+            "featureCount": self.feature_count,
+            "usage": self.usage,
+            "lastUpdateTimestamp": self.last_update_timestamp,
+            "lastRunTimestamp": self.last_run_timestamp,
+            "avgUpdateIntervalMins": self.avg_update_interval_mins,
+            "avgFeedIntervalMins": self.avg_feed_interval_mins,
+            "consecutiveFailures": self.consecutive_failures,
+            "alfpLastStatus": self.alfp_last_status,
+            "comments": self.comments,
+            "lastBuildTime": self.last_build_time,
+            "status": self.status,
+            "timestamp": self.timestamp
+        }
+        # fields not set yet are left out, like the keys missing from the dictionaries this replaced
+        return {key: value for key, value in fields.items() if value is not None}
@@ -0,0 +1,203 @@
+"""
+Measure the memory allocated by the checks of synthetic items, with DataModel.ItemRecord and with the dictionaries it
+replaced (a new dictionary of the whole item built by every stage)
+
+    python -m DataModel [number of items]
+
+The stages (item, service and layer validation, usage statistics and feature counts) are simulated with responses of
+a realistic size, the ArcGIS item and the service responses are kept by the data model until the checks are done.
+"""
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+from types import SimpleNamespace
+import DataModel as DataModel
+
+LAYERS_PER_ITEM = 3
+
+
+class _Response:
+    """ Stand-in of a requests.Response """
+
+    def __init__(self, content: bytes = b""):
+        self.content = content
+        self.elapsed = timedelta(milliseconds=120)
+        self.status_code = 200
+
+
+class _Layer:
+    """ Stand-in of an arcgis FeatureLayer """
+
+    def __init__(self, layer_id: int = 0, url: str = ""):
+        self.properties = {"id": layer_id, "name": f"Layer {layer_id}"}
+        self.url = f"{url}/{layer_id}"
+
+
+def _agol_item(item_id: str = ""):
+    url = f"https://services9.arcgis.com/RHVPKKiFTONKtxq3/arcgis/rest/services/{item_id}/FeatureServer"
+    agol_item = {
+        "title": f"Synthetic item {item_id}",
+        "snippet": "A synthetic item to measure the data model " * 4,
+        "url": url,
+        "typeKeywords": ["ArcGIS Server", "Data", "Feature Access", "Service", "Live Feed"]
+    }
+    agol_item["layers"] = [_Layer(layer_id, url) for layer_id in range(LAYERS_PER_ITEM)]
+    return agol_item
+
+
+def _service_response():
+    # the JSON description of a feature service is a few kB
+    return {"success": True, "response": _Response(b"{" + b'"x": 0, ' * 400 + b"}"), "retryCount": {}}
+
+
+def _layer_query_params(item_id, agol_item, token):
+    return [{
+        "add_token": False,
+        "id": item_id,
+        "layerId": layer.properties["id"],
+        "layerName": layer.properties["name"],
+        "params": {"where": "1=1", "returnGeometry": "false", "returnCountOnly": "true"},
+        "retryCount": 5,
+        "success": True,
+        "timeout": 5,
+        "token": token,
+        "try_json": True,
+        "url": layer.url + "/query"
+    } for layer in agol_item["layers"]]
+
+
+def _layers(item_id, agol_item, token):
+    return [{
+        "id": item_id,
+        "layerId": layer.properties["id"],
+        "addToken": False,
+        "name": layer.properties["name"],
+        "retryCount": 5,
+        "success": True,
+        "timeout": 5,
+        "token": token,
+        "url": layer.url
+    } for layer in agol_item["layers"]]
+
+
+def _elapsed_times(item_id, agol_item):
+    return [{"item": item_id, "elapsedTime": 0.12, "layerName": layer.properties["name"]}
+            for layer in agol_item["layers"]]
+
+
+def _usage():
+    return {"trendingCode": 0, "percentChange": 0.0, "usageCounts": [120, 118]}
+
+
+def check_with_dictionaries(configs=None, previous_status=None, token: str = ""):
+    """ The checks as they were done before ItemRecord, every stage copies the whole item into a new dictionary """
+    data_model = {config.id: {"id": config.id, "config": config, "token": token} for config in configs}
+    data_model = {key: {**previous_status[key], **value} for key, value in data_model.items()}
+    # the data model the analysis runs on, the validation of the items updates its dictionaries in place
+    hydrated = data_model
+    for value in data_model.values():
+        agol_item = _agol_item(value["id"])
+        value.update({"title": agol_item["title"], "snippet": agol_item["snippet"], "service_url": agol_item["url"],
+                      "agolItem": agol_item, "itemIsValid": True})
+    data_model = {key: {**value, **{"serviceResponse": _service_response()}} for key, value in data_model.items()}
+    data_model = {key: {**value,
+                        **{"allLayersAreValid": True},
+                        **{"layers": _layers(key, value["agolItem"], token)},
+                        **{"layerQueryParams": _layer_query_params(key, value["agolItem"], token)}}
+                  for key, value in data_model.items()}
+    data_model = {key: {**value, **{"usage": _usage()}} for key, value in data_model.items()}
+    data_model = {key: {**value,
+                        **{"featureCount": 1200},
+                        **{"serviceLayersElapsedTimes": _elapsed_times(key, value["agolItem"])}}
+                  for key, value in data_model.items()}
+    check_results = {key: {
+        "title": value["title"],
+        "snippet": value["snippet"],
+        "itemIsValid": value["itemIsValid"],
+        "serviceResponse": {"success": value["serviceResponse"]["success"], "retryCount": 0,
+                            "elapsedSeconds": value["serviceResponse"]["response"].elapsed.total_seconds()},
+        "allLayersAreValid": value["allLayersAreValid"],
+        "serviceLayersElapsedTimes": value["serviceLayersElapsedTimes"],
+        "layerCount": len(value["layers"]),
+        "featureCount": value["featureCount"],
+        "usage": value["usage"]
+    } for key, value in data_model.items()}
+    for key, check_result in check_results.items():
+        hydrated[key].update(check_result)
+    return hydrated
+
+
+def check_with_records(configs=None, previous_status=None, token: str = ""):
+    """ The checks with ItemRecord, every stage sets its results on the item's record """
+    data_model = {config.id: DataModel.ItemRecord(item_id=config.id, config=config, token=token) for config in configs}
+    for key, record in data_model.items():
+        record.merge_previous(previous_status[key])
+    for record in data_model.values():
+        agol_item = _agol_item(record.id)
+        record.title = agol_item["title"]
+        record.snippet = agol_item["snippet"]
+        record.service_url = agol_item["url"]
+        record.agol_item = agol_item
+        record.item_is_valid = True
+    for record in data_model.values():
+        record.service_response = _service_response()
+    for key, record in data_model.items():
+        record.layers = _layers(key, record.agol_item, token)
+        record.layer_query_params = _layer_query_params(key, record.agol_item, token)
+        record.all_layers_are_valid = True
+    for record in data_model.values():
+        record.usage = _usage()
+    for key, record in data_model.items():
+        record.feature_count = 1200
+        record.layers_elapsed_times = _elapsed_times(key, record.agol_item)
+    for record in data_model.values():
+        record.compact(retry_count=0,
+                       elapsed_seconds=record.service_response["response"].elapsed.total_seconds())
+    return data_model
+
+
+def measure(check, configs, previous_status):
+    tracemalloc.start()
+    start = time.perf_counter()
+    data_model = check(configs=configs, previous_status=previous_status, token="x" * 200)
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    del data_model
+    return {"seconds": elapsed, "peak": peak, "retained": retained, "blocks": blocks}
+
+
+def main():
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    options = {"missing_item_title": "Missing title", "missing_item_snippet": "Missing snippet"}
+    configs = [SimpleNamespace(id=f"{i:032x}", options=options, service_url="", default_retry_count=5,
+                               default_timeout=5, exclusion=[]) for i in range(n_items)]
+    previous_status = {config.id: {
+        "id": config.id,
+        "title": f"Synthetic item {config.id}",
+        "snippet": "A synthetic item to measure the data model " * 4,
+        "comments": [],
+        "lastUpdateTime": 1612467313,
+        "updateRate": 15,
+        "featureCount": 1100,
+        "usage": _usage(),
+        "status": {"code": "000"}
+    } for config in configs}
+
+    print(f"Items: {n_items}\tLayers per item: {LAYERS_PER_ITEM}\n")
+    print(f"{'data model':<16}{'peak (kB)':>12}{'retained (kB)':>16}{'blocks':>10}{'time (ms)':>12}")
+    results = {}
+    for name, check in (("dictionaries", check_with_dictionaries), ("ItemRecord", check_with_records)):
+        result = measure(check, configs, previous_status)
+        results[name] = result
+        print(f"{name:<16}{result['peak'] / 1024:>12.0f}{result['retained'] / 1024:>16.0f}{result['blocks']:>10}"
+              f"{result['seconds'] * 1000:>12.1f}")
+    print(f"\nPeak reduction: {1 - results['ItemRecord']['peak'] / results['dictionaries']['peak']:.0%}")
+    print(f"Retained reduction: {1 - results['ItemRecord']['retained'] / results['dictionaries']['retained']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
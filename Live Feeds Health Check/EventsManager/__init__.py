@@ -19,122 +19,444 @@ time_utils_response["datetimeObj"].strftime("%a, %d %b %Y %H:%M:%S +0000")
 
 
 """
-import json
+import bisect
 import os
-import pathlib
-import stat
+import time
 import FileManager as FileManager
-from datetime import datetime, timedelta
+import JsonUtils as JsonUtils
+import MetricsUtils as MetricsUtils
+from collections import deque
 
+# The sidecar index is only rewritten once the events appended since it was saved reach this many bytes, the events
+# appended after the indexed size are read from the end of the log when it is opened
+INDEX_SAVE_BYTES = 1024 * 1024
 
-def create_history_file(input_data=None, events_file=None):
-    """Create a new history file and hydrate it.
+# item ID -> EventHistory, histories stay in memory for the rest of the run once loaded
+_histories = {}
 
-    :param input_data: Input data
-    :param events_file: Output file
-    :return:
+
+class EventHistory:
     """
-    ct = datetime.now()
-    ct_timestamp = datetime.timestamp(ct)
-    dt_object = datetime.fromtimestamp(ct_timestamp)
-
-    FileManager.create_new_file(file_path=events_file)
-    FileManager.set_file_permission(file_path=events_file)
-    FileManager.save(data={
-        "id": input_data.get("id", ""),
-        "history": [{
-            "pubDate": dt_object.strftime("%a, %d %b %Y %H:%M:%S +0000"),
-            "pubEventDate": input_data.get("timestamp", 0),
-            "title": input_data.get("title", input_data.get("missing_item_title")),
-            "snippet": input_data.get("snippet", input_data.get("missing_item_snippet")),
-            "comments": input_data.get("comments", ""),
-            "lastBuildTime": input_data.get("lastBuildTime", 0),
-            "updateRate": input_data.get("avgUpdateIntervalMins", 0),
-            "featureCount": input_data.get("featureCount", 0),
-            "usage": input_data.get("usage"),
-            "status": input_data.get("status")
-        }],
-    }, path=events_file)
-
-
-def update_events_file(input_data=None, events_file=None):
+    Bounded history of an item's status events, ordered by pubEventDate (oldest first).
+
+    Events older than the RSS time range, or beyond the maximum number of events, are evicted from the front of the
+    history, so appending and trimming only cost as much as the number of events evicted.
     """
-    Update the file.
 
-    :param input_data:
-    :param events_file:
-    :return:
+    def __init__(self, item_id: str = "", max_events: int = 0, max_days: int = 0, events=None):
+        """
+        :param item_id: The item ID
+        :param max_events: Maximum number of events kept (number_of_events_max)
+        :param max_days: Number of days of events kept (rss_time_range)
+        :param events: Events to load into the history
+        """
+        self.item_id = item_id
+        # the event being added is always kept
+        self.max_events = max(int(max_events), 1)
+        self.max_days = int(max_days)
+        self.events = deque(sorted(events or [], key=lambda event: event.get("pubEventDate", 0)))
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __getitem__(self, index):
+        # indexing either end of a deque is O(1)
+        return self.events[index]
+
+    def append(self, event=None, now=None) -> list:
+        """
+        Add an event and evict the events that fall outside of the time range or exceed the maximum number of events.
+
+        :param event: The event
+        :param now: Timestamp (seconds since epoch) the time range is measured from, defaults to the current time
+        :return: The evicted events, oldest first
+        """
+        event_date = event.get("pubEventDate", 0)
+        if len(self.events) == 0 or self.events[-1].get("pubEventDate", 0) <= event_date:
+            self.events.append(event)
+        else:
+            # out of order event, this should not happen as events are added as they are observed
+            dates = [e.get("pubEventDate", 0) for e in self.events]
+            self.events.insert(bisect.bisect_right(dates, event_date), event)
+        return self.trim(now)
+
+    def trim(self, now=None) -> list:
+        """
+        Evict the events that fall outside of the time range or exceed the maximum number of events.
+
+        :param now: Timestamp (seconds since epoch) the time range is measured from, defaults to the current time
+        :return: The evicted events, oldest first
+        """
+        if now is None:
+            now = time.time()
+        oldest_allowed = now - self.max_days * 86400
+        evicted = []
+        while len(self.events) > self.max_events:
+            evicted.append(self.events.popleft())
+        while len(self.events) > 0 and self.events[0].get("pubEventDate", 0) < oldest_allowed:
+            evicted.append(self.events.popleft())
+        return evicted
+
+    def to_dict(self) -> dict:
+        """ Return the history in the (legacy) events file format """
+        return {
+            "id": self.item_id,
+            "history": list(self.events)
+        }
+
+
+class EventLog:
     """
-    ct = datetime.now()
-    ct_timestamp = datetime.timestamp(ct)
-    dt_object = datetime.fromtimestamp(ct_timestamp)
-
-    # JSON from events file
-    status_history_json = FileManager.open_file(path=events_file)
-    # history element
-    history = status_history_json["history"]
-    # number of events in the current item's history file
-    n_events = _get_num_events(history)
-    # maximum number of events permitted to be logged for this item
-    n_max_events = _get_num_events_ceiling(input_data)
-    # time constraints
-    rss_time_range_in_days = _get_rss_time_constrains(input_data)
-
-    # clean events file first
-    history = _clean_history_file(input_data=input_data,
-                                  events_history=history,
-                                  max_days_ago=rss_time_range_in_days)
-
-    # is the new event in the time range
-    # event_in_time_range = _is_event_in_time_range(input_data.get("pubEventDate", 0),
-    #                                              rss_time_range_in_days)
-
-    # if n_events >= n_max_events:
-    # number of events in the current item's history file
-    #    _get_num_events(history)
-    #    print("Remove the oldest event")
-    #    print(f"{history[0]}")
-    #    history.pop(0)
-    # else:
-    # print("\nUpdating events file")
-    # append new status to list
-    history.append({
-        "pubDate": dt_object.strftime("%a, %d %b %Y %H:%M:%S +0000"),
-        "pubEventDate": input_data.get("timestamp", 0),
-        "title": input_data.get("title", input_data.get("missing_item_title")),
-        "snippet": input_data.get("snippet", input_data.get("missing_item_snippet")),
-        "comments": input_data.get("comments", ""),
-        "lastBuildTime": input_data.get("lastBuildTime", 0),
-        "updateRate": input_data.get("avgUpdateIntervalMins", 0),
-        "featureCount": input_data.get("featureCount", 0),
-        "usage": input_data.get("usage"),
-        "status": input_data.get("status")
-    })
-    # update json
-    status_history_json.update({
-        "history": history
-    })
-    # write update to file
-    FileManager.save(data=status_history_json, path=events_file)
-    print(f"Events history file updated")
-    print(f"Number of events: {_get_num_events(history)}")
+    Append-only, line-delimited log of the status events of all items.
+
+    Each line is one JSON event with the item ID in its "id" property.  A sidecar index maps each item ID to the
+    (pubEventDate, byte offset) of its events, and the whole log is also indexed by pubEventDate, so queries only read
+    the lines they need.  Retention is enforced by periodic compaction, which rewrites the log without expired events.
+
+    The index covers the log up to the size it was saved at, it is not rewritten for every few events appended.  The
+    events appended afterwards are indexed from the end of the log when it is opened, and the index is saved again
+    once they reach INDEX_SAVE_BYTES (or the log is compacted).
+    """
+
+    def __init__(self, log_file: str = "", index_file: str = None):
+        """
+        :param log_file: Path to the log file
+        :param index_file: Path to the sidecar index, defaults to the log file path + ".idx"
+        """
+        self.log_file = log_file
+        self.index_file = index_file or log_file + ".idx"
+        # item id -> [[pubEventDate, offset], ...] ordered by pubEventDate
+        self._items = {}
+        # [[pubEventDate, offset], ...] of all the events ordered by pubEventDate
+        self._times = []
+        # size of the log in bytes (the offset of the next event)
+        self._size = 0
+        # size of the log the saved index covers
+        self._indexed_size = 0
+        self._handle = None
+        self.last_compacted = 0
+        self._load_index()
+
+    def __len__(self):
+        return len(self._times)
+
+    def has_item(self, item_id: str = "") -> bool:
+        """ Return True if the log has (or had before compaction) events for the item """
+        return item_id in self._items
+
+    def item_ids(self) -> list:
+        """ Return the IDs of the items the log has events for """
+        return list(self._items)
+
+    def last_event_date(self, item_id: str = ""):
+        """ Return the pubEventDate of the item's latest event, None if the log has no events for the item """
+        entries = self._items.get(item_id)
+        return entries[-1][0] if entries else None
+
+    def append(self, event=None) -> int:
+        """
+        Append an event to the log.
+
+        :param event: The event, must have an "id" property
+        :return: The offset of the event in the log
+        """
+        line = (JsonUtils.dumps(event) + "\n").encode("utf-8")
+        if self._handle is None:
+            self._handle = open(self.log_file, "ab")
+        offset = self._size
+        self._handle.write(line)
+        self._handle.flush()
+        self._size += len(line)
+        self._add_to_index(event, offset)
+        return offset
+
+    def events_for_item(self, item_id: str = "", since=None) -> list:
+        """
+        Return the events of an item, oldest first.
+
+        :param item_id: The item ID
+        :param since: Only return events with a pubEventDate at or after this timestamp
+        :return: List of events
+        """
+        entries = self._items.get(item_id, [])
+        if since is not None:
+            entries = entries[bisect.bisect_left(entries, [since]):]
+        return self._read([offset for _, offset in entries])
+
+    def events_in_window(self, start=None, end=None) -> list:
+        """
+        Return the events of all items within a time window, oldest first.
+
+        :param start: Window start timestamp (inclusive), None for the beginning of the log
+        :param end: Window end timestamp (inclusive), None for the end of the log
+        :return: List of events
+        """
+        return list(self.iter_events_in_window(start=start, end=end))
+
+    def iter_events_in_window(self, start=None, end=None):
+        """
+        Stream the events of all items within a time window, oldest first, reading one line at a time.
+
+        :param start: Window start timestamp (inclusive), None for the beginning of the log
+        :param end: Window end timestamp (inclusive), None for the end of the log
+        :return: Generator of events
+        """
+        lo = 0 if start is None else bisect.bisect_left(self._times, [start])
+        hi = len(self._times) if end is None else bisect.bisect_right(self._times, [end, float("inf")])
+        if lo >= hi:
+            return
+        with open(self.log_file, "rb") as file:
+            for _, offset in self._times[lo:hi]:
+                file.seek(offset)
+                yield JsonUtils.loads(file.readline())
+
+    def events_with_code(self, code: str = "", start=None, end=None) -> list:
+        """
+        Return the events of all items with a status code within a time window, oldest first.
+
+        :param code: The status code (e.g. "501")
+        :param start: Window start timestamp (inclusive), None for the beginning of the log
+        :param end: Window end timestamp (inclusive), None for the end of the log
+        :return: List of events
+        """
+        return [event for event in self.events_in_window(start=start, end=end)
+                if (event.get("status") or {}).get("code") == code]
 
+    def compact(self, retention=None, default_retention=(0, 0), now=None) -> int:
+        """
+        Rewrite the log keeping only the events each item's retention allows.
 
-def _clean_history_file(input_data=None, events_history=None, max_days_ago=None):
-    events_in_range = []
-    n_max_events = _get_num_events_ceiling(input_data)
-    # iterate through and remove items that are expired or exceed max number alowed
-    for index in range(len(events_history) - 1, -1, -1):
-        event = events_history[index]
-        if _is_event_in_time_range(event.get("pubEventDate", 0), max_days_ago):
-            print("Event in range")
-            if len(events_in_range) + 1 < n_max_events:
-                events_in_range.insert(0, event)
-            else:
-                print(f"Event dropped, too many on hand: {event}")
+        :param retention: Dictionary of item ID -> (max events, max days)
+        :param default_retention: (max events, max days) for items not in the retention dictionary (e.g. items that
+        were removed from the config file)
+        :param now: Timestamp (seconds since epoch) the retention is measured from, defaults to the current time
+        :return: The number of events removed
+        """
+        if retention is None:
+            retention = {}
+        if now is None:
+            now = time.time()
+        self.close()
+        kept = []
+        for item_id, entries in self._items.items():
+            max_events, max_days = retention.get(item_id, default_retention)
+            oldest_allowed = now - int(max_days) * 86400
+            entries = entries[bisect.bisect_left(entries, [oldest_allowed]):]
+            entries = entries[-int(max_events):] if int(max_events) > 0 else []
+            kept.extend(entries)
+        kept.sort()
+        removed = len(self._times) - len(kept)
+        tmp_file = self.log_file + ".tmp"
+        with open(self.log_file, "rb") as source, open(tmp_file, "wb") as target:
+            for _, offset in kept:
+                source.seek(offset)
+                target.write(source.readline())
+        os.replace(tmp_file, self.log_file)
+        self.rebuild_index()
+        self.last_compacted = now
+        self.save_index()
+        print(f"Event log compacted: {removed} events removed, {len(self._times)} events kept")
+        return removed
+
+    def compact_if_due(self, interval: int = 0, retention=None, default_retention=(0, 0), now=None) -> int:
+        """
+        Compact the log if the last compaction was more than interval seconds ago.
+
+        :param interval: Seconds between compactions
+        :param retention: See :meth:`compact`
+        :param default_retention: See :meth:`compact`
+        :param now: Timestamp (seconds since epoch), defaults to the current time
+        :return: The number of events removed
+        """
+        if now is None:
+            now = time.time()
+        if now - self.last_compacted < interval:
+            return 0
+        return self.compact(retention=retention, default_retention=default_retention, now=now)
+
+    def rebuild_index(self) -> None:
+        """ Rebuild the index by scanning the log. """
+        self._items = {}
+        self._times = []
+        self._size = 0
+        self._index_from(0)
+
+    def _index_from(self, offset: int = 0) -> None:
+        # index the events from the offset (the start of a line) to the end of the log
+        self._size = offset
+        if not FileManager.check_file_exist_by_os_path(self.log_file):
+            return
+        with open(self.log_file, "rb") as file:
+            file.seek(offset)
+            for line in file:
+                if line.endswith(b"\n"):
+                    self._add_to_index(JsonUtils.loads(line), self._size)
+                    self._size += len(line)
+                else:
+                    # partial line from an interrupted write, drop it
+                    print(f"Dropping incomplete event at offset {self._size} of {self.log_file}")
+                    break
+        if self._size != os.path.getsize(self.log_file):
+            with open(self.log_file, "r+b") as file:
+                file.truncate(self._size)
+
+    def copy_items_to(self, target_log=None, item_ids=None, after=None) -> int:
+        """
+        Append the events of some of the items to another log (e.g. to split the log between shards).
+
+        :param target_log: The EventLog the events are appended to
+        :param item_ids: IDs of the items whose events are copied
+        :param after: Dictionary of item ID -> pubEventDate, only the item's events after it are copied
+        :return: Number of events copied
+        """
+        if after is None:
+            after = {}
+        events = []
+        for item_id in item_ids or []:
+            since = after.get(item_id)
+            events.extend(event for event in self.events_for_item(item_id=item_id, since=since)
+                          if since is None or event.get("pubEventDate", 0) > since)
+        events.sort(key=lambda event: event.get("pubEventDate", 0))
+        for event in events:
+            target_log.append(event)
+        return len(events)
+
+    def save_index(self) -> None:
+        """ Write the sidecar index. """
+        FileManager.save(data={
+            "size": self._size,
+            "lastCompacted": self.last_compacted,
+            "items": self._items
+        }, path=self.index_file)
+        self._indexed_size = self._size
+
+    def close(self) -> None:
+        """ Close the log, and write the sidecar index if the events it does not cover reached INDEX_SAVE_BYTES. """
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        if self._size - self._indexed_size >= INDEX_SAVE_BYTES:
+            self.save_index()
+
+    def _load_index(self):
+        log_size = os.path.getsize(self.log_file) if FileManager.check_file_exist_by_os_path(self.log_file) else 0
+        if FileManager.check_file_exist_by_pathlib(self.index_file):
+            try:
+                index = FileManager.open_file(path=self.index_file)
+            except ValueError:
+                index = {}
+            self.last_compacted = index.get("lastCompacted", 0)
+            indexed_size = index.get("size")
+            if isinstance(indexed_size, int) and indexed_size <= log_size:
+                self._items = index.get("items", {})
+                self._times = sorted(entry for entries in self._items.values() for entry in entries)
+                if self._index_matches_log(indexed_size):
+                    self._indexed_size = indexed_size
+                    # the events appended since the index was saved
+                    self._index_from(indexed_size)
+                    return
+        # no index, or an index of another log (e.g. the log was compacted after the index was saved)
+        self.rebuild_index()
+        self._indexed_size = 0
+
+    def _index_matches_log(self, indexed_size: int = 0) -> bool:
+        # the last event of the index must be the line of the log that ends at the indexed size
+        if len(self._times) == 0:
+            return indexed_size == 0
+        pub_event_date, offset = max(self._times, key=lambda entry: entry[1])
+        with open(self.log_file, "rb") as file:
+            file.seek(offset)
+            line = file.readline()
+        try:
+            return offset + len(line) == indexed_size and line.endswith(b"\n") and \
+                JsonUtils.loads(line).get("pubEventDate", 0) == pub_event_date
+        except ValueError:
+            return False
+
+    def _add_to_index(self, event=None, offset: int = 0):
+        entry = [event.get("pubEventDate", 0), offset]
+        entries = self._items.setdefault(event.get("id", ""), [])
+        if len(entries) == 0 or entries[-1] <= entry:
+            entries.append(entry)
         else:
-            print(f"Event not in range: {event}")
-    return events_in_range
+            bisect.insort(entries, entry)
+        if len(self._times) == 0 or self._times[-1] <= entry:
+            self._times.append(entry)
+        else:
+            bisect.insort(self._times, entry)
+
+    def _read(self, offsets=None) -> list:
+        events = []
+        if len(offsets) == 0:
+            return events
+        with open(self.log_file, "rb") as file:
+            for offset in offsets:
+                file.seek(offset)
+                events.append(JsonUtils.loads(file.readline()))
+        return events
+
+
+def load_history(input_data=None, event_log: EventLog = None, legacy_events_file: str = None) -> EventHistory:
+    """
+    Return the event history of an item.  The history is read from the event log the first time, after that the
+    in-memory history is returned.
+
+    If the log has no events for the item but a per-item events file from an earlier version exists, its events are
+    imported into the log and the file is renamed with an ".imported" suffix.
+
+    :param input_data: The item's DataModel.ItemRecord
+    :param event_log: The event log
+    :param legacy_events_file: Path to the item's per-item events file (status_history_{id}.json)
+    :return: The item's event history
+    """
+    item_id = input_data.id
+    history = _histories.get(item_id)
+    MetricsUtils.record_cache(name="eventHistories", hit=history is not None)
+    if history is None:
+        history = EventHistory(item_id=item_id,
+                               max_events=_get_num_events_ceiling(input_data),
+                               max_days=_get_rss_time_constrains(input_data))
+        oldest_allowed = (input_data.timestamp or time.time()) - history.max_days * 86400
+        events = event_log.events_for_item(item_id=item_id, since=oldest_allowed)
+        if len(events) == 0 and legacy_events_file is not None and \
+                not event_log.has_item(item_id) and \
+                FileManager.check_file_exist_by_pathlib(path=legacy_events_file):
+            print(f"Importing events file: {legacy_events_file}")
+            for event in FileManager.open_file(path=legacy_events_file).get("history", []):
+                event_log.append({**event, **{"id": item_id}})
+            # keep the file for reference, but do not import it again
+            os.replace(legacy_events_file, legacy_events_file + ".imported")
+            events = event_log.events_for_item(item_id=item_id, since=oldest_allowed)
+        for event in events:
+            history.append(event, now=input_data.timestamp)
+        _histories[item_id] = history
+    return history
+
+
+def clear_histories() -> None:
+    """ Forget the cached event histories, they are reloaded from the event log when next needed. """
+    _histories.clear()
+
+
+def record_event(input_data=None, event_log: EventLog = None, legacy_events_file: str = None) -> EventHistory:
+    """
+    Append the item's current status to the event log and to the item's event history.
+
+    :param input_data: The item's DataModel.ItemRecord
+    :param event_log: The event log
+    :param legacy_events_file: Path to the item's per-item events file (see :func:`load_history`)
+    :return: The item's event history
+    """
+    history = load_history(input_data=input_data, event_log=event_log, legacy_events_file=legacy_events_file)
+    event = input_data.to_event()
+    event_log.append(event)
+    evicted = history.append(event, now=input_data.timestamp)
+    print(f"Number of events evicted: {len(evicted)}")
+    print(f"Number of events: {_get_num_events(history)}")
+    return history
 
 
 def _get_num_events(events_history=None):
@@ -153,10 +475,10 @@ def _get_num_events_ceiling(input_dict=None):
     """
     Return the maximum number of events permitted to be written in the events history file.
 
-    :param input_dict:
+    :param input_dict: The item's DataModel.ItemRecord
     :return:
     """
-    n_max_events = int(input_dict.get("number_of_events_max", 0))
+    n_max_events = input_dict.config.number_of_events_max
     print(f"Maximum number of events allowed: {n_max_events}")
     return n_max_events
 
@@ -165,23 +487,9 @@ def _get_rss_time_constrains(input_dict=None):
     """
     Get the time constraints.
 
-    :param input_dict:
+    :param input_dict: The item's DataModel.ItemRecord
     :return:
     """
-    n_days = input_dict.get("rss_time_range", 0)
+    n_days = input_dict.config.rss_time_range
     print(f"Time constraints: {n_days} days")
     return n_days
-
-
-def _is_event_in_time_range(time_to_check=None, time_limit=None) -> bool:
-    """
-    Check the event time to see if it falls within the range.
-
-    :param time_to_check:
-    :param time_limit: Time range in days "ago"
-    :return:
-    """
-    date_limit = datetime.now() - timedelta(days=int(time_limit))
-    if datetime.fromtimestamp(time_to_check) < date_limit:
-        return False
-    return True
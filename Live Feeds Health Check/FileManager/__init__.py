@@ -1,12 +1,307 @@
 """ Utility methods for working with files and directories """
+import gzip
+import hashlib
 import html
+import io
 import json
+import locale
 import os
 import pathlib
+import queue
+import re
 import stat
+import threading
 import xml.etree.ElementTree as Et
+import JsonUtils as JsonUtils
 import TimeUtils as TimeUtils
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# default maximum number of distinct paths waiting to be written by the write-behind writer
+DEFAULT_WRITE_QUEUE_SIZE = 256
+
+# number of characters read at a time by the streaming JSON reader
+DEFAULT_READ_CHUNK_SIZE = 65536
+
+# the active write-behind writer (None when writes are synchronous)
+_writer = None
+
+# path -> digest of the contents the compressed siblings were last generated from
+_precompressed_digests = {}
+# path -> size/ratio statistics of the compressed siblings
+_compression_stats = {}
+
+
+class WriteBehindWriter:
+    """
+    Background writer that takes file writes off the caller's thread.
+
+    Writes are submitted as (path, contents) pairs onto a bounded queue.  If a path is already waiting to be written,
+    the pending contents are replaced rather than queued a second time, so only the latest version of a file is
+    written.  Reads of a pending path are served from memory (see :func:`open_file`) so callers always see their own
+    writes.
+    """
+
+    def __init__(self, max_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE):
+        """
+        :param max_queue_size: Maximum number of distinct paths waiting to be written.  Submitting to a full queue
+        blocks until the writer catches up.
+        """
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        # path -> (contents, precompress, encoding) waiting to be written
+        self._pending = {}
+        # path -> (contents, precompress, encoding) currently being written
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.max_queue_size = max_queue_size
+        self.high_water_mark = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.errors = []
+        self._thread = threading.Thread(target=self._run, name="WriteBehindWriter", daemon=True)
+        self._thread.start()
+
+    def submit(self, path: str = "", contents: str = "", precompress: bool = False, encoding: str = None) -> None:
+        """
+        Queue the contents to be written to the path.
+
+        :param path: Output file path
+        :param contents: Text to write
+        :param precompress: Also write .gz (and .br) siblings of the file
+        :param encoding: Encoding of the file, None for the preferred encoding
+        :return: None
+        """
+        with self._lock:
+            self.submitted += 1
+            if path in self._pending:
+                # a write to this path is already queued, replace its contents
+                self._pending[path] = (contents, precompress, encoding)
+                self.coalesced += 1
+                return
+            self._pending[path] = (contents, precompress, encoding)
+        # put() blocks when the queue is full
+        self._queue.put(path)
+        self.high_water_mark = max(self.high_water_mark, self._queue.qsize())
+
+    def pending_contents(self, path: str = ""):
+        """
+        Return the contents waiting to be written to the path, or None if nothing is pending.
+
+        :param path: File path
+        :return: The pending text or None
+        """
+        with self._lock:
+            entry = self._pending.get(path)
+            if entry is None:
+                entry = self._in_flight.get(path)
+            return None if entry is None else entry[0]
+
+    def flush(self) -> None:
+        """ Block until every submitted write is on disk. """
+        self._queue.join()
+
+    def close(self) -> dict:
+        """
+        Flush the queue, stop the writer thread and return the writer statistics.
+
+        :return: Dictionary of statistics
+        """
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        return self.get_stats()
+
+    def get_stats(self) -> dict:
+        """ Return the writer statistics """
+        return {
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "errors": len(self.errors),
+            "maxQueueSize": self.max_queue_size,
+            "queueSize": self._queue.qsize(),
+            "queueHighWaterMark": self.high_water_mark
+        }
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            try:
+                if path is None:
+                    return
+                with self._lock:
+                    entry = self._pending.pop(path)
+                    self._in_flight[path] = entry
+                _write_text(path, *entry)
+                self.written += 1
+                with self._lock:
+                    self._in_flight.pop(path, None)
+            except Exception as e:
+                print(f"ERROR: Unable to write {path}: {e}")
+                with self._lock:
+                    self._in_flight.pop(path, None)
+                self.errors.append({"path": path, "error": str(e)})
+            finally:
+                self._queue.task_done()
+
+
+def start_write_behind(max_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE) -> WriteBehindWriter:
+    """
+    Route all subsequent writes made through this module through a background writer thread.
+
+    :param max_queue_size: Maximum number of distinct paths waiting to be written
+    :return: The writer
+    """
+    global _writer
+    if _writer is None:
+        _writer = WriteBehindWriter(max_queue_size=max_queue_size)
+    return _writer
+
+
+def flush_write_behind() -> dict:
+    """
+    Flush barrier, block until all queued writes are on disk.
+
+    :return: The writer statistics (empty if no writer is running)
+    """
+    if _writer is None:
+        return {}
+    _writer.flush()
+    return _writer.get_stats()
+
+
+def stop_write_behind() -> dict:
+    """
+    Flush and stop the background writer.  Subsequent writes are synchronous.
+
+    :return: The writer statistics (empty if no writer was running)
+    """
+    global _writer
+    stats = {}
+    if _writer is not None:
+        stats = _writer.close()
+        _writer = None
+    return stats
+
+
+def write_text(path: str = "", contents: str = "", precompress: bool = False, encoding: str = None) -> None:
+    """
+    Write text to a file, through the write-behind writer when one is running.
+
+    :param path: Output file path
+    :param contents: Text to write
+    :param precompress: Also write .gz (and .br when brotli is installed) siblings of the file so a static web server
+    can serve pre-compressed bytes.  The siblings are only regenerated when the contents change.
+    :param encoding: Encoding of the file (e.g. "utf-8" for a document that declares it), None for the preferred
+    encoding
+    :return: None
+    """
+    if _writer is not None:
+        _writer.submit(path, contents, precompress, encoding)
+    else:
+        _write_text(path, contents, precompress, encoding)
+
+
+def read_text(path: str = "", encoding: str = None) -> str:
+    """
+    Read a text file, returning the pending contents if a write to the path is still queued.
+
+    :param path: Path to the file
+    :param encoding: Encoding of the file, None for the preferred encoding
+    :return: The file contents
+    """
+    if _writer is not None:
+        contents = _writer.pending_contents(path)
+        if contents is not None:
+            return contents
+    with open(path, "r", encoding=encoding) as file:
+        return file.read()
+
+
+def _write_text(path: str = "", contents: str = "", precompress: bool = False, encoding: str = None) -> None:
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    with open(path, "w+", encoding=encoding) as file:
+        file.write(contents)
+    if precompress:
+        # compress the text in the encoding of the file
+        write_precompressed(path, contents.encode(encoding))
+
+
+def write_precompressed(path: str = "", data: bytes = b"") -> bool:
+    """
+    Write the gzip (and brotli) compressed siblings of a file, skipping the work if the contents have not changed since
+    the siblings were last generated.
+
+    :param path: Path to the uncompressed file
+    :param data: The uncompressed file contents
+    :return: True if the siblings were (re)generated
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    gzip_path = path + ".gz"
+    brotli_path = path + ".br"
+    updated = _precompressed_siblings_outdated(path, digest)
+    if updated:
+        # mtime=0 keeps the gzip output identical for identical input
+        with open(gzip_path, "wb") as file:
+            file.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(brotli_path, "wb") as file:
+                file.write(brotli.compress(data))
+        _precompressed_digests[path] = digest
+    _record_compression_stats(path, len(data), updated)
+    return updated
+
+
+def _precompressed_siblings_outdated(path: str = "", digest: str = "") -> bool:
+    gzip_path = path + ".gz"
+    if _precompressed_digests.get(path) is None and check_file_exist_by_os_path(gzip_path):
+        # first write of this path in this process, compare with the sibling left by a previous run
+        try:
+            with gzip.open(gzip_path, "rb") as file:
+                _precompressed_digests[path] = hashlib.sha1(file.read()).hexdigest()
+        except (OSError, EOFError):
+            pass
+    siblings_exist = check_file_exist_by_os_path(gzip_path) and \
+        (brotli is None or check_file_exist_by_os_path(path + ".br"))
+    return _precompressed_digests.get(path) != digest or not siblings_exist
+
+
+def _record_compression_stats(path: str = "", size: int = 0, updated: bool = False) -> None:
+    gzip_path = path + ".gz"
+    brotli_path = path + ".br"
+    stats = {
+        "bytes": size,
+        "gzipBytes": os.path.getsize(gzip_path),
+        "gzipRatio": _compression_ratio(os.path.getsize(gzip_path), size),
+        "updated": updated
+    }
+    if brotli is not None:
+        stats.update({
+            "brotliBytes": os.path.getsize(brotli_path),
+            "brotliRatio": _compression_ratio(os.path.getsize(brotli_path), size)
+        })
+    _compression_stats[path] = stats
+
+
+def get_compression_stats() -> dict:
+    """
+    Return the size and compression ratio of the pre-compressed siblings written (or found unchanged) in this process.
+
+    :return: Dictionary of path -> statistics
+    """
+    return _compression_stats
+
+
+def _compression_ratio(compressed_size: int = 0, size: int = 0) -> float:
+    if size == 0:
+        return 0
+    return round(compressed_size / size, 3)
+
 
 def check_file_exist_by_os_path(path: str = ""):
     """
@@ -30,6 +325,9 @@ def check_file_exist_by_pathlib(path: str = ""):
     :param path: Path to file
     :return: Boolean indicating if the file exist
     """
+    # A queued write counts as existing
+    if _writer is not None and _writer.pending_contents(path) is not None:
+        return True
     # Create path lib object.
     pl = pathlib.Path(path)
     # Check whether the path lib exist or not.
@@ -64,11 +362,19 @@ def set_file_permission(file_path):
     os.chmod(file_path, stat.S_IEXEC | stat.S_IWRITE)
 
 
-def save(data=None, path: str = "") -> None:
+def save(data=None, path: str = "", precompress: bool = False) -> None:
+    """
+    Serialize the data to JSON and write it to the path.  The data is serialized immediately so later changes to it
+    are not written.
+
+    :param data: JSON serializable data
+    :param path: Output file path
+    :param precompress: Also write pre-compressed siblings of the file (see :func:`write_text`)
+    :return: None
+    """
     if data is None:
         data = {}
-    with open(path, "w") as outfile:
-        json.dump(data, outfile)
+    write_text(path, JsonUtils.dumps(data), precompress)
 
 
 def open_file(path: str = "") -> dict:
@@ -77,9 +383,214 @@ def open_file(path: str = "") -> dict:
     :param path: Path to the file
     :return: Return the content of the file
     """
-    with open(path) as json_file:
-        data = json.load(json_file)
-    return data
+    return JsonUtils.loads(read_text(path))
+
+
+def save_streaming(data=None, path: str = "", items_key: str = "items", precompress: bool = False) -> None:
+    """
+    Serialize a JSON object whose items_key member is a (possibly very long) list to the path one item at a time, so
+    the whole document is never held in memory as a single string.  The other members are written first, the items
+    last.  The file is written under a temporary name and renamed over the path once complete, so readers never see
+    a partial file.
+
+    Unlike :func:`save`, the file is written synchronously, not through the write-behind writer.
+
+    :param data: Dictionary of JSON serializable members, items_key may be any iterable of JSON serializable items
+    :param path: Output file path
+    :param items_key: The member streamed item by item
+    :param precompress: Also write pre-compressed siblings of the file (see :func:`write_text`), compressed as the
+    file is written
+    :return: None
+    """
+    if data is None:
+        data = {}
+    if _writer is not None and _writer.pending_contents(path) is not None:
+        # an earlier write of the path is still queued, it must not land over this one
+        _writer.flush()
+    encoding = locale.getpreferredencoding(False)
+    temp_path = path + ".tmp"
+    digest = hashlib.sha1()
+    size = 0
+    gzip_file = None
+    brotli_file = None
+    brotli_compressor = None
+    compressed_files = []
+    if precompress:
+        compressed_files.append(open(temp_path + ".gz", "wb"))
+        # mtime=0 keeps the gzip output identical for identical input
+        gzip_file = gzip.GzipFile(filename="", mode="wb", compresslevel=9, mtime=0, fileobj=compressed_files[-1])
+        if brotli is not None:
+            brotli_file = open(temp_path + ".br", "wb")
+            compressed_files.append(brotli_file)
+            brotli_compressor = brotli.Compressor()
+    try:
+        with open(temp_path, "wb") as file:
+            for text in _iter_json_object(data, items_key):
+                chunk = text.encode(encoding)
+                file.write(chunk)
+                size += len(chunk)
+                if gzip_file is not None:
+                    digest.update(chunk)
+                    gzip_file.write(chunk)
+                if brotli_compressor is not None:
+                    brotli_file.write(brotli_compressor.process(chunk))
+        if gzip_file is not None:
+            gzip_file.close()
+        if brotli_compressor is not None:
+            brotli_file.write(brotli_compressor.finish())
+        for compressed_file in compressed_files:
+            compressed_file.close()
+        os.replace(temp_path, path)
+    finally:
+        for compressed_file in compressed_files:
+            compressed_file.close()
+        if check_file_exist_by_os_path(temp_path):
+            # the file was not completed, the path keeps its previous contents
+            for temp_file in (temp_path, temp_path + ".gz", temp_path + ".br"):
+                if check_file_exist_by_os_path(temp_file):
+                    os.remove(temp_file)
+    if precompress:
+        updated = _precompressed_siblings_outdated(path, digest.hexdigest())
+        for extension in (".gz", ".br"):
+            if check_file_exist_by_os_path(temp_path + extension):
+                if updated:
+                    os.replace(temp_path + extension, path + extension)
+                else:
+                    os.remove(temp_path + extension)
+        _precompressed_digests[path] = digest.hexdigest()
+        _record_compression_stats(path, size, updated)
+
+
+def _iter_json_object(data=None, items_key: str = "items"):
+    """ The JSON text of the object, in pieces, with items_key last and each of its items a piece """
+    members = [JsonUtils.dumps(key) + ":" + JsonUtils.dumps(value) for key, value in data.items() if key != items_key]
+    yield "{" + ",".join(members)
+    if items_key in data:
+        yield ("," if members else "") + JsonUtils.dumps(items_key) + ":["
+        separator = ""
+        for item in data[items_key]:
+            yield separator + JsonUtils.dumps(item)
+            separator = ","
+        yield "]"
+    yield "}"
+
+
+# whitespace between JSON tokens
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _JsonStreamReader:
+    """ Incremental parser of the members of a JSON object and the items of one of its list members """
+
+    def __init__(self, file=None, chunk_size: int = DEFAULT_READ_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def _read_more(self) -> bool:
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        # drop what has been parsed before growing the buffer
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def next_token(self) -> str:
+        """ Skip the whitespace and return the next character, without consuming it ("" at the end of the file) """
+        while True:
+            self.position = _JSON_WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read_more():
+                return ""
+
+    def expect(self, characters: str = "") -> str:
+        """ Consume the next character, which must be one of the characters """
+        token = self.next_token()
+        if token == "" or token not in characters:
+            raise json.JSONDecodeError(f"Expecting one of {characters!r}", self.buffer, self.position)
+        self.position += 1
+        return token
+
+    def value(self):
+        """ Consume and return the next JSON value """
+        self.next_token()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # the value may continue past the end of the buffer
+                if not self._read_more():
+                    raise
+                continue
+            if end == len(self.buffer) and self._read_more():
+                # a number at the end of the buffer may be truncated
+                continue
+            self.position = end
+            return value
+
+
+def open_file_streaming(path: str = "", items_key: str = "items", fields=None,
+                        chunk_size: int = DEFAULT_READ_CHUNK_SIZE) -> dict:
+    """
+    Open a JSON object whose items_key member is a (possibly very long) list, without reading the whole file in
+    memory.  The members before the list are read immediately, the items are parsed one at a time as the list is
+    iterated, and the members after the list are added to the returned dictionary once the iteration is done.
+
+    :param path: Path to the file
+    :param items_key: The list member to stream
+    :param fields: Only keep these fields of the items, None to keep all the fields
+    :param chunk_size: Number of characters read at a time
+    :return: Dictionary of the members, with an iterator of the items as items_key (an empty list if the object has
+    no such member)
+    """
+    pending = read_text(path) if _writer is not None and _writer.pending_contents(path) is not None else None
+    file = io.StringIO(pending) if pending is not None else open(path, "r")
+    reader = _JsonStreamReader(file=file, chunk_size=chunk_size)
+    data = {}
+    try:
+        reader.expect("{")
+        if reader.next_token() == "}":
+            file.close()
+            return data
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key == items_key:
+                reader.expect("[")
+                data[items_key] = _iter_json_items(reader, data, fields)
+                return data
+            data[key] = reader.value()
+            if reader.expect(",}") == "}":
+                file.close()
+                return data
+    except Exception:
+        file.close()
+        raise
+
+
+def _iter_json_items(reader=None, data=None, fields=None):
+    try:
+        if reader.next_token() != "]":
+            while True:
+                item = reader.value()
+                if fields is not None:
+                    item = {field: item[field] for field in fields if field in item}
+                yield item
+                if reader.expect(",]") == "]":
+                    break
+        else:
+            reader.expect("]")
+        # the members after the list
+        while reader.expect(",}") == ",":
+            key = reader.value()
+            reader.expect(":")
+            data[key] = reader.value()
+    finally:
+        reader.file.close()
 
 
 def get_response_time_data(path: str = "") -> dict:
@@ -87,9 +598,7 @@ def get_response_time_data(path: str = "") -> dict:
     :param path:
     :return:
     """
-    with open(path) as json_file:
-        data = json.load(json_file)
-    return data
+    return JsonUtils.loads(read_text(path))
 
 
 def update_response_time_data(path: str = "", input_data=None):
@@ -100,8 +609,7 @@ def update_response_time_data(path: str = "", input_data=None):
     """
     if input_data is None:
         input_data = {}
-    with open(path, "w") as out_file:
-        json.dump(input_data, out_file)
+    save(data=input_data, path=path)
 
 
 def get_status_from_feed(filename):
@@ -163,6 +671,5 @@ def init_rss_file(rss_template=None, item_template=None, input_dict=None, rss_fi
         output_file_contents = data.format_map(input_dict)
 
     # Over-write to an existing or new file
-    with open(rss_file, "w+") as file:
-        file.write(output_file_contents)
+    write_text(rss_file, output_file_contents)
 
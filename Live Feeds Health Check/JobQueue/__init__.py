@@ -0,0 +1,468 @@
+""" Job queue the coordinator hands the item checks to the workers through (multi-node runs) """
+import os
+import socket
+import sqlite3
+import time
+import uuid
+import JsonUtils as JsonUtils
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Default number of seconds a worker holds a job before it is handed to another worker
+DEFAULT_LEASE_SECONDS = 300
+
+# Default number of times a job is leased before it is given up on
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Job states
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# GetDriveTypeW of a network drive (Windows)
+DRIVE_REMOTE = 4
+
+# Redis scripts, each runs atomically on the server so the state of a job, its lease and the queue never disagree
+
+# Pop up to ARGV[3] jobs from the queue and lease them to worker ARGV[1] until ARGV[2], jobs purged while queued are
+# skipped.  KEYS: queue, leases.  ARGV: worker, lease expiry, count, job key prefix, leased state.  Returns a list of
+# [job ID, [run ID, item ID, payload, attempts]]
+_LEASE_SCRIPT = """
+local jobs = {}
+for i = 1, tonumber(ARGV[3]) do
+    local job_id = redis.call('RPOP', KEYS[1])
+    if not job_id then
+        break
+    end
+    local key = ARGV[4] .. job_id
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+        redis.call('HSET', key, 'state', ARGV[5], 'worker', ARGV[1])
+        redis.call('HINCRBY', key, 'attempts', 1)
+        table.insert(jobs, {job_id, redis.call('HMGET', key, 'run_id', 'item_id', 'payload', 'attempts')})
+    end
+end
+return jobs
+"""
+
+# Extend the lease of a job held by worker ARGV[2] to ARGV[3].  KEYS: leases, job.  ARGV: job ID, worker, lease
+# expiry.  Returns 1 if the lease was extended
+_EXTEND_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'worker') ~= ARGV[2] or not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+# Store the result of a job held by worker ARGV[2].  KEYS: leases, job.  ARGV: job ID, worker, done state, result.
+# Returns 1 if the job was completed
+_COMPLETE_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'worker') ~= ARGV[2] or redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[2], 'state', ARGV[3], 'result', ARGV[4])
+return 1
+"""
+
+# Hand a leased job back to the queue, or mark it failed once it was leased ARGV[3] times.  Only if worker ARGV[2]
+# holds the job, any worker when ARGV[2] is empty (expired leases).  KEYS: leases, job, queue.  ARGV: job ID, worker,
+# maximum attempts, failed state, queued state.  Returns 1 if the lease was removed
+_RETURN_SCRIPT = """
+if ARGV[2] ~= '' and redis.call('HGET', KEYS[2], 'worker') ~= ARGV[2] then
+    return 0
+end
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    -- purged while leased
+    return 1
+end
+if tonumber(redis.call('HGET', KEYS[2], 'attempts') or 0) >= tonumber(ARGV[3]) then
+    redis.call('HSET', KEYS[2], 'state', ARGV[4], 'worker', '')
+else
+    redis.call('HSET', KEYS[2], 'state', ARGV[5], 'worker', '')
+    redis.call('LPUSH', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+
+class JobQueueError(Exception):
+    """Exception raised for errors when the job queue cannot be opened.
+
+        Attributes:
+            url -- queue URL which caused the error
+            message -- explanation of the error
+    """
+
+    def __init__(self, url, message="Unable to open the job queue"):
+        self.url = url
+        self.message = message
+
+    def __str__(self):
+        return f"\nJob queue: {self.url} \n{self.message}"
+
+
+class Job:
+    """ A job leased by a worker """
+    __slots__ = ("id", "run_id", "item_id", "payload", "attempts")
+
+    def __init__(self, job_id=None, run_id: str = "", item_id: str = "", payload=None, attempts: int = 0):
+        self.id = job_id
+        self.run_id = run_id
+        self.item_id = item_id
+        self.payload = payload or {}
+        self.attempts = attempts
+
+
+class SQLiteJobQueue:
+    """
+    Job queue in a SQLite database file, for workers on the same host or sharing the file over a network drive.  A
+    local file uses write-ahead logging, which needs shared memory and so only works on one host, a file on a network
+    drive (a UNC path or a mapped drive) uses the rollback journal instead.  SQLite relies on the file locks of the
+    network file system there, use the Redis queue when they cannot be trusted (e.g. NFS).
+
+    A leased job belongs to the worker until its lease expires.  An expired job goes back to the queue (or is marked
+    failed once it has been leased `max_attempts` times), so the checks of a worker that died are picked up by the
+    other workers.  A worker that lost its lease cannot complete the job.
+    """
+
+    def __init__(self, path: str = "", lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        """
+        :param path: Path to the database file, created if it does not exist
+        :param lease_seconds: Seconds a worker holds a job
+        :param max_attempts: Number of times a job is leased before it is marked failed
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # autocommit, transactions are started explicitly
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=DELETE" if is_network_path(path) else "PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                result TEXT
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run_id, state)")
+
+    def enqueue(self, run_id: str = "", jobs=None) -> int:
+        """
+        Add jobs to the queue.
+
+        :param run_id: The run the jobs belong to
+        :param jobs: Iterable of (item ID, payload dictionary)
+        :return: Number of jobs added
+        """
+        rows = [(run_id, item_id, JsonUtils.dumps(payload), QUEUED) for item_id, payload in jobs or []]
+        with self._transaction():
+            self._connection.executemany("INSERT INTO jobs (run_id, item_id, payload, state) VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def lease(self, worker: str = "", count: int = 1, now: float = None) -> list:
+        """
+        Take the oldest queued jobs.
+
+        :param worker: The worker ID
+        :param count: Maximum number of jobs
+        :param now: Current time (seconds since epoch)
+        :return: List of Job
+        """
+        now = time.time() if now is None else now
+        with self._transaction():
+            self._requeue_expired(now)
+            rows = self._connection.execute(
+                "SELECT id, run_id, item_id, payload, attempts FROM jobs WHERE state = ? ORDER BY id LIMIT ?",
+                (QUEUED, count)).fetchall()
+            self._connection.executemany(
+                "UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(LEASED, worker, now + self.lease_seconds, row[0]) for row in rows])
+        return [Job(job_id=row[0], run_id=row[1], item_id=row[2], payload=JsonUtils.loads(row[3]), attempts=row[4] + 1)
+                for row in rows]
+
+    def extend_lease(self, job=None, worker: str = "", now: float = None) -> bool:
+        """
+        Extend the lease of a job still held by the worker.
+
+        :return: False if the worker no longer holds the job
+        """
+        now = time.time() if now is None else now
+        with self._transaction():
+            cursor = self._connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = ? AND worker = ?",
+                (now + self.lease_seconds, job.id, LEASED, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job=None, worker: str = "", result=None) -> bool:
+        """
+        Store the result of a job.
+
+        :param job: The Job
+        :param worker: The worker ID
+        :param result: The result dictionary
+        :return: False if the worker no longer holds the job (its result is discarded)
+        """
+        with self._transaction():
+            cursor = self._connection.execute(
+                "UPDATE jobs SET state = ?, result = ?, lease_expires = NULL WHERE id = ? AND state = ? AND worker = ?",
+                (DONE, JsonUtils.dumps(result), job.id, LEASED, worker))
+        return cursor.rowcount == 1
+
+    def release(self, job=None, worker: str = "") -> bool:
+        """
+        Hand a job back to the queue (e.g. the worker is stopping), it counts as an attempt.
+
+        :return: False if the worker no longer holds the job
+        """
+        with self._transaction():
+            cursor = self._connection.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, "
+                "lease_expires = NULL WHERE id = ? AND state = ? AND worker = ?",
+                (self.max_attempts, FAILED, QUEUED, job.id, LEASED, worker))
+        return cursor.rowcount == 1
+
+    def requeue_expired(self, now: float = None) -> int:
+        """
+        Put the jobs whose lease expired back in the queue.
+
+        :param now: Current time (seconds since epoch)
+        :return: Number of jobs re-queued or given up on
+        """
+        now = time.time() if now is None else now
+        with self._transaction():
+            return self._requeue_expired(now)
+
+    def results(self, run_id: str = "") -> dict:
+        """
+        :param run_id: The run
+        :return: Dictionary of item ID -> result of the completed jobs of the run
+        """
+        rows = self._connection.execute("SELECT item_id, result FROM jobs WHERE run_id = ? AND state = ?",
+                                        (run_id, DONE))
+        return {item_id: JsonUtils.loads(result) for item_id, result in rows}
+
+    def counts(self, run_id: str = "") -> dict:
+        """
+        :param run_id: The run
+        :return: Dictionary of state -> number of jobs of the run
+        """
+        rows = self._connection.execute("SELECT state, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY state", (run_id,))
+        return {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0, **dict(rows.fetchall())}
+
+    def purge(self, run_id: str = "") -> None:
+        """ Remove the jobs of a run """
+        with self._transaction():
+            self._connection.execute("DELETE FROM jobs WHERE run_id = ?", (run_id,))
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _requeue_expired(self, now):
+        cursor = self._connection.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, lease_expires = NULL "
+            "WHERE state = ? AND lease_expires < ?",
+            (self.max_attempts, FAILED, QUEUED, LEASED, now))
+        return cursor.rowcount
+
+    def _transaction(self):
+        return _SQLiteTransaction(self._connection)
+
+
+def is_network_path(path: str = "") -> bool:
+    """
+    :param path: Path to a file
+    :return: True if the path is a UNC path or on a network drive (Windows)
+    """
+    if path.startswith(("\\\\", "//")):
+        return True
+    drive = os.path.splitdrive(path)[0]
+    if os.name == "nt" and drive:
+        import ctypes
+        return ctypes.windll.kernel32.GetDriveTypeW(drive + "\\") == DRIVE_REMOTE
+    return False
+
+
+class _SQLiteTransaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers never lease the same job
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+class RedisJobQueue:
+    """
+    Job queue on a Redis (or Redis-compatible) server, for workers on several hosts.  Same behaviour as
+    :class:`SQLiteJobQueue`.
+
+    Keys (under the prefix): `next_id` job ID counter, `queue` list of queued job IDs, `leases` sorted set of leased
+    job IDs by lease expiry, `job:{id}` hash of each job and `run:{run_id}` set of the job IDs of each run.  A job
+    changes state (and moves between the queue and the leases) in a single script run on the server.
+    """
+
+    def __init__(self, url: str = "", lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS, prefix: str = "livefeeds:"):
+        """
+        :param url: Server URL (redis://host:port/db)
+        :param lease_seconds: Seconds a worker holds a job
+        :param max_attempts: Number of times a job is leased before it is marked failed
+        :param prefix: Prefix of the keys
+        """
+        if redis is None:
+            raise JobQueueError(url, "The redis package is not installed")
+        self.url = url
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._lease_script = self._client.register_script(_LEASE_SCRIPT)
+        self._extend_script = self._client.register_script(_EXTEND_SCRIPT)
+        self._complete_script = self._client.register_script(_COMPLETE_SCRIPT)
+        self._return_script = self._client.register_script(_RETURN_SCRIPT)
+
+    def enqueue(self, run_id: str = "", jobs=None) -> int:
+        """ See :meth:`SQLiteJobQueue.enqueue` """
+        jobs = list(jobs or [])
+        if not jobs:
+            return 0
+        last_id = self._client.incrby(self._key("next_id"), len(jobs))
+        pipeline = self._client.pipeline()
+        for job_id, (item_id, payload) in enumerate(jobs, start=last_id - len(jobs) + 1):
+            pipeline.hset(self._key(f"job:{job_id}"), mapping={
+                "run_id": run_id, "item_id": item_id, "payload": JsonUtils.dumps(payload), "state": QUEUED,
+                "attempts": 0, "worker": ""})
+            pipeline.sadd(self._key(f"run:{run_id}"), job_id)
+            pipeline.lpush(self._key("queue"), job_id)
+        pipeline.execute()
+        return len(jobs)
+
+    def lease(self, worker: str = "", count: int = 1, now: float = None) -> list:
+        """ See :meth:`SQLiteJobQueue.lease` """
+        now = time.time() if now is None else now
+        self.requeue_expired(now)
+        leased = self._lease_script(keys=[self._key("queue"), self._key("leases")],
+                                    args=[worker, now + self.lease_seconds, count, self._key("job:"), LEASED])
+        return [Job(job_id=job_id, run_id=run_id, item_id=item_id, payload=JsonUtils.loads(payload),
+                    attempts=int(attempts))
+                for job_id, (run_id, item_id, payload, attempts) in leased]
+
+    def extend_lease(self, job=None, worker: str = "", now: float = None) -> bool:
+        """ See :meth:`SQLiteJobQueue.extend_lease` """
+        now = time.time() if now is None else now
+        return self._extend_script(keys=[self._key("leases"), self._key(f"job:{job.id}")],
+                                   args=[job.id, worker, now + self.lease_seconds]) == 1
+
+    def complete(self, job=None, worker: str = "", result=None) -> bool:
+        """ See :meth:`SQLiteJobQueue.complete` """
+        return self._complete_script(keys=[self._key("leases"), self._key(f"job:{job.id}")],
+                                     args=[job.id, worker, DONE, JsonUtils.dumps(result)]) == 1
+
+    def release(self, job=None, worker: str = "") -> bool:
+        """ See :meth:`SQLiteJobQueue.release` """
+        return self._return_to_queue(job.id, worker)
+
+    def requeue_expired(self, now: float = None) -> int:
+        """ See :meth:`SQLiteJobQueue.requeue_expired` """
+        now = time.time() if now is None else now
+        requeued = 0
+        for job_id in self._client.zrangebyscore(self._key("leases"), "-inf", f"({now}"):
+            # whoever removes the lease owns the job, so each expired job is re-queued once
+            if self._return_to_queue(job_id):
+                requeued += 1
+        return requeued
+
+    def results(self, run_id: str = "") -> dict:
+        """ See :meth:`SQLiteJobQueue.results` """
+        results = {}
+        for job in self._get_run_jobs(run_id):
+            if job.get("state") == DONE:
+                results[job["item_id"]] = JsonUtils.loads(job["result"])
+        return results
+
+    def counts(self, run_id: str = "") -> dict:
+        """ See :meth:`SQLiteJobQueue.counts` """
+        counts = {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        for job in self._get_run_jobs(run_id):
+            if job.get("state") in counts:
+                counts[job["state"]] += 1
+        return counts
+
+    def purge(self, run_id: str = "") -> None:
+        """ See :meth:`SQLiteJobQueue.purge` """
+        run_key = self._key(f"run:{run_id}")
+        job_ids = self._client.smembers(run_key)
+        pipeline = self._client.pipeline()
+        for job_id in job_ids:
+            pipeline.delete(self._key(f"job:{job_id}"))
+            pipeline.lrem(self._key("queue"), 0, job_id)
+            pipeline.zrem(self._key("leases"), job_id)
+        pipeline.delete(run_key)
+        pipeline.execute()
+
+    def close(self) -> None:
+        self._client.close()
+
+    def _return_to_queue(self, job_id, worker=""):
+        # worker: only if the worker holds the job, empty for any worker
+        return self._return_script(keys=[self._key("leases"), self._key(f"job:{job_id}"), self._key("queue")],
+                                   args=[job_id, worker, self.max_attempts, FAILED, QUEUED]) == 1
+
+    def _get_run_jobs(self, run_id):
+        pipeline = self._client.pipeline()
+        for job_id in self._client.smembers(self._key(f"run:{run_id}")):
+            pipeline.hgetall(self._key(f"job:{job_id}"))
+        return pipeline.execute()
+
+    def _key(self, name):
+        return self.prefix + name
+
+
+def open_queue(url: str = "", lease_seconds: float = DEFAULT_LEASE_SECONDS, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+    """
+    Open the job queue.
+
+    :param url: redis://host:port/db (or rediss://) for a Redis queue, sqlite:///path or a file path for a SQLite queue
+    :param lease_seconds: Seconds a worker holds a job
+    :param max_attempts: Number of times a job is leased before it is marked failed
+    :return: SQLiteJobQueue or RedisJobQueue
+    """
+    if url.startswith(("redis://", "rediss://")):
+        return RedisJobQueue(url=url, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else url
+    if not path:
+        raise JobQueueError(url, "No queue path")
+    try:
+        return SQLiteJobQueue(path=os.path.realpath(path), lease_seconds=lease_seconds, max_attempts=max_attempts)
+    except sqlite3.Error as e:
+        raise JobQueueError(url, str(e))
+
+
+def new_run_id() -> str:
+    """ :return: A unique run ID """
+    return f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+
+
+def new_worker_id() -> str:
+    """ :return: A worker ID unique across hosts """
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:4]}"
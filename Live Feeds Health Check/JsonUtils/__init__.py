@@ -0,0 +1,134 @@
+"""
+Serialization backend for all JSON I/O in the project
+
+orjson is used when it is installed, otherwise the standard library json module is used.  Both backends accept and
+return the same Python types, so callers do not need to know which one is active.
+
+This file can also be run as a module to benchmark the available backends against the project's JSON files
+
+    python -m JsonUtils
+"""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# name of the active backend
+BACKEND = "orjson" if orjson is not None else "json"
+
+# orjson writes non-ASCII characters as is, they are escaped like the standard library does (ensure_ascii), so the
+# documents can be written in any encoding (the files are written in the Windows code page)
+_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+
+
+def _escape_non_ascii(match):
+    code = ord(match.group())
+    if code > 0xFFFF:
+        # surrogate pair
+        code -= 0x10000
+        return "\\u{0:04x}\\u{1:04x}".format(0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return "\\u{0:04x}".format(code)
+
+
+def loads(data):
+    """
+    Deserialize a JSON document
+
+    :param data: JSON document as str or bytes
+    :return: The deserialized object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+
+def dumps(data=None, sort_keys: bool = False) -> str:
+    """
+    Serialize an object to a JSON formatted str
+
+    :param data: JSON serializable object
+    :param sort_keys: Sort the keys of dictionaries, so equal objects always serialize to the same document
+    :return: JSON document
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            document = orjson.dumps(data, option=option).decode("utf-8")
+            return document if document.isascii() else _NON_ASCII.sub(_escape_non_ascii, document)
+        except TypeError:
+            # orjson is stricter than the standard library (e.g. integers over 64 bits), let json handle those
+            pass
+    return json.dumps(data, sort_keys=sort_keys)
+
+
+def load(path: str = ""):
+    """
+    Deserialize a JSON file
+
+    :param path: Path to the file
+    :return: The deserialized object
+    """
+    with open(path) as json_file:
+        return loads(json_file.read())
+
+
+def dump(data=None, path: str = "") -> None:
+    """
+    Serialize an object to a JSON file
+
+    :param data: JSON serializable object
+    :param path: Output file path
+    :return: None
+    """
+    with open(path, "w") as json_file:
+        json_file.write(dumps(data))
+
+
+def benchmark(paths=None, number: int = 200) -> list:
+    """
+    Time loads/dumps of each file with the standard library and with orjson (when installed).
+
+    :param paths: Paths to JSON files
+    :param number: Number of iterations per file
+    :return: List of results, one per file
+    """
+    import timeit
+
+    if paths is None:
+        paths = []
+    results = []
+    for path in paths:
+        with open(path, "rb") as json_file:
+            raw = json_file.read()
+        try:
+            raw.decode("utf-8")
+        except UnicodeDecodeError:
+            # statusCodes.json is saved with a Windows code page, benchmark the utf-8 equivalent
+            raw = raw.decode("cp1252").encode("utf-8")
+        try:
+            data = json.loads(raw)
+        except ValueError as e:
+            # e.g. the malformed status fixture
+            results.append({"file": path, "bytes": len(raw), "error": str(e)})
+            continue
+        result = {
+            "file": path,
+            "bytes": len(raw),
+            "json": {
+                "loads": timeit.timeit(lambda: json.loads(raw), number=number) / number,
+                "dumps": timeit.timeit(lambda: json.dumps(data), number=number) / number
+            }
+        }
+        if orjson is not None:
+            result["orjson"] = {
+                "loads": timeit.timeit(lambda: orjson.loads(raw), number=number) / number,
+                "dumps": timeit.timeit(lambda: orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS),
+                                       number=number) / number
+            }
+        results.append(result)
+    return results
@@ -0,0 +1,38 @@
+"""
+Benchmark the JSON backends against the project's JSON files (status outputs, event history and status codes)
+
+    python -m JsonUtils [number of iterations]
+"""
+import glob
+import os
+import sys
+import JsonUtils as JsonUtils
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = sorted(glob.glob(os.path.join(root_dir, "output", "status*.json")))
+    paths += sorted(glob.glob(os.path.join(root_dir, "event_history", "*.json")))
+    paths.append(os.path.join(root_dir, "statusCodes.json"))
+
+    print(f"Active backend: {JsonUtils.BACKEND}")
+    print(f"Iterations per file: {number}\n")
+    print(f"{'file':<72}{'bytes':>8}{'op':>7}{'json (us)':>12}{'orjson (us)':>13}{'speedup':>9}")
+    for result in JsonUtils.benchmark(paths=paths, number=number):
+        name = os.path.relpath(result["file"], root_dir)
+        if "error" in result:
+            print(f"{name:<72}{result['bytes']:>8}  skipped, not valid JSON: {result['error']}")
+            continue
+        for op in ("loads", "dumps"):
+            json_time = result["json"][op] * 1e6
+            if "orjson" in result:
+                orjson_time = result["orjson"][op] * 1e6
+                print(f"{name:<72}{result['bytes']:>8}{op:>7}{json_time:>12.2f}{orjson_time:>13.2f}"
+                      f"{json_time / orjson_time:>8.1f}x")
+            else:
+                print(f"{name:<72}{result['bytes']:>8}{op:>7}{json_time:>12.2f}{'n/a':>13}{'n/a':>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,31 +17,51 @@
 """
 LiveFeedsHealthCheck
 
-1) Authenticate GIS profile
+1) Authenticate the GIS profiles (portals)
 2) Setup
 3) Validation and Health check
 4) Process results
 5) Create/Update RSS files
 6) Save output
 
+Run with --daemon to stay resident and repeat the check on a schedule (see HealthCheck and Scheduler.Daemon).
+Run with --coordinator to hand the checks to workers (--worker, on any number of hosts) through the job queue.
+
 """
 
 try:
-    import arcgis
-    import arcpy
+    # arcgis and arcpy are imported where they are used: the RSS render processes re-run the imports of this module
+    # (spawn start method) and must not load them
+    import argparse
+    import contextlib
+    import glob
     import html
     import json
     import os
+    import DataModel as DataModel
     import EventsManager as EventsManager
     import FileManager as FileManager
+    import JobQueue as JobQueue
+    import JsonUtils as JsonUtils
     import LoggingUtils as LoggingUtils
+    import MetricsUtils as MetricsUtils
+    import PortalManager as PortalManager
+    import PrometheusExporter as PrometheusExporter
     import QueryEngine as QueryEngine
+    import RequestUtils as RequestUtils
+    import RetryUtils as RetryUtils
     import RSSManager as RSSManager
+    import Scheduler as Scheduler
+    import ShardManager as ShardManager
     import ServiceValidator as ServiceValidator
+    import StatusAPI as StatusAPI
     import StatusManager as StatusManager
+    import threading
+    import time
     import TimeUtils as TimeUtils
     import version as version
     from ConfigManager import ConfigManager
+    from ConfigManager import ConfigValidationError
     from UserUtils import User
 except ImportError as e:
     print(f"Import Error: {e}")
@@ -79,524 +99,1355 @@ class InputFileNotFoundError(Exception):
         return f"\nThe file {self.input_file} was not found or does not exist!"
 
 
-def main():
-    # Script version number
-    print(f"\nRunning version: {version.version_str}")
-
-    print("\n=================================================================")
-    print(f"Loading ini file")
-    print("=================================================================")
-    # The root directory of the script
-    root_dir = os.path.dirname(os.path.abspath(__file__))
-    print(f"Project Root Directory: {root_dir}\n")
-
-    # Load config ini file
-    print("Loading input items from configuration file\n")
-    # Routines for handling the loading and parsing of the config ini file
-    #
-    # A configuration file consists of sections, lead by a "[section]" header,
-    # and followed by "name: value" entries, with continuations and such in
-    # the style of RFC 822.
-    config_ini_manager = ConfigManager(root=root_dir, file_name="config.ini")
-    # Items we will analyze
-    input_items = config_ini_manager.get_config_data(config_type="items")
+class HealthCheck:
+    """
+    The health check and the state kept between runs.
 
-    print("\n=================================================================")
-    print(f"Authenticate GIS profile")
-    print("=================================================================")
-    # TODO: Not the best way at all to get the profile property from the config file
-    gis_profile = input_items[0]["profile"]
-    # initialize GIS object
-    gis = arcgis.GIS(profile=gis_profile)
-    #gis = arcgis.GIS()
-    # just check if there is a token to determine if it's a named user or anonymous
-    if gis._con.token is None:
-        print("Anonymous sign-in")
-    else:
-        # Eye candy
-        # Get the installation properties and print to stdout
-        # initialize User object
-        user = gis.users.get(gis_profile)
-        install_info = arcpy.GetInstallInfo()
-        user_sys = User(user=user, install_info=install_info)
-        user_sys.greeting()
+    :meth:`load` reads the config file, authenticates the GIS profiles and loads the status codes, status rules,
+    comments and RSS templates.  :meth:`run` runs one check.  In daemon mode the same object runs every check, so the
+    GIS connections, the HTTP sessions, the loaded files, the previous run's status and the event histories stay in
+    memory between runs.
 
-    print("\n=================================================================")
-    print(f"Hydrating input data model from config file parameters")
-    print("=================================================================")
-    # Data model
-    data_model_dict = {}
-    # Number of items we are working with (derived from the config ini)
-    item_count = len(input_items)
-    if item_count < 1:
-        raise ItemCountNotInRangeError(item_count)
-    else:
-        print(f"There are {item_count} items")
-        for input_item in input_items:
-            print(f"{input_item['id']}")
-            data_model_dict.update({
-                input_item["id"]: {**input_item, **{"token": gis._con.token}}
-            })
+    Items are grouped by their GIS profile (portal), each portal has its own GIS connection and token and its items are
+    checked in parallel with the other portals' (see PortalManager).
+    """
 
-    print("\n=================================================================")
-    print(f"Setting up project and checking folders and directories")
-    print("=================================================================")
-    # Load status codes
-    # TODO Move filename to config
-    status_code_config_path = os.path.realpath(root_dir + r"\statusCodes.json")
-    status_code_json_exist = FileManager.check_file_exist_by_pathlib(path=status_code_config_path)
-    if status_code_json_exist is False:
-        # TODO: At this point we really cannot move forward
-        raise InputFileNotFoundError(status_code_config_path)
-    else:
-        status_codes_data_model = FileManager.open_file(path=status_code_config_path)
-
-    # Load comments
-    print("\n=================================================================")
-    print(f"Checking/Creating comments folder")
-    print("=================================================================")
-    # TODO Move filename to config
-    admin_comments_file_path = os.path.realpath(root_dir + r"\comments.json")
-    admin_comments_file_exist = FileManager.check_file_exist_by_pathlib(path=admin_comments_file_path)
-    if admin_comments_file_exist is False:
-        # TODO: At this point we really cannot move forward
-        raise InputFileNotFoundError(admin_comments_file_path)
-    else:
-        admin_comments_data_model = FileManager.open_file(path=admin_comments_file_path)
-
-    # retrieve the alf statuses
-    print("\n=================================================================")
-    print("Retrieving and Processing Active Live Feed Processed files")
-    print("=================================================================")
-    alf_processor_queries = list(map(QueryEngine.prepare_alfp_query_params, data_model_dict.items()))
-    alf_processor_response = QueryEngine.get_alfp_content(alf_processor_queries)
-    alfp_content = list(map(QueryEngine.process_alfp_response, alf_processor_response))
-    alfp_dict = {}
-    for content in alfp_content:
-        # check if there is alfp content was successfully retrieved
-        if content["success"]:
-            unique_item_key = content["id"]
-            alfp_dict.update({
-                unique_item_key: content["content"]
-            })
-        else:
-            print(f"ERROR: No ALFP data on record for {content['id']}")
+    def __init__(self, root_dir: str = "", shard_index: int = None, shard_count: int = 1):
+        """
+        :param root_dir: The root directory of the script
+        :param shard_index: Only check the items of this shard (see ShardManager), None to check all the items
+        :param shard_count: Number of shards
+        """
+        self.root_dir = root_dir
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.config_ini_manager = None
+        # Items we will analyze
+        self.input_items = []
+        self.precompress_outputs = False
+        # The portals the items are checked with, profile -> PortalManager.Portal
+        self.portals = {}
+        self.status_codes_data_model = None
+        self.rule_engine = None
+        self.admin_comments_data_model = None
+        self.rss_manager = None
+        self.event_log = None
+        # Plans which items each run checks (adaptive cadence), None to check all the items every run
+        self.planner = None
+        # Job queue the checks are handed to the workers through (coordinator mode), None to run the checks here
+        self.job_queue = None
+        # Size of the job queue at the end of the last dispatch, and the number of jobs queued
+        self.job_queue_stats = None
+        # Prometheus metrics, updated at the end of every run
+        self.metrics_registry = PrometheusExporter.Registry()
+        # HTTP status API (daemon mode), None when not serving, and the snapshot of the resources it serves
+        self.status_server = None
+        self.status_snapshot = None
+        # Items changed by each of the recent runs, loaded by the first run and kept in memory afterwards (not used by
+        # the shards, the coordinator records the deltas of the merged status)
+        self.status_deltas = None
+        # The status' of all the items in the previous run, read from the status file by the first run and kept in
+        # memory afterwards
+        self.previous_status_output = None
+        # TODO Move folder names to config
+        # Directory where the output files are stored
+        self.output_status_dir_path = os.path.realpath(root_dir + r"\output")
+        # Build the path to status file.
+        self.status_file = os.path.realpath(self.output_status_dir_path + r"\status.json")
+        # The status file the previous run's status is read from
+        self.previous_status_file = self.status_file
+        # The deltas of the recent runs, and the delta of the last run
+        self.status_deltas_file = os.path.realpath(self.output_status_dir_path + r"\status_deltas.json")
+        self.status_delta_file = os.path.realpath(self.output_status_dir_path + r"\status_delta.json")
+        # Status rule hit counts and evaluation time
+        self.rule_stats_file = os.path.realpath(self.output_status_dir_path + r"\rule_stats.json")
+        # Stage durations, requests, counts and errors of the last run
+        self.run_metrics_file = os.path.realpath(self.output_status_dir_path + r"\run_metrics.json")
+        # Historical "elapsed times" file directory
+        self.response_time_data_dir = os.path.realpath(root_dir + r"\ResponseTimeData")
+        # Directory of the rss feeds
+        self.rss_dir_path = os.path.realpath(root_dir + r"\rss")
+        # Directory of the event log
+        self.event_history_dir_path = os.path.realpath(root_dir + r"\event_history")
+        self.event_log_file = os.path.realpath(self.event_history_dir_path + r"\events.log")
+        if shard_index is not None:
+            # Each shard writes its own status file and event log, the coordinator merges the status files into the
+            # status file (which every shard reads the previous run's status from)
+            shard_name = f"{shard_index}_of_{shard_count}"
+            self.shard_dir_path = os.path.realpath(self.output_status_dir_path + r"\shards")
+            self.status_file = os.path.realpath(self.shard_dir_path + r"\status_" + shard_name + ".json")
+            self.rule_stats_file = os.path.realpath(self.shard_dir_path + r"\rule_stats_" + shard_name + ".json")
+            self.run_metrics_file = os.path.realpath(self.shard_dir_path + r"\run_metrics_" + shard_name + ".json")
+            self.event_log_file = os.path.realpath(self.event_history_dir_path + r"\events_" + shard_name + ".log")
+        # TODO Move filenames to config
+        self.config_file = os.path.realpath(root_dir + r"\config.ini")
+        self.status_code_config_path = os.path.realpath(root_dir + r"\statusCodes.json")
+        self.status_rules_path = os.path.realpath(root_dir + r"\statusRules.json")
+        self.admin_comments_file_path = os.path.realpath(root_dir + r"\comments.json")
+        self.rss_template_path = root_dir + r"\rss_template.xml"
+        self.rss_item_template_path = root_dir + r"\rss_item_template.xml"
+
+    def watched_files(self) -> list:
+        """
+        :return: The input files, a change to any of them reloads the configuration in daemon mode
+        """
+        return [self.config_file, self.status_code_config_path, self.status_rules_path,
+                self.admin_comments_file_path, self.rss_template_path, self.rss_item_template_path]
+
+    def load(self):
+        """
+        Load (or reload) the config file and the input files.  Nothing is replaced until everything has loaded, so a
+        failed reload leaves the running configuration in place.
+        :return: None
+        """
+        with MetricsUtils.span("load"):
+            print("\n=================================================================")
+            print(f"Loading ini file")
+            print("=================================================================")
+            print(f"Project Root Directory: {self.root_dir}\n")
+
+            # Load config ini file
+            print("Loading input items from configuration file\n")
+            # Routines for handling the loading and parsing of the config ini file
+            #
+            # A configuration file consists of sections, lead by a "[section]" header,
+            # and followed by "name: value" entries, with continuations and such in
+            # the style of RFC 822.
+            config_ini_manager = ConfigManager(root=self.root_dir, file_name="config.ini")
+            # Items we will analyze
+            input_items = config_ini_manager.get_config_data(config_type="items")
+            # Number of items we are working with (derived from the config ini)
+            item_count = len(input_items)
+            if item_count < 1:
+                raise ItemCountNotInRangeError(item_count)
+            if self.shard_index is not None:
+                input_items = [input_item for input_item in input_items
+                               if ShardManager.shard_of(input_item.id, self.shard_count) == self.shard_index]
+                item_count = len(input_items)
+                print(f"Shard {self.shard_index} of {self.shard_count}")
+
+            print("\n=================================================================")
+            print(f"Setting up project and checking folders and directories")
+            print("=================================================================")
+            # Load status codes
+            status_code_json_exist = FileManager.check_file_exist_by_pathlib(path=self.status_code_config_path)
+            if status_code_json_exist is False:
+                # TODO: At this point we really cannot move forward
+                raise InputFileNotFoundError(self.status_code_config_path)
+            else:
+                status_codes_data_model = FileManager.open_file(path=self.status_code_config_path)
+
+            # Load and compile the status rules
+            if FileManager.check_file_exist_by_pathlib(path=self.status_rules_path) is False:
+                raise InputFileNotFoundError(self.status_rules_path)
+            rule_engine = StatusManager.load_rule_engine(path=self.status_rules_path,
+                                                         status_codes_data_model=status_codes_data_model)
+
+            # Load comments
+            print("\n=================================================================")
+            print(f"Checking/Creating comments folder")
+            print("=================================================================")
+            admin_comments_file_exist = FileManager.check_file_exist_by_pathlib(path=self.admin_comments_file_path)
+            if admin_comments_file_exist is False:
+                # TODO: At this point we really cannot move forward
+                raise InputFileNotFoundError(self.admin_comments_file_path)
+            else:
+                admin_comments_data_model = FileManager.open_file(path=self.admin_comments_file_path)
+
+            # Load RSS template
+            print("\n=================================================================")
+            print(f"Loading RSS template files")
+            print("=================================================================")
+            # Write .gz/.br copies of the status file and RSS files for the web server
+            precompress_outputs = config_ini_manager.get_default_boolean(option="precompress_outputs")
+            # The templates are read and parsed once, any field they reference that is not in the config file (or filled
+            # in at run time) is reported here rather than part way through the run
+            rss_manager = RSSManager.RSS(self.rss_template_path, self.rss_item_template_path,
+                                         precompress=precompress_outputs,
+                                         incremental=config_ini_manager.get_default_boolean("rss_incremental_updates"),
+                                         known_fields=set().union(*[input_item.options for input_item in input_items]))
+
+            # Everything loaded, switch to the new configuration
+            self.config_ini_manager = config_ini_manager
+            self.input_items = input_items
+            self.precompress_outputs = precompress_outputs
+            self.status_codes_data_model = status_codes_data_model
+            self.rule_engine = rule_engine
+            self.admin_comments_data_model = admin_comments_data_model
+            if self.rss_manager is not None:
+                # the render processes of the previous templates
+                self.rss_manager.close()
+            self.rss_manager = rss_manager
+            if self.planner is not None:
+                self.planner.configure(**self.get_cadence_settings())
+            print(f"There are {item_count} items")
+
+            self.update_portals(input_items=input_items, config_ini_manager=config_ini_manager)
+
+            if self.event_log is None:
+                self.create_folders()
+            else:
+                # the cached event histories were sized with the previous configuration
+                EventsManager.clear_histories()
+
+    def get_cadence_settings(self) -> dict:
+        """
+        :return: The adaptive cadence settings of the config file, as Scheduler.CheckPlanner arguments
+        """
+        return {
+            "min_interval": float(self.config_ini_manager.get_default_value("cadence_min_minutes", 2)) * 60,
+            "max_interval": float(self.config_ini_manager.get_default_value("cadence_max_minutes", 60)) * 60,
+            "degraded_interval": float(self.config_ini_manager.get_default_value("cadence_degraded_minutes", 2)) * 60,
+            "update_interval_factor": float(self.config_ini_manager.get_default_value(
+                "cadence_update_interval_factor", 0.5)),
+            "request_budget": int(self.config_ini_manager.get_default_value("cadence_request_budget", 0))
+        }
+
+    def update_portals(self, input_items=None, config_ini_manager=None):
+        """
+        Authenticate the GIS profiles of the items not signed in yet (see sign_in_portals), forget the profiles no
+        longer used and set the number of items of each portal checked at the same time (portal_check_concurrency, and
+        its per profile overrides portal_check_concurrency_limits)
+        :param input_items: The items
+        :param config_ini_manager: The config file
+        :return: None
+        """
+        concurrency = int(config_ini_manager.get_default_value("portal_check_concurrency",
+                                                               PortalManager.DEFAULT_CONCURRENCY))
+        limits_value = config_ini_manager.get_default_value("portal_check_concurrency_limits", "")
+        try:
+            limits = PortalManager.parse_concurrency_limits(limits_value)
+        except ValueError as e:
+            raise ConfigValidationError("DEFAULT", "portal_check_concurrency_limits", limits_value, str(e))
+        portals = {}
+        for profile in PortalManager.group_items(input_items):
+            portal = self.portals.get(profile) or PortalManager.Portal(profile=profile)
+            portal.max_concurrency = limits.get(profile, concurrency)
+            portals[profile] = portal
+        self.portals = portals
+        self.sign_in_portals()
+        # the items of all the portals checked at the same time may send requests to the same host
+        RequestUtils.set_pool_size(sum(portal.max_concurrency for portal in portals.values()))
+        print(f"Portals: {', '.join(f'{portal.profile} ({portal.max_concurrency})' for portal in portals.values())}")
+
+    def sign_in_portals(self):
+        """
+        Sign in to the portals not signed in yet, or whose sign-in failed, at the same time (see
+        PortalManager.sign_in).  The items of a portal that cannot be signed in are not checked.
+        :return: None
+        """
+        PortalManager.sign_in(portals=self.portals.values(),
+                              authenticate=lambda profile: self.authenticate(gis_profile=profile),
+                              parallel_authenticate=lambda profile: self.authenticate(gis_profile=profile, timed=False))
+
+    def authenticate(self, gis_profile: str = "", timed: bool = True):
+        """
+        Authenticate the GIS profile
+        :param gis_profile: The profile name
+        :param timed: Time the sign-in as a stage (MetricsUtils.span), False when called from a thread of a thread pool
+        :return: The GIS object
+        """
+        span = MetricsUtils.span if timed else (lambda name: contextlib.nullcontext())
+        print("\n=================================================================")
+        with span("authenticate"):
+            print(f"Authenticate GIS profile {gis_profile}")
+            print("=================================================================")
+            import arcgis
+            # initialize GIS object
+            gis = arcgis.GIS(profile=gis_profile)
+            #gis = arcgis.GIS()
+            # just check if there is a token to determine if it's a named user or anonymous
+            if gis._con.token is None:
+                print("Anonymous sign-in")
+            else:
+                # Eye candy
+                # Get the installation properties and print to stdout
+                # initialize User object
+                user = gis.users.get(gis_profile)
+                import arcpy
+                install_info = arcpy.GetInstallInfo()
+                user_sys = User(user=user, install_info=install_info)
+                user_sys.greeting()
+            return gis
+
+    def create_folders(self):
+        """
+        Create the output folders and open the event log
+        :return: None
+        """
+        print("\n=================================================================")
+        print(f"Checking/Creating output folder")
+        print("=================================================================")
+        # Create a new directory if it does not exists
+        FileManager.create_new_folder(self.output_status_dir_path)
+
+        # response time directory
+        print("\n=================================================================")
+        print(f"Checking/Creating response time data folder")
+        print("=================================================================")
+        # Create a new directory if it does not exists
+        FileManager.create_new_folder(file_path=self.response_time_data_dir)
+
+        # Create a new directory to hold the rss feeds (if it does not exist)
+        print("\n=================================================================")
+        print(f"Checking/Creating RSS output folder")
+        print("=================================================================")
+        FileManager.create_new_folder(file_path=self.rss_dir_path)
+
+        # Event history
+        print("\n=================================================================")
+        print(f"Checking/Creating status event history folder")
+        print("=================================================================")
+        FileManager.create_new_folder(file_path=self.event_history_dir_path)
+        # Single append-only log holding the events of all the items (of the shard)
+        self.event_log = EventsManager.EventLog(log_file=self.event_log_file)
+        if self.shard_index is not None:
+            FileManager.create_new_folder(file_path=self.shard_dir_path)
+        self.sync_event_log()
+        print(f"Events on record: {len(self.event_log)}")
+
+    def sync_event_log(self) -> None:
+        """
+        Copy the events the event log is missing from the event logs of the other shard counts: a shard's log from the
+        unsharded log and the logs of the previous shard counts, the unsharded log from the shard logs.  Each item's
+        events are copied from the log with its latest event, only those after the item's latest event in this log.
+        :return: None
+        """
+        source_files = glob.glob(os.path.join(glob.escape(self.event_history_dir_path), "events_*_of_*.log"))
+        if self.shard_index is not None:
+            # the other shards of this shard count hold none of this shard's items, and are being written to
+            source_files = [source_file for source_file in source_files
+                            if not source_file.endswith(f"_of_{self.shard_count}.log")]
+            source_files.append(os.path.realpath(self.event_history_dir_path + r"\events.log"))
+        source_files = [source_file for source_file in source_files
+                        if os.path.realpath(source_file) != self.event_log_file
+                        and FileManager.check_file_exist_by_pathlib(path=source_file)]
+        if not source_files:
+            return
+        source_logs = {source_file: EventsManager.EventLog(log_file=source_file) for source_file in source_files}
+        # item ID -> (pubEventDate of its latest event, log file holding it)
+        latest = {}
+        for source_file, source_log in source_logs.items():
+            for item_id in source_log.item_ids():
+                if self.shard_index is not None and \
+                        ShardManager.shard_of(item_id, self.shard_count) != self.shard_index:
+                    continue
+                last_event_date = source_log.last_event_date(item_id)
+                if last_event_date > latest.get(item_id, (self.event_log.last_event_date(item_id) or 0, None))[0]:
+                    latest[item_id] = (last_event_date, source_file)
+        for source_file, source_log in source_logs.items():
+            item_ids = [item_id for item_id, (_, latest_file) in latest.items() if latest_file == source_file]
+            if item_ids:
+                copied = source_log.copy_items_to(target_log=self.event_log, item_ids=item_ids,
+                                                  after={item_id: self.event_log.last_event_date(item_id)
+                                                         for item_id in item_ids})
+                print(f"Events copied from {source_file}: {copied}")
+
+    def run(self):
+        """
+        Run one health check of all the items (or, with adaptive cadence, of the items due for a check)
+        :return: Summary of the run
+        """
+        run_started = time.monotonic()
+        # Retry counts are reported per run
+        RetryUtils.clear_retry_output()
+
+        # Items checked in this run
+        input_items = self.input_items
+        with MetricsUtils.span("plan"):
+            if self.planner is not None:
+                print("\n=================================================================")
+                print(f"Planning checks")
+                print("=================================================================")
+                now = time.time()
+                self.planner.sync([input_item.id for input_item in self.input_items], now=now)
+                due_item_ids = set(self.planner.due_items(now=now))
+                input_items = [input_item for input_item in self.input_items if input_item.id in due_item_ids]
+                print(f"Items due for a check: {len(input_items)} of {len(self.input_items)}")
+        if len(input_items) == 0:
+            print("No items to check")
+            # the planning belongs to this run, not to the next one
+            MetricsUtils.finish_run()
+            return {"items": 0, "runSeconds": round(time.monotonic() - run_started, 3)}
+
+        with MetricsUtils.span("hydrate"):
+            print("\n=================================================================")
+            print(f"Hydrating input data model from config file parameters")
+            print("=================================================================")
+            # Data model
+            data_model_dict = {}
+            print(f"There are {len(input_items)} items")
+            for input_item in input_items:
+                print(f"{input_item.id}")
+                # the parsed config of the item is kept as one object rather than copying every option into the model
+                data_model_dict[input_item.id] = DataModel.ItemRecord(item_id=input_item.id,
+                                                                      config=input_item,
+                                                                      token=self.portals[input_item.profile].token)
+
+        with MetricsUtils.span("alfp"):
+            # retrieve the alf statuses
+            print("\n=================================================================")
+            print("Retrieving and Processing Active Live Feed Processed files")
+            print("=================================================================")
+            alf_processor_queries = list(map(QueryEngine.prepare_alfp_query_params, data_model_dict.items()))
+            alf_processor_response = QueryEngine.get_alfp_content(alf_processor_queries)
+            alfp_content = list(map(QueryEngine.process_alfp_response, alf_processor_response))
+            alfp_dict = {}
+            for content in alfp_content:
+                # check if there is alfp content was successfully retrieved
+                if content["success"]:
+                    unique_item_key = content["id"]
+                    alfp_dict.update({
+                        unique_item_key: content["content"]
+                    })
+                else:
+                    print(f"ERROR: No ALFP data on record for {content['id']}")
 
-    # Read in the previous status output file
-    print("\n=================================================================")
-    print("Loading status output from previous run")
-    print("=================================================================")
-    # TODO Move folder name to config
-    # Directory where the output files are stored
-    output_status_dir_path = os.path.realpath(root_dir + r"\output")
-    # Create a new directory if it does not exists
-    FileManager.create_new_folder(output_status_dir_path)
-    # TODO Move filename to config
-    # Build the path to status file.
-    status_file = os.path.realpath(output_status_dir_path + r"\status.json")
-    # Check file existence
-    file_exist = FileManager.check_file_exist_by_pathlib(path=status_file)
-    if file_exist:
-        # The status' of all the items in the previous run
-        previous_status_output = FileManager.open_file(path=status_file)["items"]
-        # iterate through the items in the config file
-        for key, value in data_model_dict.items():
-            print(f"{key}")
-            # iterate through the item output in the status file
-            for ele in previous_status_output:
-                # item ID
-                status_file_key = ele["id"]
+        with MetricsUtils.span("previous_status"):
+            # Read in the previous status output file
+            print("\n=================================================================")
+            print("Loading status output from previous run")
+            print("=================================================================")
+            # Check file existence
+            file_exist = FileManager.check_file_exist_by_pathlib(path=self.status_file)
+            if self.previous_status_output is None:
+                # The status' of all the items in the previous run, indexed by item ID (empty if there was no
+                # previous run)
+                self.previous_status_output = StatusManager.PreviousStatusIndex.from_file(
+                    path=self.previous_status_file)
+            previous_status_output = self.previous_status_output
+            print(f"Items in previous run: {len(previous_status_output)}")
+            # iterate through the items in the config file
+            for key, value in data_model_dict.items():
+                previous_status = previous_status_output.get(key)
                 # if the item in the config file is also in the previous run,
                 # merge the output from the previous run to the data model
-                if key == status_file_key:
-                    merged_dict = {**ele, **value}
-                    data_model_dict.update({
-                        key: merged_dict
-                    })
-    else:
-        # TODO What if the file does not exist?
-        print(f"")
+                if previous_status is not None:
+                    print(f"{key}")
+                    value.merge_previous(previous_status)
+
+        print("\n=================================================================")
+        print(f"Current data and time")
+        print("=================================================================")
+        time_utils_response = TimeUtils.get_current_time_and_date()
+        timestamp = time_utils_response["timestamp"]
+        print(f"{time_utils_response['datetimeObj']}")
+
+        with MetricsUtils.span("checks"):
+            # the portals whose sign-in failed are signed in again
+            self.sign_in_portals()
+            if self.job_queue is None:
+                not_checked = check_portal_items(portals=self.portals, data_model_dict=data_model_dict)
+            else:
+                # the checks run on the workers
+                not_checked = self.dispatch_checks(data_model_dict=data_model_dict)
+            if not_checked:
+                # the items keep the status of their last check, like the items not due for a check
+                print(f"Items not checked, their previous status is kept: {len(not_checked)}")
+                for item_id in not_checked:
+                    del data_model_dict[item_id]
+
+        with MetricsUtils.span("analysis"):
+            print("\n=================================================================")
+            print(f"Analyze and process data")
+            print("=================================================================")
+            # IDs of the items whose event history and RSS file need an update
+            updated_item_ids = []
+            # Facts about each item the status rules are evaluated against, in the order of the data model
+            rule_rows = []
+            for key, value in data_model_dict.items():
+                item_id = key
+                agol_is_valid = True
+                item_is_valid = value.item_is_valid
+                service_response = value.service_response
+                service_is_valid = service_response["success"]
+                layers_are_valid = value.all_layers_are_valid
+
+                print(f"{item_id}\t{value.title}")
+                print(f"ArcGIS Online accessible: {agol_is_valid}")
+                print(f"Item valid: {item_is_valid}")
+                print(f"Service valid: {service_is_valid}")
+                print(f"All layers valid: {layers_are_valid}\n")
+
+                print("-------- RETRY COUNT ---------")
+                # Process Retry Count
+                service_retry_count = service_response["retryCount"]
+                print(f"Service Retry Count: {service_retry_count}")
+                print("------------------------------\n")
+
+                print("-------- ELAPSED TIME --------")
+                # Retrieve the elapsed time of the query to the service (not the layers)
+                service_elapsed_time = service_response["elapsedSeconds"]
+                print(f"Service Elapsed Time: {service_elapsed_time}")
+                # Retrieve the average elapsed time of layers for the current service (layers only)
+                print(f"Layers Elapsed times (individual)")
+                layers_elapsed_time = QueryEngine.get_layers_average_elapsed_time(
+                    layers_elapsed_times=value.layers_elapsed_times)
+                print(f"Layers Elapsed Time (average): {layers_elapsed_time}")
+                # Sum up the elapsed time for the service and the layers divided by 2
+                # We want the total elapsed time of the layers and the FS
+                total_elapsed_time = (service_elapsed_time + layers_elapsed_time)/2
+                print(f"Total Elapsed Time average: {total_elapsed_time}")
+                print("------------------------------\n\n")
+
+                # Obtain the total elapsed time and counts
+                # path to output file
+                # This file contains the:
+                #   item id
+                #   elapsed time
+                #   elapsed sums
+                response_time_data_file_path = os.path.join(self.response_time_data_dir, item_id + "." + "json")
+                # Check file existence.
+                response_time_data_file_path_exist = FileManager.check_file_exist_by_pathlib(path=response_time_data_file_path)
+
+                exclude_save = value.config.exclusion_calendar.is_excluded(timestamp)
+                print(f"Exclude response time data from save: {exclude_save}")
+
+                # Does the file exist
+                if not response_time_data_file_path_exist:
+                    # If file does not exist then create it.
+                    FileManager.create_new_file(response_time_data_file_path)
+                    FileManager.set_file_permission(response_time_data_file_path)
+                    if not exclude_save:
+                        FileManager.save(data={
+                            "id": item_id,
+                            "elapsed_sums": total_elapsed_time,
+                            "elapsed_count": 1
+                        }, path=response_time_data_file_path)
+                    # since it's our first entry, the average is the current elapsed time
+                    elapsed_times_average = total_elapsed_time
+                else:
+                    # Retrieve the elapsed time DIVIDE by count
+                    print(f"Retrieving response time data from existing json file: {item_id}.json")
+                    response_time_data = FileManager.get_response_time_data(response_time_data_file_path)
+                    # total counts
+                    elapsed_times_count = response_time_data["elapsed_count"]
+                    print(f"Elapsed count (on file before update): {elapsed_times_count}")
+                    # sum of all times
+                    elapsed_times_sum = response_time_data["elapsed_sums"]
+                    print(f"Elapsed sums (on file before update): {elapsed_times_sum}")
+                    # calculated average
+                    elapsed_times_average = elapsed_times_sum / elapsed_times_count
+                    if not exclude_save:
+                        # update the response time data file
+                        FileManager.update_response_time_data(path=response_time_data_file_path, input_data={
+                            "id": item_id,
+                            "elapsed_count": elapsed_times_count + 1,
+                            "elapsed_sums": elapsed_times_sum + total_elapsed_time
+                        })
+                print(f"Elapsed average: {elapsed_times_average}")
+
+                # retrieve alfp details
+                alfp_data = alfp_dict.get(item_id)
+
+                if alfp_data is not None:
+                    # 10 digit Timestamp 'seconds since epoch' containing time of last
+                    # Successful Run (and Service update) when data was changed
+                    value.last_update_timestamp = alfp_data.get("lastUpdateTimestamp", 0)
+                    # 10 digit Timestamp 'seconds since epoch' containing time of last
+                    # Failed run (or Service update failure)
+                    # feed_last_failure_timestamp = item["lastFailureTimestamp"]
+                    # 10 digit Timestamp 'seconds since epoch' containing time of last
+                    # run (having a Success, a Failure, or a No Action flag ('No Data
+                    # Updates')
+                    value.last_run_timestamp = alfp_data.get("lastRunTimestamp", 0)
+                    # Average number of minutes between each successful run (or Service
+                    # update)
+                    value.avg_update_interval_mins = alfp_data.get("avgUpdateIntervalMins", 0)
+                    # Average number of minutes between each run
+                    value.avg_feed_interval_mins = alfp_data.get("avgFeedIntervalMins", 0)
+                    #
+                    value.consecutive_failures = alfp_data.get("consecutiveFailures", 0)
+                    #
+                    value.alfp_last_status = alfp_data["lastStatus"]["code"]
+                else:
+                    value.last_update_timestamp = 0
+                    value.last_run_timestamp = 0
+                    value.avg_update_interval_mins = 0
+                    value.avg_feed_interval_mins = 0
+                    value.consecutive_failures = 0
+                    value.alfp_last_status = 0
+
+                # Facts and parameters the status rules are evaluated against
+                rule_rows.append({
+                    **StatusManager.build_rule_facts(item=value,
+                                                     timestamp=timestamp,
+                                                     service_retry_count=service_retry_count,
+                                                     total_elapsed_time=total_elapsed_time),
+                    **{name: getattr(value.config, name) for name in self.rule_engine.params}
+                })
 
-    # Historical "elapsed times" file directory
-    # response time directory
+        with MetricsUtils.span("rules"):
+            print("\n=================================================================")
+            print(f"Evaluating status rules")
+            print("=================================================================")
+            # The rules are evaluated over all the items at once
+            status_code_keys = self.rule_engine.evaluate_batch(rows=rule_rows)
+            rule_stats = self.rule_engine.get_stats()
+            for rule_hit in rule_stats["ruleHits"]:
+                print(f"{rule_hit['code']}\t{rule_hit['hits']}")
+            print(f"Evaluation time: {rule_stats['evaluationSeconds']} seconds")
+
+        with MetricsUtils.span("status"):
+            for (item_id, value), status_code_key in zip(data_model_dict.items(), status_code_keys):
+                status_code = StatusManager.get_status_code(status_code_key, self.status_codes_data_model)
+                LoggingUtils.log_status_code_details(item_id, status_code)
+
+                # update/add status code in the data model
+                # Add the Admin comments (if any)
+                # Add the last build time
+                # Add the status code
+                # Add the current run time of the script
+                value.comments = self.admin_comments_data_model.get(item_id, [])
+                value.last_build_time = time_utils_response["datetimeObj"].strftime("%a, %d %b %Y %H:%M:%S +0000")
+                value.status = status_code
+                value.timestamp = timestamp
+
+                if self.planner is not None:
+                    # Next check of the item, degraded items and fast feeds are checked sooner
+                    next_check = self.planner.reschedule(item_id=item_id,
+                                                         now=time.time(),
+                                                         update_interval_mins=value.avg_update_interval_mins,
+                                                         # 0xx status codes are Normal (or Under Maintenance)
+                                                         healthy=status_code_key.startswith("0"),
+                                                         # service, usage, ALFP and one request per layer
+                                                         requests=3 + value.layer_count)
+                    print(f"Next check in {round(next_check / 60, 1)} minutes")
+
+                # Items whose status record is identical to the previous run's have nothing new for the events or RSS
+                status_record = value.to_status_record()
+                if StatusManager.hash_status_record(status_record) == previous_status_output.content_hash(item_id):
+                    print(f"\nNo change since the previous run")
+                    continue
+
+                # If the file exist, check the status/comments between the item's previous status/code comment, and the
+                # current status/code comment to determine if the existing RSS file should be updated.
+                update_current_feed = StatusManager.update_rss_feed(
+                    previous_status_output=previous_status_output,
+                    item=value,
+                    status_codes_data_model=self.status_codes_data_model)
+                # Check if we need to apply an update
+                if update_current_feed:
+                    print(f"\nUpdate Required")
+                    updated_item_ids.append(item_id)
+
+        with MetricsUtils.span("events"):
+            print("\n=================================================================")
+            print(f"Updating event history")
+            print("=================================================================")
+            # RSS files to update, (data model, RSS file path, event history)
+            rss_feeds = []
+            for item_id in updated_item_ids:
+                value = data_model_dict[item_id]
+                print(f"\n{item_id}")
+                # Per-item events file written by earlier versions, imported into the event log the first time
+                legacy_events_file = os.path.realpath(self.event_history_dir_path + r"\status_history"
+                                                      + f"_{item_id}.json")
+                event_history = EventsManager.record_event(input_data=value,
+                                                           event_log=self.event_log,
+                                                           legacy_events_file=legacy_events_file)
+                # Build the path to RSS output file for the current item.  This file is what the RSS reader reads.
+                # There should be one output file for each service/item being monitored.
+                rss_file_path = os.path.join(self.rss_dir_path, item_id + "." + value.config.rss_file_extension)
+                # Check if the output file already exist
+                if FileManager.check_file_exist_by_pathlib(path=rss_file_path):
+                    # the RSS templates are filled from a dictionary of the data model
+                    rss_feeds.append((value.to_dict(), rss_file_path, event_history))
+
+        with MetricsUtils.span("rss"):
+            print("\n=================================================================")
+            print(f"Updating RSS files")
+            print("=================================================================")
+            self.rss_manager.update_rss_feeds(
+                feeds=rss_feeds,
+                max_workers=int(self.config_ini_manager.get_default_value("rss_render_processes", 1)),
+                min_batch=int(self.config_ini_manager.get_default_value("rss_render_min_batch",
+                                                                        RSSManager.DEFAULT_MIN_PARALLEL_BATCH)))
+            print(f"RSS files updated: {len(rss_feeds)} "
+                  f"({self.rss_manager.incremental_updates} incremental, {self.rss_manager.full_updates} full)")
+
+        with MetricsUtils.span("save"):
+            print("\n=================================================================")
+            print("Saving results")
+            print(f"Output file path: {self.status_file}")
+            print("=================================================================")
+            # output file
+            output_file = {
+                "statusPreparedOn": timestamp,
+                "items": []
+            }
+            # the items not checked in this run keep the status of their last check, read back from the status file
+            carried_over = previous_status_output.full_records(
+                [input_item.id for input_item in self.input_items if input_item.id not in data_model_dict])
+            # hydrate output file
+            for input_item in self.input_items:
+                if input_item.id in data_model_dict:
+                    output_file["items"].append(data_model_dict[input_item.id].to_status_record())
+                elif input_item.id in carried_over:
+                    output_file["items"].append(carried_over[input_item.id])
+            if self.shard_index is None:
+                if self.status_deltas is None:
+                    self.status_deltas = StatusManager.StatusDeltaFeed.from_file(
+                        path=self.status_deltas_file,
+                        sequence=previous_status_output.sequence)
+                self.status_deltas.window = int(self.config_ini_manager.get_default_value(
+                    "status_delta_window", StatusManager.DEFAULT_DELTA_WINDOW))
+                # Sets the run's sequence number in the output file
+                delta = self.status_deltas.record(status_output=output_file,
+                                                  previous_status_output=previous_status_output)
+                print(f"Sequence: {delta['sequence']}\tItems changed: {len(delta['changed'])}\t"
+                      f"Items removed: {len(delta['removed'])}")
+            # Pretty print dictionary
+
+            # If file do not exist then create it.
+            # TODO Not correct
+            if not file_exist:
+                FileManager.create_new_file(self.status_file)
+                FileManager.set_file_permission(self.status_file)
+            else:
+                # open file
+                print()
+            # streamed to the file one item at a time
+            FileManager.save_streaming(data=output_file, path=self.status_file, precompress=self.precompress_outputs)
+            if self.status_deltas is not None:
+                self.status_deltas.save(path=self.status_deltas_file,
+                                        delta_path=self.status_delta_file,
+                                        precompress=self.precompress_outputs)
+
+        # In sharded runs the coordinator writes the aggregate feed from the event logs of all the shards
+        if self.shard_index is None and self.config_ini_manager.get_default_boolean("aggregate_feed_enabled"):
+            update_aggregate_feed(config_ini_manager=self.config_ini_manager,
+                                  output_dir=self.rss_dir_path,
+                                  precompress=self.precompress_outputs,
+                                  event_logs=[self.event_log],
+                                  timestamp=timestamp)
+
+        if self.status_server is not None:
+            with MetricsUtils.span("status_api"):
+                self.publish_status_snapshot(output_file=output_file,
+                                             updated_item_ids=updated_item_ids,
+                                             timestamp=timestamp)
+
+        with MetricsUtils.span("compaction"):
+            # Remove expired events from the event log
+            self.event_log.compact_if_due(
+                interval=int(self.config_ini_manager.get_default_value("event_log_compaction_hours", 24)) * 3600,
+                retention={
+                    input_item.id: (input_item.number_of_events_max, input_item.rss_time_range)
+                    for input_item in self.input_items
+                },
+                default_retention=(self.config_ini_manager.get_default_value("number_of_events_max", 0),
+                                   self.config_ini_manager.get_default_value("rss_time_range", 0)),
+                now=timestamp)
+            self.event_log.close()
+
+        # Status rule hit counts and evaluation time
+        FileManager.save(data=self.rule_engine.get_stats(), path=self.rule_stats_file)
+
+        # The next run compares against this run's status without reading it back from disk
+        self.previous_status_output = StatusManager.PreviousStatusIndex(output_file, path=self.status_file)
+
+        with MetricsUtils.span("flush"):
+            # Flush barrier, wait for every queued write to reach the disk
+            print("\n=================================================================")
+            print("Flushing queued writes")
+            print("=================================================================")
+            write_stats = FileManager.flush_write_behind()
+            self.print_write_stats(write_stats)
+
+        if self.precompress_outputs:
+            print("\n=================================================================")
+            print("Pre-compressed outputs")
+            print("=================================================================")
+            for path, stats in FileManager.get_compression_stats().items():
+                print(f"{os.path.basename(path)}\t{'updated' if stats['updated'] else 'unchanged'}\t"
+                      f"{stats['bytes']} bytes\tgzip {stats['gzipBytes']} ({stats['gzipRatio']})"
+                      + (f"\tbrotli {stats['brotliBytes']} ({stats['brotliRatio']})" if "brotliBytes" in stats else ""))
+
+        run_summary = {
+            "items": len(input_items),
+            "itemsUpdated": len(updated_item_ids),
+            "rssFilesUpdated": len(rss_feeds),
+            "eventsOnRecord": len(self.event_log),
+            "ruleHits": {rule_hit["code"]: rule_hit["hits"] for rule_hit in rule_stats["ruleHits"]},
+            "writes": write_stats,
+            "runSeconds": round(time.monotonic() - run_started, 3)
+        }
+
+        # Stage durations, requests, counts and errors, anything recorded from now on belongs to the next run
+        print("\n=================================================================")
+        print("Run metrics")
+        print(f"Output file path: {self.run_metrics_file}")
+        print("=================================================================")
+        run_metrics = MetricsUtils.finish_run()
+        for name in ("items", "itemsUpdated", "rssFilesUpdated", "eventsOnRecord"):
+            run_metrics.count(name=name, value=run_summary[name])
+        run_report = run_metrics.report(run_seconds=run_summary["runSeconds"])
+        FileManager.save(data={**run_report, **{"writes": write_stats}}, path=self.run_metrics_file)
+        print(run_metrics.summary(run_seconds=run_summary["runSeconds"]))
+
+        self.export_metrics(items=data_model_dict.values(), run_report=run_report, write_stats=write_stats)
+        return run_summary
+
+    def publish_status_snapshot(self, output_file=None, updated_item_ids=None, timestamp: int = 0):
+        """
+        Build the status API resources of the run and publish them to the status server.  The event histories and RSS
+        feeds of all the items are built by the first run, after that only those of the updated items.
+        :param output_file: The status output of the run
+        :param updated_item_ids: IDs of the items whose event history and RSS file were updated by the run
+        :param timestamp: Timestamp of the run
+        :return: None
+        """
+        item_ids = {input_item.id for input_item in self.input_items}
+        bodies = {"/status": (JsonUtils.dumps(output_file).encode("utf-8"), StatusAPI.JSON_CONTENT_TYPE)}
+        for status_record in output_file["items"]:
+            bodies[f"/status/{status_record['id']}"] = (JsonUtils.dumps(status_record).encode("utf-8"),
+                                                        StatusAPI.JSON_CONTENT_TYPE)
+        if self.status_deltas is not None:
+            # the changes since each sequence number of the window
+            for sequence in range(self.status_deltas.oldest_sequence, self.status_deltas.sequence + 1):
+                bodies[f"/changes/{sequence}"] = (
+                    JsonUtils.dumps(self.status_deltas.changes_since(sequence)).encode("utf-8"),
+                    StatusAPI.JSON_CONTENT_TYPE)
+        if self.status_snapshot is None:
+            self.status_snapshot = StatusAPI.StatusSnapshot()
+            history_item_ids = item_ids
+        else:
+            history_item_ids = set(updated_item_ids)
+        for input_item in self.input_items:
+            if input_item.id not in history_item_ids:
+                continue
+            record = DataModel.ItemRecord(item_id=input_item.id, config=input_item)
+            record.timestamp = timestamp
+            event_history = EventsManager.load_history(input_data=record, event_log=self.event_log)
+            bodies[f"/events/{input_item.id}"] = (
+                JsonUtils.dumps({"id": input_item.id, "events": list(event_history)}).encode("utf-8"),
+                StatusAPI.JSON_CONTENT_TYPE)
+            rss_file_path = os.path.join(self.rss_dir_path, input_item.id + "." + input_item.rss_file_extension)
+            if FileManager.check_file_exist_by_pathlib(path=rss_file_path):
+                bodies[f"/rss/{input_item.id}"] = (FileManager.read_text(rss_file_path).encode("utf-8"),
+                                                   StatusAPI.RSS_CONTENT_TYPE)
+        # Keep the event histories and RSS feeds of the items that are still configured
+        self.status_snapshot = self.status_snapshot.update(bodies=bodies,
+                                                           keep=lambda path: path.rsplit("/", 1)[-1] in item_ids,
+                                                           status_prepared_on=timestamp)
+        self.status_server.publish(self.status_snapshot)
+        print(f"Status API resources published: {len(self.status_snapshot.resources)}")
+
+    def export_metrics(self, items=None, run_report=None, write_stats=None):
+        """
+        Update and publish the Prometheus metrics, and write the textfile collector file (metrics_textfile)
+        :param items: The data models of the items checked in the run
+        :param run_report: The run's MetricsUtils report
+        :param write_stats: The write-behind writer statistics
+        :return: None
+        """
+        queues = {}
+        if write_stats:
+            queues["write_behind"] = {"size": write_stats["queueSize"],
+                                      "highWaterMark": write_stats["queueHighWaterMark"]}
+        if self.job_queue_stats is not None:
+            queues["jobs"] = self.job_queue_stats
+        PrometheusExporter.record_items(registry=self.metrics_registry,
+                                        items=items,
+                                        item_ids=[input_item.id for input_item in self.input_items])
+        PrometheusExporter.record_run(registry=self.metrics_registry, run_report=run_report, queues=queues)
+        self.metrics_registry.publish()
+        metrics_textfile = self.config_ini_manager.get_default_value("metrics_textfile", "")
+        # the shards would overwrite each other's run metrics
+        if metrics_textfile and self.shard_index is None:
+            PrometheusExporter.write_textfile(registry=self.metrics_registry,
+                                              path=os.path.realpath(os.path.join(self.root_dir, metrics_textfile)))
+
+    def dispatch_checks(self, data_model_dict=None) -> list:
+        """
+        Queue a check job per item for the workers and set the results on the items.  Items not checked by a worker
+        within job_dispatch_timeout_minutes (or whose job was given up on after job_max_attempts leases) are checked
+        here.
+        :param data_model_dict: The data model of the items to check (item ID -> DataModel.ItemRecord)
+        :return: IDs of the items not checked (see PortalManager.check_portals)
+        """
+        print("\n=================================================================")
+        print(f"Dispatching checks to the workers")
+        print("=================================================================")
+        with MetricsUtils.span("dispatch"):
+            run_id = JobQueue.new_run_id()
+            self.job_queue.enqueue(run_id=run_id, jobs=[(key, value.check_payload())
+                                                        for key, value in data_model_dict.items()])
+            print(f"Run: {run_id}\tJobs queued: {len(data_model_dict)}")
+            deadline = time.monotonic() + float(self.config_ini_manager.get_default_value(
+                "job_dispatch_timeout_minutes", 30)) * 60
+            poll_seconds = float(self.config_ini_manager.get_default_value("job_poll_seconds", 2))
+            counts = self.job_queue.counts(run_id=run_id)
+            while counts[JobQueue.QUEUED] + counts[JobQueue.LEASED] > 0 and time.monotonic() < deadline:
+                time.sleep(poll_seconds)
+                # the jobs of a worker that died go back to the queue once their lease expires
+                requeued = self.job_queue.requeue_expired()
+                if requeued:
+                    print(f"Expired leases: {requeued}")
+                counts = self.job_queue.counts(run_id=run_id)
+            self.job_queue_stats = {"size": counts[JobQueue.QUEUED] + counts[JobQueue.LEASED],
+                                    "highWaterMark": len(data_model_dict)}
+            print(f"Jobs done: {counts[JobQueue.DONE]}\tfailed: {counts[JobQueue.FAILED]}\t"
+                  f"not completed: {counts[JobQueue.QUEUED] + counts[JobQueue.LEASED]}")
+            check_results = self.job_queue.results(run_id=run_id)
+            self.job_queue.purge(run_id=run_id)
+            for key, check_result in check_results.items():
+                if key in data_model_dict:
+                    data_model_dict[key].apply_check_result(check_result)
+
+            unchecked_items = {key: value for key, value in data_model_dict.items() if key not in check_results}
+            if unchecked_items:
+                print(f"Checking {len(unchecked_items)} items not checked by a worker")
+                return check_portal_items(portals=self.portals, data_model_dict=unchecked_items)
+            return []
+
+    def close(self):
+        """
+        Flush and close the event log, the job queue, the RSS render processes, the write-behind writer and the HTTP
+        sessions
+        :return: None
+        """
+        if self.event_log is not None:
+            self.event_log.close()
+        if self.job_queue is not None:
+            self.job_queue.close()
+        if self.rss_manager is not None:
+            self.rss_manager.close()
+        print("\n=================================================================")
+        print("Stopping the write-behind writer")
+        print("=================================================================")
+        self.print_write_stats(FileManager.stop_write_behind())
+        RequestUtils.close_sessions()
+
+    @staticmethod
+    def print_write_stats(write_stats=None):
+        """
+        Print the write-behind writer statistics
+        :param write_stats: The writer statistics
+        :return: None
+        """
+        if not write_stats:
+            return
+        print(f"Writes submitted: {write_stats['submitted']}")
+        print(f"Writes coalesced: {write_stats['coalesced']}")
+        print(f"Files written: {write_stats['written']}")
+        print(f"Write errors: {write_stats['errors']}")
+        print(f"Queue high-water mark: {write_stats['queueHighWaterMark']} of {write_stats['maxQueueSize']}")
+
+
+def check_portal_items(portals=None, data_model_dict=None) -> list:
+    """
+    Check the items of every portal in parallel, each with its portal's GIS (see PortalManager.check_portals)
+    :param portals: Dictionary of profile -> PortalManager.Portal
+    :param data_model_dict: The data model of the items to check (item ID -> DataModel.ItemRecord)
+    :return: IDs of the items not checked, because their portal is not signed in or their checks failed
+    """
     print("\n=================================================================")
-    print(f"Checking/Creating response time data folder")
+    print(f"Checking the items by portal")
     print("=================================================================")
-    # TODO Move folder name to config
-    response_time_data_dir = os.path.realpath(root_dir + r"\ResponseTimeData")
-    # Create a new directory if it does not exists
-    FileManager.create_new_folder(file_path=response_time_data_dir)
+    for profile, input_items in PortalManager.group_items(value.config for value in data_model_dict.values()).items():
+        print(f"{profile}\titems: {len(input_items)}\tconcurrency: {portals[profile].max_concurrency}")
+    # the checks of the batches run in parallel are timed as a whole, spans are not opened from their threads
+    return PortalManager.check_portals(
+        portals=portals, data_model_dict=data_model_dict,
+        check=lambda portal, batch: check_items(gis=portal.gis, data_model_dict=batch),
+        parallel_check=lambda portal, batch: check_items(gis=portal.gis, data_model_dict=batch, timed=False))
 
-    # Create a new directory to hold the rss feeds (if it does not exist)
-    print("\n=================================================================")
-    print(f"Checking/Creating RSS output folder and loading RSS template files")
-    print("=================================================================")
-    # TODO Move folder name to config
-    rss_dir_path = os.path.realpath(root_dir + r"\rss")
-    FileManager.create_new_folder(file_path=rss_dir_path)
 
-    # Load RSS template
-    # TODO Move filename to config
-    rss_manager = RSSManager.RSS(root_dir + r"\rss_template.xml", root_dir + r"\rss_item_template.xml")
+def check_items(gis=None, data_model_dict=None, timed: bool = True) -> dict:
+    """
+    Validate the items, their services and layers and retrieve their usage statistics and feature counts.  The
+    results are set on the items' records, which only keep the results once the checks are done (see
+    DataModel.ItemRecord.compact).
+    :param gis: The GIS object
+    :param data_model_dict: The data model of the items to check (item ID -> DataModel.ItemRecord)
+    :param timed: Time each check as a stage (MetricsUtils.span), False when called from a thread of a thread pool
+    :return: The data model
+    """
+    span = MetricsUtils.span if timed else (lambda name: contextlib.nullcontext())
+    with span("validate_items"):
+        print("\n=================================================================")
+        print(f"Validating item's unique key and meta-data")
+        print("=================================================================")
+        data_model_dict = ServiceValidator.validate_items(gis=gis, data_model=data_model_dict)
+
+    with span("validate_services"):
+        print("\n=================================================================")
+        print(f"Validating services")
+        print("=================================================================")
+        data_model_dict = ServiceValidator.validate_services(data_model=data_model_dict)
+
+    with span("validate_layers"):
+        print("\n=================================================================")
+        print(f"Validating layers")
+        print("=================================================================")
+        data_model_dict = ServiceValidator.validate_layers(data_model=data_model_dict)
+
+    with span("usage"):
+        print("\n=================================================================")
+        print(f"Retrieve usage statistics")
+        print("=================================================================")
+        data_model_dict = QueryEngine.get_usage_details(data_model=data_model_dict)
+
+    with span("feature_counts"):
+        print("\n=================================================================")
+        print(f"Retrieve feature counts")
+        print("=================================================================")
+        data_model_dict = QueryEngine.get_feature_counts(data_model=data_model_dict)
+
+    for value in data_model_dict.values():
+        # the item and response objects are not needed after the checks
+        value.compact(retry_count=QueryEngine.get_retry_count(value.service_response["retryCount"]),
+                      elapsed_seconds=QueryEngine.get_service_elapsed_time(value.service_response["success"],
+                                                                           value.service_response["response"]))
+    return data_model_dict
+
+
+def open_job_queue(config_ini_manager=None, output_dir: str = ""):
+    """
+    Open the job queue of the config file (job_queue_url, by default a SQLite queue in the output folder)
+    :param config_ini_manager: The config file
+    :param output_dir: The output folder
+    :return: JobQueue.SQLiteJobQueue or JobQueue.RedisJobQueue
+    """
+    queue_url = config_ini_manager.get_default_value("job_queue_url", "") or \
+        "sqlite:///" + os.path.realpath(output_dir + r"\jobs.db")
+    return JobQueue.open_queue(url=queue_url,
+                               lease_seconds=float(config_ini_manager.get_default_value(
+                                   "job_lease_seconds", JobQueue.DEFAULT_LEASE_SECONDS)),
+                               max_attempts=int(config_ini_manager.get_default_value(
+                                   "job_max_attempts", JobQueue.DEFAULT_MAX_ATTEMPTS)))
 
-    # Event history
-    print("\n=================================================================")
-    print(f"Checking/Creating status event history folder")
-    print("=================================================================")
-    event_history_dir_path = os.path.realpath(root_dir + r"\event_history")
-    FileManager.create_new_folder(file_path=event_history_dir_path)
 
+def run_worker(root_dir: str = "", worker_id: str = None):
+    """
+    Check the items of the jobs in the job queue and push the results back, until stopped (SIGINT/SIGTERM).  The
+    config file is reloaded when it changes.
+    :param root_dir: The root directory of the script
+    :param worker_id: The worker ID, unique across the hosts
+    :return: None
+    """
+    worker_id = worker_id or JobQueue.new_worker_id()
+    # only used for its paths and to authenticate, nothing else is loaded
+    health_check = HealthCheck(root_dir=root_dir)
+    FileManager.create_new_folder(health_check.output_status_dir_path)
+    config_ini_manager = ConfigManager(root=root_dir, file_name="config.ini")
+    job_queue = open_job_queue(config_ini_manager=config_ini_manager,
+                               output_dir=health_check.output_status_dir_path)
+    stop_event = threading.Event()
+    Scheduler.install_stop_handlers(lambda *args: stop_event.set())
     print("\n=================================================================")
-    print(f"Current data and time")
+    print(f"Worker {worker_id} waiting for jobs")
     print("=================================================================")
-    time_utils_response = TimeUtils.get_current_time_and_date()
-    timestamp = time_utils_response["timestamp"]
-    print(f"{time_utils_response['datetimeObj']}")
+    input_items = {}
+    config_mtime = None
+    jobs_done = 0
+    try:
+        while not stop_event.is_set():
+            if os.stat(health_check.config_file).st_mtime_ns != config_mtime:
+                config_mtime = os.stat(health_check.config_file).st_mtime_ns
+                config_ini_manager = ConfigManager(root=root_dir, file_name="config.ini")
+                input_items = {input_item.id: input_item
+                               for input_item in config_ini_manager.get_config_data(config_type="items")}
+                health_check.update_portals(input_items=input_items.values(), config_ini_manager=config_ini_manager)
+
+            jobs = job_queue.lease(worker=worker_id,
+                                   count=int(config_ini_manager.get_default_value("job_batch_size", 5)))
+            if not jobs:
+                stop_event.wait(float(config_ini_manager.get_default_value("job_poll_seconds", 2)))
+                continue
+
+            # Retry counts are reported per batch
+            RetryUtils.clear_retry_output()
+            data_model_dict = {}
+            for job in jobs:
+                if job.item_id not in input_items:
+                    # not (yet) in this host's config file, leave it to another worker
+                    print(f"ERROR: {job.item_id} is not in the config file")
+                    job_queue.release(job=job, worker=worker_id)
+                    continue
+                portal = health_check.portals[input_items[job.item_id].profile]
+                data_model_dict[job.item_id] = DataModel.ItemRecord(item_id=job.item_id,
+                                                                    config=input_items[job.item_id],
+                                                                    token=portal.token)
+                data_model_dict[job.item_id].merge_previous(job.payload)
+            if not data_model_dict:
+                continue
+            # the portals whose sign-in failed are signed in again
+            health_check.sign_in_portals()
+            not_checked = set(check_portal_items(portals=health_check.portals, data_model_dict=data_model_dict))
+            for job in jobs:
+                if job.item_id in not_checked:
+                    # leave it to another worker
+                    job_queue.release(job=job, worker=worker_id)
+                elif job.item_id in data_model_dict:
+                    check_result = data_model_dict[job.item_id].check_result()
+                    if job_queue.complete(job=job, worker=worker_id, result=check_result):
+                        jobs_done += 1
+                    else:
+                        print(f"ERROR: Lease on {job.item_id} expired, result discarded")
+            print(f"Jobs done: {jobs_done}")
+    finally:
+        job_queue.close()
+        RequestUtils.close_sessions()
 
-    print("\n=================================================================")
-    print(f"Validating item's unique key and meta-data")
-    print("=================================================================")
-    data_model_dict = ServiceValidator.validate_items(gis=gis, data_model=data_model_dict)
 
+def update_aggregate_feed(config_ini_manager=None, output_dir: str = "", precompress: bool = False, event_logs=None,
+                          timestamp: int = 0):
+    """
+    Write the aggregate feed of all the items
+    :param config_ini_manager: The config file
+    :param output_dir: The RSS folder
+    :param precompress: Write .gz/.br copies
+    :param event_logs: The event logs (one per shard in sharded runs)
+    :param timestamp: The run timestamp
+    :return: None
+    """
     print("\n=================================================================")
-    print(f"Validating services")
-    print("=================================================================")
-    data_model_dict = ServiceValidator.validate_services(data_model=data_model_dict)
-
+    with MetricsUtils.span("aggregate_feed"):
+        print("Updating aggregate feed")
+        print("=================================================================")
+        # One pass over the recent events of all the items in the event logs
+        run_settings = config_ini_manager.get_defaults()
+        aggregate_feed = RSSManager.AggregateFeed(settings=run_settings,
+                                                  output_dir=output_dir,
+                                                  precompress=precompress)
+        start = timestamp - int(run_settings.get("rss_time_range") or 0) * 86400
+        aggregate_feed_events = ShardManager.merge_event_streams([event_log.iter_events_in_window(start=start)
+                                                                  for event_log in event_logs])
+        for path, updated in aggregate_feed.write(events=aggregate_feed_events).items():
+            print(f"{os.path.basename(path)}\t{'updated' if updated else 'unchanged'}")
+
+
+def run_shard(root_dir: str = "", profile_dir: str = None, profile_stages=None, shard_index: int = 0,
+              shard_count: int = 1) -> dict:
+    """
+    Run the health check of the items of one shard (in a worker process, see ShardManager.run_shards)
+    :param root_dir: The root directory of the script
+    :param profile_dir: Profile the shard and write its reports to a subfolder of this folder, None to not profile
+    :param profile_stages: Only profile these stages (MetricsUtils span names)
+    :param shard_index: The shard
+    :param shard_count: Number of shards
+    :return: Summary of the run
+    """
+    if profile_dir is not None:
+        MetricsUtils.start_profiling(output_dir=os.path.join(profile_dir, f"shard_{shard_index}_of_{shard_count}"),
+                                     stages=profile_stages)
+    FileManager.start_write_behind()
+    health_check = HealthCheck(root_dir=root_dir, shard_index=shard_index, shard_count=shard_count)
+    try:
+        health_check.load()
+        return health_check.run()
+    finally:
+        health_check.close()
+        if profile_dir is not None:
+            for path in MetricsUtils.stop_profiling():
+                print(f"Shard {shard_index} profile report: {path}")
+
+
+def run_sharded(root_dir: str = "", shard_count: int = 1, profile_dir: str = None, profile_stages=None):
+    """
+    Partition the items across worker processes, each running the whole health check on its shard, then merge the
+    shards' status files into the status file and write the combined run summary and the aggregate feed
+    :param root_dir: The root directory of the script
+    :param shard_count: Number of shards (worker processes)
+    :param profile_dir: Profile each shard and write its reports to a subfolder of this folder, None to not profile
+    :param profile_stages: Only profile these stages (MetricsUtils span names)
+    :return: None
+    """
     print("\n=================================================================")
-    print(f"Validating layers")
+    print(f"Running the health check on {shard_count} shards")
     print("=================================================================")
-    data_model_dict = ServiceValidator.validate_layers(data_model=data_model_dict)
+    config_ini_manager = ConfigManager(root=root_dir, file_name="config.ini")
+    input_items = config_ini_manager.get_config_data(config_type="items")
+    precompress_outputs = config_ini_manager.get_default_boolean(option="precompress_outputs")
+    run_started = time.monotonic()
+    summaries = ShardManager.run_shards(run_shard, shard_count, root_dir, profile_dir, profile_stages)
 
     print("\n=================================================================")
-    print(f"Retrieve usage statistics")
+    print("Merging shard results")
     print("=================================================================")
-    data_model_dict = QueryEngine.get_usage_details(data_model=data_model_dict)
+    # the shard HealthCheck objects only provide the paths here, nothing is loaded
+    shards = [HealthCheck(root_dir=root_dir, shard_index=shard_index, shard_count=shard_count)
+              for shard_index in range(shard_count)]
+    status_file = shards[0].previous_status_file
+    FileManager.create_new_folder(shards[0].output_status_dir_path)
+    FileManager.create_new_folder(shards[0].shard_dir_path)
+    previous_status_output = StatusManager.PreviousStatusIndex.from_file(path=status_file)
+    output_file = ShardManager.merge_status_outputs(
+        status_outputs=[FileManager.open_file_streaming(path=shard.status_file) for shard in shards
+                        if FileManager.check_file_exist_by_pathlib(path=shard.status_file)],
+        item_ids=[input_item.id for input_item in input_items],
+        previous_status_output=previous_status_output)
+    print(f"Items: {len(output_file['items'])}")
+    status_deltas = StatusManager.StatusDeltaFeed.from_file(
+        path=shards[0].status_deltas_file,
+        window=int(config_ini_manager.get_default_value("status_delta_window", StatusManager.DEFAULT_DELTA_WINDOW)),
+        sequence=previous_status_output.sequence)
+    delta = status_deltas.record(status_output=output_file, previous_status_output=previous_status_output)
+    print(f"Sequence: {delta['sequence']}\tItems changed: {len(delta['changed'])}\t"
+          f"Items removed: {len(delta['removed'])}")
+    FileManager.save_streaming(data=output_file, path=status_file, precompress=precompress_outputs)
+    status_deltas.save(path=shards[0].status_deltas_file,
+                       delta_path=shards[0].status_delta_file,
+                       precompress=precompress_outputs)
+
+    if config_ini_manager.get_default_boolean("aggregate_feed_enabled"):
+        event_logs = [EventsManager.EventLog(log_file=shard.event_log_file) for shard in shards
+                      if FileManager.check_file_exist_by_pathlib(path=shard.event_log_file)]
+        update_aggregate_feed(config_ini_manager=config_ini_manager,
+                              output_dir=shards[0].rss_dir_path,
+                              precompress=precompress_outputs,
+                              event_logs=event_logs,
+                              timestamp=output_file["statusPreparedOn"])
+
+    # Combined run summary
+    run_summary = ShardManager.merge_summaries(summaries)
+    run_summary["runSeconds"] = round(time.monotonic() - run_started, 3)
+    FileManager.save(data=run_summary, path=os.path.realpath(shards[0].shard_dir_path + r"\run_summary.json"))
+    for summary in summaries:
+        print(f"Shard {summary['shard']}\t{'FAILED' if 'error' in summary else 'OK'}\t"
+              f"{summary.get('items', 0)} items\t{summary.get('runSeconds', 0)} seconds")
+    print(f"Items updated: {run_summary['totals'].get('itemsUpdated', 0)}")
+    print(f"Total time: {run_summary['runSeconds']} seconds")
+
+
+def main(daemon: bool = False, interval: float = None, shards: int = None, coordinator: bool = False,
+         worker: bool = False, worker_id: str = None, profile: bool = False, profile_stages=None):
+    """
+    :param daemon: Stay resident and repeat the check on a schedule
+    :param interval: Minutes between the start of two checks in daemon mode, defaults to daemon_interval_minutes in
+    the config file
+    :param shards: Number of worker processes the items are partitioned across, defaults to shard_count in the config
+    file
+    :param coordinator: Hand the checks to the workers through the job queue
+    :param worker: Check the items of the jobs in the job queue until stopped
+    :param worker_id: The worker ID, defaults to the host name and process ID
+    :param profile: Run under cProfile and tracemalloc and write the reports to output/profile (and those of each shard
+    of a sharded run to output/profile/shard_{shard}_of_{count})
+    :param profile_stages: Only profile these stages (MetricsUtils span names), implies profile
+    """
+    # Script version number
+    print(f"\nRunning version: {version.version_str}")
 
-    print("\n=================================================================")
-    print(f"Retrieve feature counts")
-    print("=================================================================")
-    data_model_dict = QueryEngine.get_feature_counts(data_model=data_model_dict)
+    # The root directory of the script
+    root_dir = os.path.dirname(os.path.abspath(__file__))
 
-    print("\n=================================================================")
-    print(f"Analyze and process data")
-    print("=================================================================")
-    for key, value in data_model_dict.items():
-        item_id = key
-        agol_is_valid = True
-        item_is_valid = value["itemIsValid"]
-        service_response = value["serviceResponse"]
-        service_is_valid = service_response["success"]
-        layers_are_valid = value["allLayersAreValid"]
-
-        print(f"{item_id}\t{value['title']}")
-        print(f"ArcGIS Online accessible: {agol_is_valid}")
-        print(f"Item valid: {item_is_valid}")
-        print(f"Service valid: {service_is_valid}")
-        print(f"All layers valid: {layers_are_valid}\n")
-
-        print("-------- RETRY COUNT ---------")
-        # Process Retry Count
-        service_retry_count = QueryEngine.get_retry_count(service_response["retryCount"])
-        print(f"Service Retry Count: {service_retry_count}")
-        print("------------------------------\n")
-
-        print("-------- ELAPSED TIME --------")
-        # Retrieve the elapsed time of the query to the service (not the layers)
-        service_elapsed_time = QueryEngine.get_service_elapsed_time(service_is_valid, service_response["response"])
-        print(f"Service Elapsed Time: {service_elapsed_time}")
-        # Retrieve the average elapsed time of layers for the current service (layers only)
-        print(f"Layers Elapsed times (individual)")
-        layers_elapsed_time = QueryEngine.get_layers_average_elapsed_time(layers_elapsed_times=value['serviceLayersElapsedTimes'])
-        print(f"Layers Elapsed Time (average): {layers_elapsed_time}")
-        # Sum up the elapsed time for the service and the layers divided by 2
-        # We want the total elapsed time of the layers and the FS
-        total_elapsed_time = (service_elapsed_time + layers_elapsed_time)/2
-        print(f"Total Elapsed Time average: {total_elapsed_time}")
-        print("------------------------------\n\n")
-
-        # Obtain the total elapsed time and counts
-        # path to output file
-        # This file contains the:
-        #   item id
-        #   elapsed time
-        #   elapsed sums
-        response_time_data_file_path = os.path.join(response_time_data_dir, item_id + "." + "json")
-        # Check file existence.
-        response_time_data_file_path_exist = FileManager.check_file_exist_by_pathlib(path=response_time_data_file_path)
-
-        exclude_save = TimeUtils.is_now_excluded(value["exclude_time_ranges"],
-                                                 value["exclude_days"],
-                                                 value["exclude_specific_dates"],
-                                                 timestamp)
-        print(f"Exclude response time data from save: {exclude_save}")
-
-        # Does the file exist
-        if not response_time_data_file_path_exist:
-            # If file does not exist then create it.
-            FileManager.create_new_file(response_time_data_file_path)
-            FileManager.set_file_permission(response_time_data_file_path)
-            if not exclude_save:
-                FileManager.save(data={
-                    "id": item_id,
-                    "elapsed_sums": total_elapsed_time,
-                    "elapsed_count": 1
-                }, path=response_time_data_file_path)
-            # since it's our first entry, the average is the current elapsed time
-            elapsed_times_average = total_elapsed_time
-        else:
-            # Retrieve the elapsed time DIVIDE by count
-            print(f"Retrieving response time data from existing json file: {item_id}.json")
-            response_time_data = FileManager.get_response_time_data(response_time_data_file_path)
-            # total counts
-            elapsed_times_count = response_time_data["elapsed_count"]
-            print(f"Elapsed count (on file before update): {elapsed_times_count}")
-            # sum of all times
-            elapsed_times_sum = response_time_data["elapsed_sums"]
-            print(f"Elapsed sums (on file before update): {elapsed_times_sum}")
-            # calculated average
-            elapsed_times_average = elapsed_times_sum / elapsed_times_count
-            if not exclude_save:
-                # update the response time data file
-                FileManager.update_response_time_data(path=response_time_data_file_path, input_data={
-                    "id": item_id,
-                    "elapsed_count": elapsed_times_count + 1,
-                    "elapsed_sums": elapsed_times_sum + total_elapsed_time
-                })
-        print(f"Elapsed average: {elapsed_times_average}")
-
-        # retrieve alfp details
-        alfp_data = alfp_dict.get(item_id)
-
-        if alfp_data is not None:
-            # 10 digit Timestamp 'seconds since epoch' containing time of last
-            # Successful Run (and Service update) when data was changed
-            value.update({
-                "lastUpdateTimestamp": alfp_data.get("lastUpdateTimestamp", 0)
-            })
-            # 10 digit Timestamp 'seconds since epoch' containing time of last
-            # Failed run (or Service update failure)
-            # feed_last_failure_timestamp = item["lastFailureTimestamp"]
-            # 10 digit Timestamp 'seconds since epoch' containing time of last
-            # run (having a Success, a Failure, or a No Action flag ('No Data
-            # Updates')
-            value.update({
-                "lastRunTimestamp": alfp_data.get("lastRunTimestamp", 0)
-            })
-            # Average number of minutes between each successful run (or Service
-            # update)
-            value.update({
-                "avgUpdateIntervalMins": alfp_data.get("avgUpdateIntervalMins", 0)
-            })
-            # Average number of minutes between each run
-            value.update({
-                "avgFeedIntervalMins": alfp_data.get("avgFeedIntervalMins", 0)
-            })
-            #
-            value.update({
-                "consecutiveFailures": alfp_data.get("consecutiveFailures", 0)
-            })
-            #
-            value.update({
-                "alfpLastStatus": alfp_data["lastStatus"]["code"]
-            })
-        else:
-            value.update({
-                "lastUpdateTimestamp": 0,
-                "lastRunTimestamp": 0,
-                "avgUpdateIntervalMins": 0,
-                "avgFeedIntervalMins": 0,
-                "consecutiveFailures": 0,
-                "alfpLastStatus": 0
-            })
-
-        # initialize the status code
-        status_code = StatusManager.get_status_code("000", status_codes_data_model)
-
-        if all([agol_is_valid, item_is_valid, service_is_valid, layers_are_valid]):
-            print("AGOL, Item, Service checks normal")
-
-            # 001 Check
-            print("\nCHECKING     001")
-            # Check elapsed time between now and the last updated time of the feed
-            last_update_timestamp_diff = timestamp - value.get("lastUpdateTimestamp", timestamp)
-            # Check elapsed time between now and the last run time of the feed
-            last_run_timestamp_diff = timestamp - value["lastRunTimestamp"]
-
-            # If the Difference exceeds the average update interval by an interval of X, flag it
-            last_update_timestamp_diff_minutes = last_update_timestamp_diff / 60
-            print(f"Last update timestamp delta:\t{last_update_timestamp_diff_minutes} seconds")
-            # Average number of minutes between each successful run (or Service update)
-            avg_update_int_threshold = int(value["average_update_interval_factor"]) * value["avgUpdateIntervalMins"]
-            print(f"Average update interval threshold: {avg_update_int_threshold}")
-            if last_update_timestamp_diff_minutes > avg_update_int_threshold:
-                status_code = StatusManager.get_status_code("001", status_codes_data_model)
-
-            print("\nCHECKING     002")
-            # 002 Check
-            last_run_timestamp_diff_minutes = last_run_timestamp_diff / 60
-            print(f"Last run timestamp delta:\t{last_run_timestamp_diff_minutes} seconds")
-            # calculate the threshold (Average number of minutes between each run)
-            avg_feed_int_threshold = int(value["average_feed_interval_factor"]) * value["avgFeedIntervalMins"]
-            print(f"Average Feed Interval threshold: {avg_feed_int_threshold}")
-            if last_run_timestamp_diff_minutes > avg_feed_int_threshold:
-                status_code = StatusManager.get_status_code("002", status_codes_data_model)
-
-            print("\nCHECKING     003")
-            # 003 Check
-            if value["alfpLastStatus"] == 2:
-                if value["consecutiveFailures"] > int(value["consecutive_failures_threshold"]):
-                    status_code = StatusManager.get_status_code("003", status_codes_data_model)
-
-            print("\nCHECKING     004")
-            # 004 Check
-            if value["alfpLastStatus"] == 3:
-                if value["consecutiveFailures"] > int(value["consecutive_failures_threshold"]):
-                    status_code = StatusManager.get_status_code("004", status_codes_data_model)
-
-            print("\nCHECKING     005")
-            # 005 Check
-            if value["alfpLastStatus"] == 1:
-                if value["consecutiveFailures"] > int(value["consecutive_failures_threshold"]):
-                    status_code = StatusManager.get_status_code("005", status_codes_data_model)
-
-            print("\nCHECKING     006")
-            # 006 Check
-            if value["alfpLastStatus"] == -1:
-                status_code = StatusManager.get_status_code("006", status_codes_data_model)
-
-            print("\nCHECKING     100")
-            # 100
-            # Check retry count
-            if service_retry_count > int(value["default_retry_count"]):
-                status_code = StatusManager.get_status_code("100", status_codes_data_model)
-
-            print("\nCHECKING     101")
-            # 101
-            # Check elapsed time
-            # avg_elapsed_time_threshold = float(value["average_elapsed_time_factor"]) * float(elapsed_times_average)
-            avg_elapsed_time_threshold = float(value["average_elapsed_time_factor"])
-            if total_elapsed_time > avg_elapsed_time_threshold:
-                status_code = StatusManager.get_status_code("101", status_codes_data_model)
-
-            LoggingUtils.log_status_code_details(item_id, status_code)
-        else:
-            print("\nCHECKING     102, 201, 500, 501")
-            # If we are at this point, then one or more of the Service states has failed
-            #
-            # The any() function returns True if any item in an iterable are true, otherwise it returns False.
-            if any([agol_is_valid, item_is_valid, service_is_valid]):
-                if service_is_valid:
-                    print(f"Service | Success")
-                    if item_is_valid:
-                        print(f"Item | Success | AGOL must be down, then why is the item accessible?")
-                    else:
-                        # 102
-                        status_code = StatusManager.get_status_code("102", status_codes_data_model)
-                    # 201 Check
-                    if layers_are_valid is not True:
-                        status_code = StatusManager.get_status_code("201", status_codes_data_model)
-                else:
-                    # 500
-                    if item_is_valid:
-                        status_code = StatusManager.get_status_code("500", status_codes_data_model)
-                    else:
-                        print(f"Item | Fail")
-                        # If ALL of the Service states are False, we have reached a critical failure in the system
-                        status_code = StatusManager.get_status_code("501", status_codes_data_model)
+    profiling = profile or bool(profile_stages)
+    profile_dir = os.path.realpath(root_dir + r"\output\profile")
+    if profiling:
+        # CPU and memory profile of the whole run, or of the named stages (see MetricsUtils.Profiler)
+        MetricsUtils.start_profiling(output_dir=profile_dir, stages=profile_stages)
+    try:
+        if worker:
+            run_worker(root_dir=root_dir, worker_id=worker_id)
+            print("Script completed...")
+            return
+
+        if shards is None and not coordinator:
+            shards = int(ConfigManager(root=root_dir, file_name="config.ini").get_default_value("shard_count", 1))
+        if shards is not None and shards > 1 and not daemon:
+            FileManager.start_write_behind()
+            try:
+                # each shard process profiles itself (to output/profile/shard_{shard}_of_{count})
+                run_sharded(root_dir=root_dir, shard_count=shards, profile_dir=profile_dir if profiling else None,
+                            profile_stages=profile_stages)
+            finally:
+                HealthCheck.print_write_stats(FileManager.stop_write_behind())
+            print("Script completed...")
+            return
+
+        # All output files (response time data, event history, RSS and the status file) are written by a background
+        # writer thread so that disk latency does not hold up the analysis of each item.
+        FileManager.start_write_behind()
+
+        health_check = HealthCheck(root_dir=root_dir)
+        try:
+            health_check.load()
+            if coordinator:
+                health_check.job_queue = open_job_queue(config_ini_manager=health_check.config_ini_manager,
+                                                        output_dir=health_check.output_status_dir_path)
+            if not daemon:
+                health_check.run()
             else:
-                # If ALL of the Service states are False, we have reached a critical failure in the system
-                status_code = StatusManager.get_status_code("501", status_codes_data_model)
-
-            LoggingUtils.log_status_code_details(item_id, status_code)
-
-        # update/add status code in the data model
-        # Add the Admin comments (if any)
-        # Add the last build time
-        # Add the status code
-        # Add the current run time of the script
-        value.update({
-            "comments": admin_comments_data_model.get(item_id, []),
-            "lastBuildTime": time_utils_response["datetimeObj"].strftime("%a, %d %b %Y %H:%M:%S +0000"),
-            "status": status_code,
-            "timestamp": timestamp
-        })
-
-        # If the file exist, check the status/comments between the item's previous status/code comment, and the
-        # current status/code comment to determine if the existing RSS file should be updated.
-        update_current_feed = StatusManager.update_rss_feed(previous_status_output=previous_status_output,
-                                                            item=value,
-                                                            status_codes_data_model=status_codes_data_model)
-        # Check if we need to apply an update
-        if update_current_feed:
-            print(f"\nUpdate Required")
-            print(f"---------- Events History --------")
-            # This file will hold a history of event changes
-            current_events_file = os.path.realpath(event_history_dir_path + r"\status_history" + f"_{item_id}.json")
-            # Check file existence
-            status_history_file_exist = FileManager.check_file_exist_by_pathlib(path=current_events_file)
-            if status_history_file_exist:
-                print(f"Checking events file: {current_events_file}")
-                EventsManager.update_events_file(input_data=value, events_file=current_events_file)
-            else:
-                print(f"Creating events file: {current_events_file}")
-                EventsManager.create_history_file(input_data=value, events_file=current_events_file)
-            print(f"----------------------------------")
-
-            print(f"\n---------- RSS Updates -----------")
-            # Build the path to RSS output file for the current item.  This file is what the RSS reader reads.
-            # There should be one output file for each service/item being monitored.
-            rss_file_path = os.path.join(rss_dir_path, item_id + "." + value["rss_file_extension"])
-            # Check if the output file already exist
-            rss_file_exist = FileManager.check_file_exist_by_pathlib(path=rss_file_path)
-            if rss_file_exist:
-                # Update the dictionary
-                # rss_items is the placeholder in the main rss_template file
-                value.update({
-                    "rss_items": rss_manager.build_item_nodes(input_data=value, events_file=current_events_file)
-                })
-                # Update the RSS output file
-                rss_manager.update_rss_contents(input_data=value, rss_file=rss_file_path)
-            print(f"----------------------------------")
-
-    print("\n=================================================================")
-    print("Saving results")
-    print(f"Output file path: {status_file}")
-    print("=================================================================")
-    # output file
-    output_file = {
-        "statusPreparedOn": timestamp,
-        "items": []
-    }
-    # hydrate output file
-    for key, value in data_model_dict.items():
-        output_file["items"].append({
-            "id": key,
-            "title": value.get("title", value.get("missing_item_title")),
-            "snippet": value.get("snippet", value.get("missing_item_snippet")),
-            "comments": value.get("comments", ""),
-            "lastUpdateTime": value.get("lastUpdateTimestamp", 0),
-            "updateRate": value.get("avgUpdateIntervalMins", 0),
-            "featureCount": value.get("featureCount", 0),
-            "usage": value.get("usage"),
-            "status": {
-                "code": value["status"]["code"]
-            }
-        })
-    # Pretty print dictionary
-
-    # If file do not exist then create it.
-    # TODO Not correct
-    if not file_exist:
-        FileManager.create_new_file(status_file)
-        FileManager.set_file_permission(status_file)
-    else:
-        # open file
-        print()
-    FileManager.save(data=output_file, path=status_file)
-
-    print("Script completed...")
+                if interval is None:
+                    interval = float(health_check.config_ini_manager.get_default_value(
+                        "daemon_interval_minutes", Scheduler.DEFAULT_INTERVAL_MINUTES))
+                print("\n=================================================================")
+                print(f"Running as a daemon, checking every {interval} minutes")
+                print("=================================================================")
+                if health_check.config_ini_manager.get_default_boolean("adaptive_cadence_enabled"):
+                    # Each run only checks the items due for a check
+                    health_check.planner = Scheduler.CheckPlanner(**health_check.get_cadence_settings())
+                scheduler = Scheduler.Daemon(run=health_check.run,
+                                             interval=interval * 60,
+                                             watched_files=health_check.watched_files,
+                                             reload=health_check.load,
+                                             poll_interval=float(health_check.config_ini_manager.get_default_value(
+                                                 "daemon_poll_seconds", Scheduler.DEFAULT_POLL_SECONDS)),
+                                             next_due=lambda: health_check.planner.next_due()
+                                             if health_check.planner is not None else None)
+                metrics_server = None
+                metrics_port = int(health_check.config_ini_manager.get_default_value("metrics_port", 0))
+                if metrics_port > 0:
+                    # Prometheus endpoint, serving the metrics of the last run
+                    metrics_server = PrometheusExporter.MetricsServer(
+                        registry=health_check.metrics_registry,
+                        host=health_check.config_ini_manager.get_default_value("metrics_host", "127.0.0.1"),
+                        port=metrics_port)
+                    metrics_server.start()
+                status_api_port = int(health_check.config_ini_manager.get_default_value("status_api_port", 0))
+                if status_api_port > 0:
+                    # Status API, serving the status, event histories and RSS feeds of the last run from memory
+                    health_check.status_server = StatusAPI.StatusServer(
+                        host=health_check.config_ini_manager.get_default_value("status_api_host", "127.0.0.1"),
+                        port=status_api_port)
+                    health_check.status_server.start()
+                try:
+                    scheduler.start()
+                finally:
+                    if metrics_server is not None:
+                        metrics_server.stop()
+                    if health_check.status_server is not None:
+                        health_check.status_server.stop()
+        finally:
+            health_check.close()
+
+        print("Script completed...")
+    finally:
+        if profiling:
+            print("\n=================================================================")
+            print("Profile reports")
+            print("=================================================================")
+            for path in MetricsUtils.stop_profiling():
+                print(path)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Live Feeds Health Check")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident and repeat the check on a schedule")
+    parser.add_argument("--interval", type=float, default=None,
+                        help="minutes between checks in daemon mode (default: daemon_interval_minutes)")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="number of worker processes the items are partitioned across (default: shard_count)")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="hand the checks to the workers through the job queue (job_queue_url)")
+    parser.add_argument("--worker", action="store_true",
+                        help="check the items of the jobs in the job queue until stopped")
+    parser.add_argument("--worker-id", default=None,
+                        help="worker ID (default: host name and process ID)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the run (cProfile and tracemalloc), reports are written to output/profile")
+    parser.add_argument("--profile-stages", default=None, type=lambda value: value.split(","),
+                        help="only profile these comma separated stages (e.g. analysis,rss), implies --profile")
+    args = parser.parse_args()
+    if args.daemon and args.shards is not None and args.shards > 1:
+        parser.error("--shards is not supported in daemon mode")
+    if args.coordinator and args.shards is not None and args.shards > 1:
+        parser.error("--shards is not supported in coordinator mode")
+    if args.worker and (args.daemon or args.coordinator):
+        parser.error("--worker cannot be combined with --daemon or --coordinator")
+    main(daemon=args.daemon, interval=args.interval, shards=args.shards, coordinator=args.coordinator,
+         worker=args.worker, worker_id=args.worker_id, profile=args.profile, profile_stages=args.profile_stages)
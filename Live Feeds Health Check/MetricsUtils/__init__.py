@@ -0,0 +1,380 @@
+""" Timing spans and counters of a run, reported in the run metrics file, and the profiler of --profile runs """
+import contextlib
+import cProfile
+import io
+import json
+import linecache
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+# Name of the stage requests made outside of any span are attributed to
+NO_STAGE = "other"
+
+
+class RunMetrics:
+    """
+    Durations of the stages of a run and the durations, sizes and outcomes of its network requests.
+
+    Stages are timed with :meth:`span`, spans can be nested (the outer span includes the inner ones).  Requests are
+    attributed to the innermost open span and to their host.  The stages of a run follow each other, so the open spans
+    are shared by all the threads and requests made from thread pools are attributed to the stage that started them.
+    """
+
+    def __init__(self):
+        self.started_on = int(time.time())
+        self._lock = threading.Lock()
+        # stage name -> stage stats, in the order the stages first ran
+        self.stages = {}
+        # stage name -> request stats
+        self.requests = {}
+        # host -> request stats
+        self.hosts = {}
+        # name -> count
+        self.counts = {}
+        # cache name -> {"hits", "misses"}
+        self.caches = {}
+        self._open_spans = []
+
+    @contextlib.contextmanager
+    def span(self, name: str = ""):
+        """
+        Time a stage, an exception raised in the stage counts as an error of the stage.
+
+        :param name: Stage name, the stats of spans of the same name are added up
+        """
+        with self._lock:
+            stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "maxSeconds": 0.0, "errors": 0})
+        profiler = _profiler
+        if profiler is not None:
+            profiler.enter_stage(name)
+        self._open_spans.append(name)
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            self._open_spans.remove(name)
+            if profiler is not None:
+                profiler.exit_stage(name)
+            with self._lock:
+                stats["calls"] += 1
+                stats["seconds"] += seconds
+                stats["maxSeconds"] = max(stats["maxSeconds"], seconds)
+                stats["errors"] += failed
+
+    def record_request(self, host: str = "", seconds: float = 0, size: int = 0, success: bool = True) -> None:
+        """
+        Record a network request.
+
+        :param host: Host the request was sent to
+        :param seconds: Duration of the request, including the retries
+        :param size: Response body size in bytes
+        :param success: False if the request failed
+        """
+        stage = self._open_spans[-1] if self._open_spans else NO_STAGE
+        with self._lock:
+            for stats in (self.requests.setdefault(stage, _new_request_stats()),
+                          self.hosts.setdefault(host or "unknown", _new_request_stats())):
+                stats["count"] += 1
+                stats["errors"] += not success
+                stats["seconds"] += seconds
+                stats["maxSeconds"] = max(stats["maxSeconds"], seconds)
+                stats["bytes"] += size
+
+    @contextlib.contextmanager
+    def timed_request(self, host: str = ""):
+        """ Record the request made in the block, it failed if the block raises an exception """
+        started = time.perf_counter()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self.record_request(host=host, seconds=time.perf_counter() - started, success=success)
+
+    def count(self, name: str = "", value: int = 1) -> None:
+        """ Add to a counter """
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def record_cache(self, name: str = "", hit: bool = True) -> None:
+        """ Record a cache lookup """
+        with self._lock:
+            stats = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+            stats["hits" if hit else "misses"] += 1
+
+    def report(self, run_seconds: float = None) -> dict:
+        """
+        :param run_seconds: Duration of the run, defaults to the time since the metrics started
+        :return: The run metrics, durations in seconds and sizes in bytes
+        """
+        with self._lock:
+            requests_total = _new_request_stats()
+            for stats in self.requests.values():
+                for key, value in stats.items():
+                    requests_total[key] = max(requests_total[key], value) if key == "maxSeconds" \
+                        else requests_total[key] + value
+            return {
+                "runStartedOn": self.started_on,
+                "runSeconds": round(time.time() - self.started_on if run_seconds is None else run_seconds, 3),
+                "stages": {name: _rounded(stats) for name, stats in self.stages.items()},
+                "requests": {
+                    "total": _rounded(requests_total),
+                    "byStage": {name: _rounded(stats) for name, stats in self.requests.items()},
+                    "byHost": {host: _rounded(stats) for host, stats in self.hosts.items()}
+                },
+                "counts": dict(self.counts),
+                "caches": {name: {**stats, **{"hitRate": round(stats["hits"] / (stats["hits"] + stats["misses"]), 4)}}
+                           for name, stats in self.caches.items()},
+                "errors": {
+                    "requests": requests_total["errors"],
+                    "stages": sum(stats["errors"] for stats in self.stages.values())
+                }
+            }
+
+    def summary(self, run_seconds: float = None) -> str:
+        """
+        :param run_seconds: Duration of the run
+        :return: Compact human readable summary of the report
+        """
+        report = self.report(run_seconds=run_seconds)
+        total = report["requests"]["total"]
+        lines = [f"Run: {report['runSeconds']} seconds, {total['count']} requests ({total['errors']} failed, "
+                 f"{round(total['bytes'] / 1024)} KB, {total['seconds']} seconds)"]
+        for name, stats in report["stages"].items():
+            requests = report["requests"]["byStage"].get(name)
+            lines.append(f"  {name:<20}{stats['seconds']:>10.3f} s"
+                         + (f" x{stats['calls']}" if stats["calls"] > 1 else "")
+                         + (f"\t{requests['count']} requests, {requests['errors']} failed" if requests else "")
+                         + (f"\t{stats['errors']} errors" if stats["errors"] else ""))
+        slowest_host = max(report["requests"]["byHost"].items(), key=lambda host: host[1]["seconds"], default=None)
+        if slowest_host is not None:
+            lines.append(f"Slowest host: {slowest_host[0]} ({slowest_host[1]['count']} requests, "
+                         f"{slowest_host[1]['seconds']} seconds, max {slowest_host[1]['maxSeconds']})")
+        return "\n".join(lines)
+
+
+def _new_request_stats():
+    return {"count": 0, "errors": 0, "seconds": 0.0, "maxSeconds": 0.0, "bytes": 0}
+
+
+def _rounded(stats):
+    return {key: round(value, 4) if isinstance(value, float) else value for key, value in stats.items()}
+
+
+class Profiler:
+    """
+    CPU (cProfile) and memory (tracemalloc) profiler of the whole run or of named stages.
+
+    Without stages, everything between :meth:`start` and :meth:`stop` is profiled.  With stages, only the spans of
+    those stages are (a stage nested in another selected stage is profiled once).  The peak memory of every stage is
+    tracked either way.  cProfile only sees the thread that started it, the work done in thread pools shows up as the
+    time the main thread spent waiting for it.  tracemalloc sees every thread.
+
+    Reports written by :meth:`stop` to the output folder:
+        profile.prof            raw cProfile stats (pstats, snakeviz, ...)
+        profile_functions.txt   functions by cumulative time
+        profile_allocations.txt allocation sites of the memory still allocated at the end of each profiled section
+        profile_stages.json     peak traced memory and number of profiled calls of each stage
+    """
+
+    def __init__(self, output_dir: str = "", stages=None, top: int = 40, frames: int = 1):
+        """
+        :param output_dir: Folder of the reports
+        :param stages: Names of the stages to profile, None to profile everything
+        :param top: Number of functions and allocation sites in the reports
+        :param frames: Number of frames of the allocation tracebacks
+        """
+        self.output_dir = output_dir
+        self.stages = set(stages) if stages else None
+        self.top = top
+        self.frames = frames
+        self._profile = cProfile.Profile()
+        # depth of the selected stages open
+        self._depth = 0
+        self._snapshot = None
+        # (file, line) -> [size, count] of the blocks allocated by the profiled sections and still allocated
+        self._allocations = {}
+        # stage name -> {"peakBytes", "calls"}
+        self._stage_stats = {}
+        # peak memory of the open spans' children, the open span's own peak is reset when a child starts
+        self._open_peaks = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        tracemalloc.start(self.frames)
+        if self.stages is None:
+            self._begin()
+
+    def stop(self) -> list:
+        """
+        Stop profiling and write the reports
+        :return: Paths of the reports
+        """
+        if self.stages is None:
+            self._end()
+        tracemalloc.stop()
+        return self.write_reports()
+
+    def enter_stage(self, name: str = "") -> None:
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                return
+            if self._open_peaks:
+                self._open_peaks[-1] = max(self._open_peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._open_peaks.append(0)
+            if self.stages is not None and name in self.stages:
+                self._depth += 1
+                if self._depth == 1:
+                    self._begin()
+
+    def exit_stage(self, name: str = "") -> None:
+        with self._lock:
+            if not tracemalloc.is_tracing() or not self._open_peaks:
+                return
+            peak = max(self._open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if self._open_peaks:
+                self._open_peaks[-1] = max(self._open_peaks[-1], peak)
+            stats = self._stage_stats.setdefault(name, {"peakBytes": 0, "calls": 0})
+            stats["peakBytes"] = max(stats["peakBytes"], peak)
+            stats["calls"] += 1
+            if self.stages is not None and name in self.stages:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._end()
+
+    def _begin(self):
+        self._snapshot = tracemalloc.take_snapshot()
+        self._profile.enable()
+
+    def _end(self):
+        self._profile.disable()
+        if self._snapshot is None:
+            return
+        snapshot_filter = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        snapshot = tracemalloc.take_snapshot().filter_traces(snapshot_filter)
+        for stat in snapshot.compare_to(self._snapshot.filter_traces(snapshot_filter), "lineno"):
+            if stat.size_diff > 0:
+                frame = stat.traceback[0]
+                allocation = self._allocations.setdefault((frame.filename, frame.lineno), [0, 0])
+                allocation[0] += stat.size_diff
+                allocation[1] += stat.count_diff
+        self._snapshot = None
+
+    def write_reports(self) -> list:
+        """
+        Write the reports
+        :return: Paths of the reports
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        raw_path = os.path.join(self.output_dir, "profile.prof")
+        functions_path = os.path.join(self.output_dir, "profile_functions.txt")
+        allocations_path = os.path.join(self.output_dir, "profile_allocations.txt")
+        stages_path = os.path.join(self.output_dir, "profile_stages.json")
+
+        self._profile.dump_stats(raw_path)
+        functions = io.StringIO()
+        try:
+            pstats.Stats(self._profile, stream=functions).sort_stats("cumulative").print_stats(self.top)
+        except TypeError:
+            # nothing was profiled
+            functions.write("No calls profiled\n")
+        with open(functions_path, "w", encoding="utf-8") as report:
+            report.write(f"Profiled stages: {', '.join(sorted(self.stages)) if self.stages else 'all'}\n")
+            report.write(functions.getvalue())
+
+        with open(allocations_path, "w", encoding="utf-8") as report:
+            report.write(f"Top {self.top} allocation sites (memory allocated by the profiled sections and still "
+                         f"allocated at their end)\n\n")
+            allocations = sorted(self._allocations.items(), key=lambda allocation: allocation[1][0], reverse=True)
+            for (filename, lineno), (size, count) in allocations[:self.top]:
+                report.write(f"{size / 1024:>12.1f} KiB {count:>10} blocks  {filename}:{lineno}\n")
+                line = linecache.getline(filename, lineno).strip()
+                if line:
+                    report.write(f"{'':>36}{line}\n")
+
+        with open(stages_path, "w", encoding="utf-8") as report:
+            json.dump({name: {**stats, **{"peakMiB": round(stats["peakBytes"] / 1048576, 2)}}
+                       for name, stats in self._stage_stats.items()}, report, indent=4)
+        return [raw_path, functions_path, allocations_path, stages_path]
+
+
+# Metrics of the current run
+_run_metrics = RunMetrics()
+
+# Profiler of --profile runs
+_profiler = None
+
+
+def get_run_metrics() -> RunMetrics:
+    """ :return: The metrics of the current run """
+    return _run_metrics
+
+
+def finish_run() -> RunMetrics:
+    """
+    End the current run's metrics, whatever is recorded from now on (e.g. a reload between two runs in daemon mode)
+    belongs to the next run.
+
+    :return: The metrics of the run that ended
+    """
+    global _run_metrics
+    run_metrics, _run_metrics = _run_metrics, RunMetrics()
+    return run_metrics
+
+
+def span(name: str = ""):
+    """ Time a stage of the current run, see :meth:`RunMetrics.span` """
+    return _run_metrics.span(name)
+
+
+def record_request(host: str = "", seconds: float = 0, size: int = 0, success: bool = True) -> None:
+    """ Record a network request of the current run, see :meth:`RunMetrics.record_request` """
+    _run_metrics.record_request(host=host, seconds=seconds, size=size, success=success)
+
+
+def timed_request(host: str = ""):
+    """ Record the request made in the block, see :meth:`RunMetrics.timed_request` """
+    return _run_metrics.timed_request(host=host)
+
+
+def count(name: str = "", value: int = 1) -> None:
+    """ Add to a counter of the current run """
+    _run_metrics.count(name=name, value=value)
+
+
+def record_cache(name: str = "", hit: bool = True) -> None:
+    """ Record a cache lookup of the current run """
+    _run_metrics.record_cache(name=name, hit=hit)
+
+
+def start_profiling(output_dir: str = "", stages=None, top: int = 40) -> Profiler:
+    """
+    Start profiling the run (or the named stages), see :class:`Profiler`
+    :param output_dir: Folder of the reports
+    :param stages: Names of the stages to profile, None to profile everything
+    :param top: Number of functions and allocation sites in the reports
+    :return: The Profiler
+    """
+    global _profiler
+    _profiler = Profiler(output_dir=output_dir, stages=stages, top=top)
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiling() -> list:
+    """
+    Stop profiling and write the reports
+    :return: Paths of the reports
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler.stop() if profiler is not None else []
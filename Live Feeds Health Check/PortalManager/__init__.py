@@ -0,0 +1,162 @@
+""" The portals (GIS profiles) the items are checked with, each checked independently of the others """
+import concurrent.futures
+import traceback
+import MetricsUtils as MetricsUtils
+
+# Default number of items of a portal checked at the same time
+DEFAULT_CONCURRENCY = 1
+
+
+class Portal:
+    """
+    A portal the items are checked with: its authenticated GIS, token and the number of its items checked at the same
+    time.  Every portal has its own GIS connection, so a slow or unavailable portal does not hold up the others.  The
+    GIS is None until the portal is signed in (see :func:`sign_in`).
+    """
+
+    def __init__(self, profile: str = "", gis=None, max_concurrency: int = DEFAULT_CONCURRENCY):
+        """
+        :param profile: The GIS profile name
+        :param gis: The authenticated arcgis.GIS, None if not signed in
+        :param max_concurrency: Number of the portal's items checked at the same time
+        """
+        self.profile = profile
+        self.gis = gis
+        self.max_concurrency = max_concurrency
+
+    def __repr__(self):
+        return f"Portal({self.profile})"
+
+    @property
+    def signed_in(self) -> bool:
+        return self.gis is not None
+
+    @property
+    def token(self):
+        """ The token of the GIS, None when signed in anonymously """
+        return self.gis._con.token if self.gis is not None else None
+
+
+def group_items(input_items=None) -> dict:
+    """
+    Group the items by their GIS profile
+
+    :param input_items: The items (ConfigManager.ItemConfig)
+    :return: Dictionary of profile -> list of the profile's items, in the order of the config file
+    """
+    groups = {}
+    for input_item in input_items or []:
+        groups.setdefault(input_item.profile, []).append(input_item)
+    return groups
+
+
+def parse_concurrency_limits(value: str = "") -> dict:
+    """
+    Parse the per portal concurrency limits of the config file
+
+    :param value: Comma separated list of profile:limit (e.g. "jack_dangermond:8, enterprise_admin:2")
+    :return: Dictionary of profile -> limit
+    """
+    limits = {}
+    for entry in (value or "").split(","):
+        if not entry.strip():
+            continue
+        profile, separator, limit = entry.rpartition(":")
+        if not separator or not profile.strip():
+            raise ValueError(f"Expected profile:limit, got {entry.strip()}")
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError(f"The limit of {profile.strip()} must be greater than 0")
+        limits[profile.strip()] = limit
+    return limits
+
+
+def sign_in(portals=None, authenticate=None, parallel_authenticate=None) -> list:
+    """
+    Sign in to the portals not signed in yet, all at the same time.  A portal whose sign-in fails is left signed out
+    (its items are not checked, see :func:`check_portals`) and is signed in again by the next call, the other portals
+    are signed in regardless.
+
+    A single portal is signed in from the calling thread with authenticate.  Otherwise each portal is signed in on a
+    thread of its own with parallel_authenticate, within a single "sign_in" span of the calling thread (see
+    :func:`check_portals`).
+
+    :param portals: Iterable of Portal
+    :param authenticate: Callable returning the GIS of a profile, called as authenticate(profile)
+    :param parallel_authenticate: Callable signing in on a thread of its own, defaults to authenticate
+    :return: The portals that could not be signed in
+    """
+    portals = [portal for portal in portals or [] if not portal.signed_in]
+
+    def sign_in_portal(portal, sign_in_profile):
+        try:
+            portal.gis = sign_in_profile(portal.profile)
+        except Exception:
+            print(f"ERROR: Unable to sign in to the {portal.profile} portal\n{traceback.format_exc()}")
+
+    if len(portals) == 1:
+        sign_in_portal(portals[0], authenticate)
+    elif len(portals) > 1:
+        with MetricsUtils.span("sign_in"), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=len(portals),
+                                                      thread_name_prefix="sign-in") as executor:
+            for portal in portals:
+                executor.submit(sign_in_portal, portal, parallel_authenticate or authenticate)
+    return [portal for portal in portals if not portal.signed_in]
+
+
+def check_portals(portals=None, data_model_dict=None, check=None, parallel_check=None) -> list:
+    """
+    Check the items of every portal in parallel.  The items of a portal are split into up to max_concurrency batches
+    checked at the same time, each batch updates the records of its items in place.  The items of a portal not signed
+    in are not checked, and a batch that raises an exception only fails its own items: the other batches are checked
+    regardless.
+
+    A single batch (one portal checked one item at a time) is checked in the calling thread with check.  Otherwise
+    the batches are checked on a thread each with parallel_check, within a single "check_portals" span of the calling
+    thread: the spans and the profiled stages are those of the calling thread (see MetricsUtils), so parallel_check
+    should not open spans of its own.
+
+    :param portals: Dictionary of profile -> Portal
+    :param data_model_dict: The data model of the items to check (item ID -> DataModel.ItemRecord)
+    :param check: Callable checking a batch in the calling thread, called as check(portal, data model of the batch)
+    :param parallel_check: Callable checking a batch on a thread of its own, defaults to check
+    :return: IDs of the items not checked, because their portal is not signed in or their batch failed (the records of
+    a failed batch may be partly updated)
+    """
+    if data_model_dict is None:
+        data_model_dict = {}
+    not_checked = []
+    batches = []
+    for profile, input_items in group_items(record.config for record in data_model_dict.values()).items():
+        portal = portals[profile]
+        if not portal.signed_in:
+            print(f"ERROR: Not signed in to the {profile} portal, its {len(input_items)} items are not checked")
+            not_checked.extend(input_item.id for input_item in input_items)
+            continue
+        batch_count = max(1, min(portal.max_concurrency, len(input_items)))
+        # round robin, so the batches are of the same size
+        for index in range(batch_count):
+            batches.append((portal, {input_item.id: data_model_dict[input_item.id]
+                                     for input_item in input_items[index::batch_count]}))
+    if len(batches) == 1:
+        portal, batch = batches[0]
+        try:
+            check(portal, batch)
+        except Exception:
+            print(f"ERROR: The checks of the {portal.profile} portal failed\n{traceback.format_exc()}")
+            not_checked.extend(batch)
+    elif len(batches) > 1:
+        with MetricsUtils.span("check_portals"), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=len(batches),
+                                                      thread_name_prefix="portal") as executor:
+            futures = [(portal, batch, executor.submit(parallel_check or check, portal, batch))
+                       for portal, batch in batches]
+            concurrent.futures.wait([future for _, _, future in futures])
+        for portal, batch, future in futures:
+            error = future.exception()
+            if error is not None:
+                print(f"ERROR: The checks of the {portal.profile} portal failed\n"
+                      f"{''.join(traceback.format_exception(type(error), error, error.__traceback__))}")
+                not_checked.extend(batch)
+    return not_checked
@@ -0,0 +1,297 @@
+""" Prometheus metrics of the health check, served over HTTP and written for the node_exporter textfile collector """
+import http.server
+import math
+import os
+import threading
+
+# Buckets (seconds) of the service and layer latency histograms
+DEFAULT_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Content type of the text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricFamily:
+    """ A metric and its samples, one per label set """
+    __slots__ = ("name", "type", "help", "buckets", "samples")
+
+    def __init__(self, name: str = "", metric_type: str = "gauge", help_text: str = "", buckets=None):
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.buckets = tuple(buckets or ())
+        # label tuple ((name, value), ...) -> value, or [bucket counts, sum, count] for histograms
+        self.samples = {}
+
+
+class Registry:
+    """
+    The metrics of the health check.  The runs update the metrics and :meth:`publish` them, the HTTP endpoint serves
+    the last published exposition, so a scrape never sees a run half way through its update.
+    """
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+        self._exposition = b""
+
+    def gauge(self, name: str = "", help_text: str = "") -> None:
+        """ Declare a gauge (no-op if already declared) """
+        self._declare(name, "gauge", help_text)
+
+    def counter(self, name: str = "", help_text: str = "") -> None:
+        """ Declare a counter (no-op if already declared) """
+        self._declare(name, "counter", help_text)
+
+    def histogram(self, name: str = "", help_text: str = "", buckets=DEFAULT_LATENCY_BUCKETS) -> None:
+        """ Declare a histogram (no-op if already declared) """
+        self._declare(name, "histogram", help_text, buckets)
+
+    def set(self, name: str = "", value: float = 0, **labels) -> None:
+        """ Set a gauge """
+        with self._lock:
+            self._families[name].samples[_label_key(labels)] = value
+
+    def inc(self, name: str = "", value: float = 1, **labels) -> None:
+        """ Increment a counter """
+        with self._lock:
+            samples = self._families[name].samples
+            key = _label_key(labels)
+            samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name: str = "", value: float = 0, **labels) -> None:
+        """ Add an observation to a histogram """
+        with self._lock:
+            family = self._families[name]
+            sample = family.samples.setdefault(_label_key(labels), [[0] * len(family.buckets), 0.0, 0])
+            for i, upper_bound in enumerate(family.buckets):
+                if value <= upper_bound:
+                    sample[0][i] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def retain(self, name: str = "", label: str = "", values=None) -> None:
+        """ Drop the samples whose `label` is not one of `values` (e.g. items no longer configured) """
+        values = set(values or [])
+        with self._lock:
+            family = self._families.get(name)
+            if family is not None:
+                family.samples = {key: value for key, value in family.samples.items() if dict(key).get(label) in values}
+
+    def render(self) -> str:
+        """ :return: The metrics in the Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            for family in self._families.values():
+                if not family.samples:
+                    continue
+                lines.append(f"# HELP {family.name} {family.help}")
+                lines.append(f"# TYPE {family.name} {family.type}")
+                for key, value in family.samples.items():
+                    if family.type != "histogram":
+                        lines.append(f"{family.name}{_format_labels(key)} {_format_value(value)}")
+                        continue
+                    bucket_counts, total, count = value
+                    for upper_bound, bucket_count in zip(family.buckets, bucket_counts):
+                        bucket_key = key + (("le", _format_value(upper_bound)),)
+                        lines.append(f"{family.name}_bucket{_format_labels(bucket_key)} {bucket_count}")
+                    lines.append(f"{family.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{family.name}_sum{_format_labels(key)} {_format_value(total)}")
+                    lines.append(f"{family.name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def publish(self) -> bytes:
+        """
+        Render the metrics for the endpoint
+        :return: The exposition
+        """
+        self._exposition = self.render().encode("utf-8")
+        return self._exposition
+
+    def exposition(self) -> bytes:
+        """ :return: The last published exposition """
+        return self._exposition
+
+    def _declare(self, name, metric_type, help_text, buckets=None):
+        with self._lock:
+            if name not in self._families:
+                self._families[name] = MetricFamily(name=name, metric_type=metric_type, help_text=help_text,
+                                                    buckets=buckets)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def record_items(registry: Registry = None, items=None, item_ids=None) -> None:
+    """
+    Update the item metrics with the results of the items checked in the run
+    :param registry: The Registry
+    :param items: Iterable of the DataModel.ItemRecord of the items checked (after the status is set)
+    :param item_ids: IDs of all the configured items, the metrics of the other items are dropped
+    """
+    registry.gauge("livefeeds_item_status_code", "Status code of the item (statusCodes.json)")
+    registry.gauge("livefeeds_item_healthy", "1 if the item's status code is 0xx (normal), 0 otherwise")
+    registry.gauge("livefeeds_item_valid", "1 if the item, its service or all its layers are accessible")
+    registry.gauge("livefeeds_item_retries", "Number of retries of the last check of the item's service")
+    registry.gauge("livefeeds_item_service_latency_seconds", "Response time of the item's service in the last check")
+    registry.gauge("livefeeds_item_layers_latency_seconds", "Average response time of the item's layers")
+    registry.gauge("livefeeds_item_feature_count", "Number of features of the item")
+    registry.gauge("livefeeds_item_usage_trend", "Usage trending code (0 no change, 1 up, 2 down)")
+    registry.gauge("livefeeds_item_usage_percent_change", "Change of the item's usage in the last hour, in percent")
+    registry.gauge("livefeeds_item_last_check_timestamp_seconds", "Time of the last check of the item")
+    registry.histogram("livefeeds_service_latency_seconds", "Response times of the services")
+    registry.histogram("livefeeds_layer_latency_seconds", "Response times of the layers")
+    for item in items or []:
+        item_id = item.id
+        status_code = item.status["code"]
+        service_response = item.service_response
+        layers_elapsed_times = [layer["elapsedTime"] for layer in item.layers_elapsed_times]
+        registry.set("livefeeds_item_status_code", int(status_code), item=item_id)
+        registry.set("livefeeds_item_healthy", str(status_code).startswith("0"), item=item_id)
+        registry.set("livefeeds_item_valid", bool(item.item_is_valid), item=item_id, check="item")
+        registry.set("livefeeds_item_valid", bool(service_response["success"]), item=item_id, check="service")
+        registry.set("livefeeds_item_valid", bool(item.all_layers_are_valid), item=item_id, check="layers")
+        registry.set("livefeeds_item_retries", service_response["retryCount"], item=item_id)
+        registry.set("livefeeds_item_service_latency_seconds", service_response["elapsedSeconds"], item=item_id)
+        registry.set("livefeeds_item_layers_latency_seconds",
+                     sum(layers_elapsed_times) / len(layers_elapsed_times) if layers_elapsed_times else 0,
+                     item=item_id)
+        registry.set("livefeeds_item_feature_count", item.feature_count or 0, item=item_id)
+        usage = item.usage or {}
+        if "trendingCode" in usage:
+            registry.set("livefeeds_item_usage_trend", usage["trendingCode"], item=item_id)
+            registry.set("livefeeds_item_usage_percent_change", usage.get("percentChange", 0), item=item_id)
+        registry.set("livefeeds_item_last_check_timestamp_seconds", item.timestamp or 0, item=item_id)
+        if service_response["success"]:
+            registry.observe("livefeeds_service_latency_seconds", service_response["elapsedSeconds"])
+        for elapsed_time in layers_elapsed_times:
+            registry.observe("livefeeds_layer_latency_seconds", elapsed_time)
+    if item_ids is not None:
+        for name in ("livefeeds_item_status_code", "livefeeds_item_healthy", "livefeeds_item_valid",
+                     "livefeeds_item_retries", "livefeeds_item_service_latency_seconds",
+                     "livefeeds_item_layers_latency_seconds", "livefeeds_item_feature_count",
+                     "livefeeds_item_usage_trend", "livefeeds_item_usage_percent_change",
+                     "livefeeds_item_last_check_timestamp_seconds"):
+            registry.retain(name, "item", item_ids)
+
+
+def record_run(registry: Registry = None, run_report=None, queues=None) -> None:
+    """
+    Update the internal metrics with a run's metrics
+    :param registry: The Registry
+    :param run_report: The run's MetricsUtils report
+    :param queues: Dictionary of queue name -> {"size", "highWaterMark"}
+    """
+    registry.counter("livefeeds_runs_total", "Number of runs")
+    registry.gauge("livefeeds_run_duration_seconds", "Duration of the last run")
+    registry.gauge("livefeeds_run_timestamp_seconds", "Start time of the last run")
+    registry.gauge("livefeeds_run_counts", "Counts of the last run (items checked, updated, ...)")
+    registry.gauge("livefeeds_stage_duration_seconds", "Duration of each stage of the last run")
+    registry.counter("livefeeds_requests_total", "Network requests by host and outcome")
+    registry.counter("livefeeds_request_duration_seconds_total", "Time spent in network requests by host")
+    registry.counter("livefeeds_response_bytes_total", "Response bytes by host")
+    registry.counter("livefeeds_errors_total", "Failed requests and failed stages")
+    registry.counter("livefeeds_cache_lookups_total", "Cache lookups by cache and result")
+    registry.gauge("livefeeds_queue_depth", "Number of entries waiting in a queue at the end of the last run")
+    registry.gauge("livefeeds_queue_high_water_mark", "Highest number of entries waiting in a queue")
+
+    registry.inc("livefeeds_runs_total")
+    registry.set("livefeeds_run_duration_seconds", run_report["runSeconds"])
+    registry.set("livefeeds_run_timestamp_seconds", run_report["runStartedOn"])
+    for name, value in run_report["counts"].items():
+        registry.set("livefeeds_run_counts", value, name=name)
+    registry.retain("livefeeds_stage_duration_seconds", "stage", run_report["stages"])
+    for stage, stats in run_report["stages"].items():
+        registry.set("livefeeds_stage_duration_seconds", stats["seconds"], stage=stage)
+    for host, stats in run_report["requests"]["byHost"].items():
+        registry.inc("livefeeds_requests_total", stats["count"] - stats["errors"], host=host, outcome="success")
+        registry.inc("livefeeds_requests_total", stats["errors"], host=host, outcome="error")
+        registry.inc("livefeeds_request_duration_seconds_total", stats["seconds"], host=host)
+        registry.inc("livefeeds_response_bytes_total", stats["bytes"], host=host)
+    for kind, errors in run_report["errors"].items():
+        registry.inc("livefeeds_errors_total", errors, kind=kind)
+    for cache, stats in run_report.get("caches", {}).items():
+        registry.inc("livefeeds_cache_lookups_total", stats["hits"], cache=cache, result="hit")
+        registry.inc("livefeeds_cache_lookups_total", stats["misses"], cache=cache, result="miss")
+    for queue, stats in (queues or {}).items():
+        registry.set("livefeeds_queue_depth", stats.get("size", 0), queue=queue)
+        if "highWaterMark" in stats:
+            registry.set("livefeeds_queue_high_water_mark", stats["highWaterMark"], queue=queue)
+
+
+def write_textfile(registry: Registry = None, path: str = "") -> None:
+    """
+    Write the published metrics for the node_exporter textfile collector.  The file is written under a temporary name
+    and renamed, so the collector never reads a partial file.
+    :param registry: The Registry
+    :param path: Path of the .prom file
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as textfile:
+        textfile.write(registry.exposition())
+    os.replace(temp_path, path)
+
+
+class MetricsServer:
+    """ HTTP endpoint serving the published metrics on /metrics, from a background thread """
+
+    def __init__(self, registry: Registry = None, host: str = "127.0.0.1", port: int = 9464):
+        """
+        :param registry: The Registry
+        :param host: Address to listen on
+        :param port: Port to listen on
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self) -> None:
+        registry = self.registry
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.exposition()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # scrapes are not logged
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        print(f"Serving metrics on http://{self.host}:{self._server.server_port}/metrics")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
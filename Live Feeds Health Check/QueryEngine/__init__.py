@@ -18,9 +18,11 @@ Success -   Obtain feature counts
 Error   -   Use feature counts from previous run (do not over-write data model)
 """
 import concurrent.futures
-import json
+import JsonUtils as JsonUtils
 import math
+import MetricsUtils as MetricsUtils
 import RequestUtils as RequestUtils
+from urllib.parse import urlparse
 
 
 def get_usage_details(data_model=None) -> dict:
@@ -92,17 +94,17 @@ def get_usage_details(data_model=None) -> dict:
         """
         Get the usage detail for a single item
         :param current_item: The current item
-        :return: A response from the usage query
+        :return: The item ID and its record, with the usage statistics
         """
         item_id = current_item[0]
-        item_content = current_item[1]
+        record = current_item[1]
         print(f"\n{item_id}")
-        response = item_content['usage']
 
         try:
-            agol_item = item_content["agolItem"]
+            agol_item = record.agol_item
             if agol_item is not None:
-                usage_data = agol_item.usage(date_range=item_content["usage_data_range"], as_df=False)
+                with MetricsUtils.timed_request(host=urlparse(agol_item._gis.url).netloc):
+                    usage_data = agol_item.usage(date_range=record.config.usage_data_range, as_df=False)
                 if len(usage_data["data"]) > 0:
                     # last hour count (we grab the last full hour)
                     last_hour_count = int(usage_data["data"][0]["num"][-2][1])
@@ -116,20 +118,17 @@ def get_usage_details(data_model=None) -> dict:
                         last_n_hours_count = last_n_hours_count + int(hr[1])
                     # get the average over the last n hours
                     last_n_hours_average = math.trunc(last_n_hours_count / 6)
-                    # determine the trending code
-                    response = get_trending(last_hour_count,
-                                            last_n_hours_count,
-                                            last_n_hours_average,
-                                            int(item_content["percent_lower_bound"]),
-                                            int(item_content["percent_upper_bound"]))
+                    # determine the trending code, otherwise the usage of the previous run is kept
+                    record.usage = get_trending(last_hour_count,
+                                                last_n_hours_count,
+                                                last_n_hours_average,
+                                                record.config.percent_lower_bound,
+                                                record.config.percent_upper_bound)
             else:
                 print(f"ERROR: Unable to retrieve usage details on: {item_id}.")
-                return current_item[0], {**current_item[1], **{"usage": response}}
         except (IndexError, KeyError, TypeError) as e:
             print(f"ERROR: Unable to retrieve usage details on: {item_id}. {e}")
-            return current_item[0], {**current_item[1], **{"usage": response}}
-        else:
-            return current_item[0], {**current_item[1], **{"usage": response}}
+        return current_item
 
     return dict(map(get_usage_detail, data_model.items()))
 
@@ -151,20 +150,16 @@ def get_feature_counts(data_model=None) -> dict:
         """
         item_id = current_item[0]
         print(f"\n{item_id}")
-        item_content = current_item[1]
-        layer_query_params = item_content["layerQueryParams"]
+        record = current_item[1]
+        layer_query_params = record.layer_query_params
         # reset the total feature count for this service
         current_item_feature_count = 0
         #
         elapsed_times = []
         # We check if the service is accessible, not the item
-        if item_content["serviceResponse"]["success"]:
-            exclusion_list_input = item_content["exclusion"].split(",")
-            exclusion_list_input_results = []
-            if isinstance(exclusion_list_input[0], str) and \
-                    len(exclusion_list_input[0]) > 0 and \
-                    len(exclusion_list_input) > 0:
-                exclusion_list_input_results = list(map(int, exclusion_list_input))
+        if record.service_response["success"]:
+            # IDs of the layers excluded from the count
+            exclusion_list_input_results = record.config.exclusion
 
             for layer in layer_query_params:
                 if "layerId" in layer:
@@ -175,7 +170,7 @@ def get_feature_counts(data_model=None) -> dict:
                         if validated_layer["success"]:
                             print(f"Success\t{current_item[0]}\t{layer['layerName']}")
                             if layer["layerId"] not in exclusion_list_input_results:
-                                count_dict = json.loads(validated_layer["response"].content.decode('utf-8'))
+                                count_dict = JsonUtils.loads(validated_layer["response"].content)
                                 if "count" in count_dict:
                                     print(f"Feature count: {count_dict['count']}")
                                     current_item_feature_count += count_dict["count"]
@@ -194,13 +189,10 @@ def get_feature_counts(data_model=None) -> dict:
                         print(f"")
         else:
             # The service is not valid or inaccessible, use the cached feature count
-            if "featureCount" in item_content:
-                current_item_feature_count = item_content["featureCount"]
-        return current_item[0], {
-            **current_item[1],
-            **{"featureCount": current_item_feature_count},
-            **{"serviceLayersElapsedTimes": elapsed_times}
-        }
+            current_item_feature_count = record.feature_count
+        record.feature_count = current_item_feature_count
+        record.layers_elapsed_times = elapsed_times
+        return current_item
 
     def check_layer_url(layer=None) -> dict:
         """ Check that the Item's url is valid """
@@ -286,7 +278,7 @@ def process_alfp_response(alfp_response=None) -> dict:
     if alfp_response["response"]["success"]:
         item_id = alfp_response["id"]
         if alfp_response["response"]["response"].status_code == 200:
-            content = json.loads(alfp_response["response"]["response"].content.decode('utf-8'))
+            content = JsonUtils.loads(alfp_response["response"]["response"].content)
             return {
                 "id": item_id,
                 "content": content,
@@ -1,73 +1,149 @@
 """ Utility methods for working with RSS """
+import concurrent.futures
+import concurrent.futures.process
 import html
+import io
 import os
+import string
 import FileManager as FileManager
+import JsonUtils as JsonUtils
 import TimeUtils as TimeUtils
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape as xml_escape, quoteattr
+
+# Template fields that are filled in at run time rather than from the config file
+RUNTIME_FIELDS = frozenset([
+    "adminComments",
+    "id",
+    "lastBuildTime",
+    "pubDate",
+    "pubEventDate",
+    "rss_items",
+    "snippet",
+    "status",
+    "title"
+])
+
+# Maximum number of rendered comment sections kept in memory
+COMMENTS_CACHE_SIZE = 1024
+
+# Placeholder of the item nodes in the channel template
+RSS_ITEMS_PLACEHOLDER = "{rss_items}"
+
+# Batches of feeds smaller than this are rendered in the current process, as starting a process pool costs more than
+# rendering a handful of feeds
+DEFAULT_MIN_PARALLEL_BATCH = 16
+
+# The RSS object used by each process of the process pool
+_worker_rss = None
+
+
+class TemplateFieldError(Exception):
+    """Exception raised when a template references fields that will not be available when it is rendered
+
+        Attributes:
+            template -- path to the template
+            fields -- the missing fields
+    """
+
+    def __init__(self, template, fields):
+        self.template = template
+        self.fields = fields
+
+    def __str__(self):
+        return f"\nThe template {self.template} references unknown fields: {', '.join(sorted(self.fields))}"
 
 
 class RSS:
     """
+    Renders the RSS files of the items.
 
+    Both templates are read once, with their newlines removed, and their fields are parsed up front so that fields
+    that are not available can be reported before anything is rendered.
+
+    In incremental mode, adding an event to an existing RSS file only renders the new item node and splices it into
+    the existing document (see :meth:`splice_item_node`), instead of re-rendering every event in the history.
     """
 
-    def __init__(self, rss_template, item_template):
+    def __init__(self, rss_template, item_template, precompress=False, known_fields=None, incremental=False):
         """
 
-        :param rss_template:
-        :param item_template:
+        :param rss_template: Path to the channel template
+        :param item_template: Path to the item template
+        :param precompress: Write pre-compressed (.gz/.br) siblings of each RSS file
+        :param known_fields: Names of the fields available from the config file.  If provided, the templates are
+        checked against them (and the run time fields) and a TemplateFieldError is raised for any unknown field.
+        :param incremental: Splice new item nodes into existing RSS files rather than re-rendering them
         """
         self.rss_template = os.path.realpath(rss_template)
         self.item_template = os.path.realpath(item_template)
+        self.precompress = precompress
+        self.incremental = incremental
+        self.rss_template_text = _load_template(self.rss_template)
+        self.item_template_text = _load_template(self.item_template)
+        self.rss_fields = _parse_fields(self.rss_template_text)
+        self.item_fields = _parse_fields(self.item_template_text)
+        # the channel template before and after the item nodes, None if it cannot be split
+        self.rss_head_text = None
+        self.rss_tail_text = None
+        if self.rss_template_text.count(RSS_ITEMS_PLACEHOLDER) == 1:
+            self.rss_head_text, self.rss_tail_text = self.rss_template_text.split(RSS_ITEMS_PLACEHOLDER)
+        self.incremental_updates = 0
+        self.full_updates = 0
+        # hash of (comments header, comments) -> escaped comments section
+        self._comments_cache = {}
+        self.comments_cache_hits = 0
+        self.comments_cache_misses = 0
+        # process pool of update_rss_feeds, started by the first batch large enough and kept until close() (the
+        # processes are bound to the templates), and its number of processes
+        self._executor = None
+        self._executor_workers = 0
+        if known_fields is not None:
+            known_fields = RUNTIME_FIELDS.union(known_fields)
+            for template, fields in ((self.rss_template, self.rss_fields), (self.item_template, self.item_fields)):
+                missing_fields = fields - known_fields
+                if len(missing_fields) > 0:
+                    raise TemplateFieldError(template, missing_fields)
 
-    def build_item_nodes(self, input_data=None, events_file=None):
+    def build_item_nodes(self, input_data=None, events_file=None, history=None):
         """
 
         :param input_data:
-        :param events_file:
+        :param events_file: The events file, only read if no history is passed in
+        :param history: The item's events (e.g. the EventHistory returned by EventsManager)
         :return:
         """
-        # JSON from events file
-        status_history_json = FileManager.open_file(path=events_file)
-        # history element
-        history = status_history_json["history"]
-        # comments
-        comments = ""
-        #
-        items = []
-        # build RSS file
+        if history is None:
+            # JSON from events file
+            status_history_json = FileManager.open_file(path=events_file)
+            # history element
+            history = status_history_json["history"]
+        # one working copy of the data model for all the events, rather than one per event
+        fields = dict(input_data)
+        items = io.StringIO()
         for event in history:
-            # store the admin comments
-            admin_comments = ""
-            # comments section
-            comments_section = ""
-            # sort the comments in the comments section in reverse order by time
-            sorted_comments = sorted(event["comments"], key=lambda k: k["timestamp"], reverse=True)
-            # If there are comments, build the section that will be included in the rss output
-            if len(sorted_comments) > 0:
-                for sorted_comment in sorted_comments:
-                    comment = sorted_comment["comment"]
-                    comment_timestamp = TimeUtils.convert_from_utc_to_datetime(
-                        sorted_comment["timestamp"]).strftime("%a, %d %b %Y %H:%M:%S")
-                    admin_comments += "<li>" + f"Posted: {comment_timestamp} | <b>{comment}</b>" + "</li>"
-                comments_section = "<h4>" + input_data["rss_comments_header"] + "</h4>" + admin_comments
-            comments = comments + comments_section
-
-            # Hydrate the data model to include the comments
-            input_data.update({
-                "adminComments": html.escape(comments_section),
-                "lastBuildTime": event["lastBuildTime"],
-                "pubDate": event["pubDate"],
-                "pubEventDate": event["pubEventDate"],
-                "status": event["status"]
-            })
+            items.write(self._render_item(fields, event))
+        return items.getvalue()
+
+    def render_item(self, input_data=None, event=None) -> str:
+        """
+        Render the item node of a single event.
+
+        :param input_data: The item's data model
+        :param event: The event
+        :return: The item node
+        """
+        return self._render_item(dict(input_data), event)
 
-            # Open the RSS item template.
-            # Create the item nodes that will ultimately hydrate the main rss template
-            with open(self.item_template, "r") as file:
-                data = file.read().replace("\n", "")
-                items.append(data.format_map(input_data))
-        return "".join(items)
+    def render_channel(self, input_data=None) -> str:
+        """
+        Render the RSS document.
+
+        :param input_data: The item's data model, including the rendered "rss_items"
+        :return: The RSS document
+        """
+        return self.rss_template_text.format_map(input_data)
 
     def update_rss_contents(self, input_data=None, rss_file=None):
         """
@@ -76,11 +152,331 @@ class RSS:
         :param rss_file:
         :return:
         """
-        # Open the RSS main template
-        with open(self.rss_template, "r") as file:
-            data = file.read().replace("\n", "")
-            output_file_contents = data.format_map(input_data)
-
         # Over-write to an existing or new file
-        with open(rss_file, "w+") as file:
-            file.write(output_file_contents)
+        FileManager.write_text(rss_file, self.render_channel(input_data), self.precompress)
+
+    def _render_item(self, fields=None, event=None) -> str:
+        # fields is a working copy of the data model, hydrate it with the event
+        fields.update({
+            "adminComments": self.get_comments_section(fields["rss_comments_header"], event["comments"]),
+            "lastBuildTime": event["lastBuildTime"],
+            "pubDate": event["pubDate"],
+            "pubEventDate": event["pubEventDate"],
+            "status": event["status"]
+        })
+        return self.item_template_text.format_map(fields)
+
+    def update_rss_feed(self, input_data=None, rss_file=None, history=None) -> None:
+        """
+        Update an item's RSS file after an event was appended to its history.  In incremental mode the new item node
+        is spliced into the existing file, otherwise (or if the file cannot be spliced) the whole file is re-rendered.
+
+        :param input_data: The item's data model
+        :param rss_file: Path to the RSS file
+        :param history: The item's events, the newest event last
+        :return: None
+        """
+        self.update_rss_feeds(feeds=[(input_data, rss_file, history)], max_workers=1)
+
+    def update_rss_feeds(self, feeds=None, max_workers: int = None, min_batch: int = DEFAULT_MIN_PARALLEL_BATCH):
+        """
+        Update a batch of RSS files (see :meth:`update_rss_feed`).  Large batches are rendered on a process pool, the
+        files are written in the order of the batch regardless of which process rendered them.  The pool is kept for
+        the next batches (e.g. the next runs in daemon mode) until :meth:`close`.
+
+        :param feeds: List of (input data, RSS file path, history) tuples
+        :param max_workers: Maximum number of processes, defaults to the number of cores
+        :param min_batch: Batches smaller than this are rendered in the current process
+        :return: None
+        """
+        if feeds is None:
+            feeds = []
+        if max_workers is None or max_workers < 1:
+            max_workers = os.cpu_count() or 1
+        # only the template fields of the data model are sent to the pool
+        jobs = [(self.template_data(input_data),
+                 FileManager.read_text(rss_file) if self.incremental else None,
+                 list(history)) for input_data, rss_file, history in feeds]
+        results = None
+        if max_workers > 1 and len(jobs) >= max(min_batch, 2):
+            executor = self._get_executor(max_workers)
+            print(f"Rendering {len(jobs)} RSS feeds on {max_workers} processes")
+            try:
+                # map() returns the results in the order of the jobs
+                results = list(executor.map(_render_feed_job, jobs,
+                                            chunksize=max(1, len(jobs) // (max_workers * 4))))
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # a process died, render the batch here and start a new pool for the next one
+                print(f"ERROR: The RSS render processes stopped ({e}), rendering in the current process")
+                self.close()
+        if results is None:
+            results = [self.render_feed(*job) for job in jobs]
+        for (_, rss_file, _), (output_file_contents, incremental) in zip(feeds, results):
+            if incremental:
+                self.incremental_updates += 1
+            else:
+                self.full_updates += 1
+            FileManager.write_text(rss_file, output_file_contents, self.precompress)
+
+    def close(self) -> None:
+        """ Stop the process pool, if one was started """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            self._executor_workers = 0
+
+    def _get_executor(self, max_workers: int = 1):
+        if self._executor is not None and self._executor_workers != max_workers:
+            self.close()
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                                    initializer=_init_render_worker,
+                                                                    initargs=(self.rss_template,
+                                                                              self.item_template,
+                                                                              self.incremental))
+            self._executor_workers = max_workers
+        return self._executor
+
+    def render_feed(self, input_data=None, document=None, history=None) -> tuple:
+        """
+        Render an item's RSS document, splicing the newest event into the existing document when possible.
+
+        :param input_data: The item's data model
+        :param document: The existing RSS document, None to always render the whole document
+        :param history: The item's events, the newest event last
+        :return: (RSS document, True if it was spliced incrementally)
+        """
+        if self.incremental and document is not None:
+            output_file_contents = self.splice_item_node(input_data=input_data, document=document, history=history)
+            if output_file_contents is not None:
+                return output_file_contents, True
+        return self.render_channel({
+            **input_data,
+            **{"rss_items": self.build_item_nodes(input_data=input_data, history=history)}
+        }), False
+
+    def template_data(self, input_data=None) -> dict:
+        """
+        Return the part of the data model the templates use.
+
+        :param input_data: The item's data model
+        :return: Dictionary of the template fields
+        """
+        fields = self.rss_fields.union(self.item_fields, ["rss_comments_header"])
+        options = input_data["config"].options
+        return {key: input_data[key] if key in input_data else options[key]
+                for key in fields if key in input_data or key in options}
+
+    def splice_item_node(self, input_data=None, document: str = "", history=None):
+        """
+        Render only the newest event's item node and splice it into an existing RSS document.  Item nodes of events
+        no longer in the history (expired or over the maximum number of events) are removed and the channel is
+        re-rendered with the current lastBuildDate.  The result is identical to a full render of the history.
+
+        The existing document is located by rendering the oldest event still in the history; everything before that
+        node is dropped.  If it cannot be found, or the number of item nodes does not match the history, None is
+        returned and the caller should fall back to a full render.
+
+        :param input_data: The item's data model
+        :param document: The existing RSS document
+        :param history: The item's events, the newest event last
+        :return: The updated RSS document, or None
+        """
+        if self.rss_head_text is None or len(history) == 0:
+            return None
+        kept_items = ""
+        if len(history) > 1:
+            # the item node of the oldest event kept, exactly as it was rendered the last time
+            oldest_item = self.render_item(input_data=input_data, event=history[0])
+            start = document.find(oldest_item)
+            end = document.rfind("</item>") + len("</item>")
+            if start < 0 or end < start:
+                return None
+            kept_items = document[start:end]
+            if kept_items.count("</item>") != len(history) - 1:
+                return None
+        return self.rss_head_text.format_map(input_data) + \
+            kept_items + \
+            self.render_item(input_data=input_data, event=history[-1]) + \
+            self.rss_tail_text.format_map(input_data)
+
+    def get_comments_section(self, comments_header: str = "", comments=None) -> str:
+        """
+        Return the escaped administrator comments section of an item node.  Sections are cached by the serialized
+        header and comments, as the same comments appear in every event of an item.
+
+        :param comments_header: The comments header (rss_comments_header)
+        :param comments: List of comments
+        :return: The escaped comments section
+        """
+        key = JsonUtils.dumps([comments_header, comments])
+        comments_section = self._comments_cache.get(key)
+        if comments_section is not None:
+            self.comments_cache_hits += 1
+            return comments_section
+        self.comments_cache_misses += 1
+        # store the admin comments
+        admin_comments = ""
+        # comments section
+        comments_section = ""
+        # sort the comments in the comments section in reverse order by time
+        sorted_comments = sorted(comments, key=lambda k: k["timestamp"], reverse=True)
+        # If there are comments, build the section that will be included in the rss output
+        if len(sorted_comments) > 0:
+            for sorted_comment in sorted_comments:
+                comment = sorted_comment["comment"]
+                comment_timestamp = TimeUtils.convert_from_utc_to_datetime(
+                    sorted_comment["timestamp"]).strftime("%a, %d %b %Y %H:%M:%S")
+                admin_comments += "<li>" + f"Posted: {comment_timestamp} | <b>{comment}</b>" + "</li>"
+            comments_section = "<h4>" + comments_header + "</h4>" + admin_comments
+        comments_section = html.escape(comments_section)
+        if len(self._comments_cache) >= COMMENTS_CACHE_SIZE:
+            self._comments_cache.clear()
+        self._comments_cache[key] = comments_section
+        return comments_section
+
+
+def _init_render_worker(rss_template, item_template, incremental):
+    """ Process pool initializer, load the templates once per process """
+    global _worker_rss
+    _worker_rss = RSS(rss_template, item_template, incremental=incremental)
+
+
+def _render_feed_job(job):
+    """ Render a feed in a process pool process, job is a tuple of the arguments of RSS.render_feed """
+    return _worker_rss.render_feed(*job)
+
+
+def _load_template(path: str = "") -> str:
+    """
+    Read a template and remove its newlines
+    :param path: Path to the template
+    :return: The template text
+    """
+    with open(path, "r") as file:
+        return file.read().replace("\n", "")
+
+
+def _parse_fields(template_text: str = "") -> frozenset:
+    """
+    Return the names of the top-level fields referenced by a template (e.g. "status" for "{status[code]}")
+    :param template_text: The template text
+    :return: Set of field names
+    """
+    fields = set()
+    for _, field_name, _, _ in string.Formatter().parse(template_text):
+        if field_name:
+            fields.add(field_name.split("[", 1)[0].split(".", 1)[0])
+    return frozenset(fields)
+
+
+class AggregateFeed:
+    """
+    A single feed covering the recent events of all the items, written as RSS 2.0, Atom and JSON Feed.
+
+    The events are consumed in one pass (e.g. streamed from the event log) and all three formats are rendered together,
+    newest event first.  The feed dates come from the newest event rather than the run time, so the files only change,
+    and are only re-written, when an event is added or removed.
+    """
+
+    def __init__(self, settings=None, output_dir: str = "", precompress: bool = False):
+        """
+        :param settings: The [DEFAULT] options of the config file (aggregate_feed_* and rss_* options)
+        :param output_dir: Folder the feeds are written to
+        :param precompress: Write pre-compressed (.gz/.br) siblings of each file
+        """
+        if settings is None:
+            settings = {}
+        self.settings = settings
+        self.max_events = int(settings.get("aggregate_feed_max_events") or 200)
+        self.precompress = precompress
+        file_name = settings.get("aggregate_feed_file_name") or "all"
+        self.rss_file = os.path.join(output_dir, file_name + ".rss")
+        self.atom_file = os.path.join(output_dir, file_name + ".atom")
+        self.json_file = os.path.join(output_dir, file_name + ".json")
+
+    def write(self, events=None) -> dict:
+        """
+        Render and write the feeds.
+
+        :param events: Iterable of events, oldest first, each with the item ID in its "id" property
+        :return: Dictionary of path -> True if the file was written, False if it was unchanged
+        """
+        # single pass over the events, keeping only the most recent ones
+        recent_events = deque(events or [], maxlen=self.max_events)
+        title = xml_escape(self.settings.get("aggregate_feed_title", ""))
+        description = xml_escape(self.settings.get("aggregate_feed_description", ""))
+        # Atom requires an author, of the feed or of every entry
+        author = xml_escape(self.settings.get("aggregate_feed_author") or self.settings.get("aggregate_feed_title")
+                            or "Live Feeds Health Check")
+        link = self.settings.get("rss_item_link", "")
+        updated = recent_events[-1]["pubEventDate"] if len(recent_events) > 0 else 0
+
+        rss_items = io.StringIO()
+        atom_entries = io.StringIO()
+        json_items = []
+        for event in reversed(recent_events):
+            item_id = event.get("id", "")
+            details = (event.get("status") or {}).get("statusDetails") or {}
+            item_title = f"{event.get('title') or item_id}: {details.get('Status', '')}"
+            summary = details.get("Comment", "")
+            item_url = self.settings.get("rss_item_agol_url", "") + item_id
+            guid = f"{item_id}.{event['pubEventDate']}"
+            published = _to_rfc3339(event["pubEventDate"])
+            rss_items.write(f"<item><title>{xml_escape(item_title)}</title><link>{xml_escape(item_url)}</link>"
+                            f"<description>{xml_escape(summary)}</description><pubDate>{event['pubDate']}</pubDate>"
+                            f"<guid isPermaLink=\"false\">{guid}</guid></item>")
+            atom_entries.write(f"<entry><title>{xml_escape(item_title)}</title><link href={quoteattr(item_url)}/>"
+                               f"<id>urn:livefeeds:{guid}</id><updated>{published}</updated>"
+                               f"<summary>{xml_escape(summary)}</summary></entry>")
+            json_items.append({
+                "id": guid,
+                "url": item_url,
+                "title": item_title,
+                "content_text": summary,
+                "date_published": published,
+                "tags": [(event.get("status") or {}).get("code", "")]
+            })
+
+        rss_document = "<?xml version=\"1.0\" encoding=\"UTF-8\"?><rss version=\"2.0\"><channel>" \
+                       f"<title>{title}</title><link>{xml_escape(link)}</link>" \
+                       f"<description>{description}</description>" \
+                       f"<lastBuildDate>{_to_rfc822(updated)}</lastBuildDate>" \
+                       f"<ttl>{self.settings.get('rss_ttl', '')}</ttl>{rss_items.getvalue()}</channel></rss>"
+        atom_document = "<?xml version=\"1.0\" encoding=\"UTF-8\"?><feed xmlns=\"http://www.w3.org/2005/Atom\">" \
+                        f"<title>{title}</title><subtitle>{description}</subtitle>" \
+                        f"<link href={quoteattr(link)}/><id>urn:livefeeds:aggregate</id>" \
+                        f"<updated>{_to_rfc3339(updated)}</updated><author><name>{author}</name></author>" \
+                        f"{atom_entries.getvalue()}</feed>"
+        json_document = JsonUtils.dumps({
+            "version": "https://jsonfeed.org/version/1.1",
+            "title": self.settings.get("aggregate_feed_title", ""),
+            "description": self.settings.get("aggregate_feed_description", ""),
+            "home_page_url": link,
+            "items": json_items
+        })
+        return {
+            self.rss_file: self._write_if_changed(self.rss_file, rss_document),
+            self.atom_file: self._write_if_changed(self.atom_file, atom_document),
+            self.json_file: self._write_if_changed(self.json_file, json_document)
+        }
+
+    def _write_if_changed(self, path: str = "", contents: str = "") -> bool:
+        # the documents declare UTF-8, they are written (and pre-compressed) as UTF-8 whatever the preferred encoding
+        if FileManager.check_file_exist_by_pathlib(path):
+            try:
+                if FileManager.read_text(path, encoding="utf-8") == contents:
+                    return False
+            except UnicodeDecodeError:
+                # written in the preferred encoding by an earlier version
+                pass
+        FileManager.write_text(path, contents, self.precompress, encoding="utf-8")
+        return True
+
+
+def _to_rfc822(timestamp=0) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%a, %d %b %Y %H:%M:%S +0000")
+
+
+def _to_rfc3339(timestamp=0) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,96 @@
+"""
+Benchmark the rendering of an RSS feed from a synthetic event history
+
+    python -m RSSManager [number of events]
+"""
+import configparser
+import html
+import os
+import sys
+import time
+import RSSManager as RSSManager
+import TimeUtils as TimeUtils
+
+
+def _render_uncached(rss_template, item_template, input_data, history):
+    """ Render the feed the way it was done before the templates were cached (templates read once per event) """
+    items = []
+    for event in history:
+        admin_comments = ""
+        comments_section = ""
+        sorted_comments = sorted(event["comments"], key=lambda k: k["timestamp"], reverse=True)
+        if len(sorted_comments) > 0:
+            for sorted_comment in sorted_comments:
+                comment_timestamp = TimeUtils.convert_from_utc_to_datetime(
+                    sorted_comment["timestamp"]).strftime("%a, %d %b %Y %H:%M:%S")
+                admin_comments += "<li>" + f"Posted: {comment_timestamp} | <b>{sorted_comment['comment']}</b>" + "</li>"
+            comments_section = "<h4>" + input_data["rss_comments_header"] + "</h4>" + admin_comments
+        input_data.update({
+            "adminComments": html.escape(comments_section),
+            "lastBuildTime": event["lastBuildTime"],
+            "pubDate": event["pubDate"],
+            "pubEventDate": event["pubEventDate"],
+            "status": event["status"]
+        })
+        with open(item_template, "r") as file:
+            items.append(file.read().replace("\n", "").format_map(input_data))
+    input_data.update({"rss_items": "".join(items)})
+    with open(rss_template, "r") as file:
+        return file.read().replace("\n", "").format_map(input_data)
+
+
+def main():
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeat = 20
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    rss_template = os.path.join(root_dir, "rss_template.xml")
+    item_template = os.path.join(root_dir, "rss_item_template.xml")
+
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(root_dir, "config.ini"), encoding="latin-1")
+    input_data = {
+        **dict(parser.defaults()),
+        **{
+            "id": "248e7b5827a34b248647afb012c58787",
+            "title": "Active Hurricanes, Cyclones and Typhoons",
+            "snippet": "Synthetic item",
+            "lastBuildTime": "Thu, 04 Feb 2021 13:35:13 +0000"
+        }
+    }
+    status = {
+        "code": "000",
+        "statusDetails": {"Status": "Normal", "Comment": "Service and updates are operating normally."}
+    }
+    comments = [{"comment": "Planned maintenance starting today!", "timestamp": 1602762302}]
+    history = [{
+        "pubDate": "Thu, 04 Feb 2021 13:35:20 +0000",
+        "pubEventDate": 1612467313 + i,
+        "comments": comments,
+        "lastBuildTime": "Thu, 04 Feb 2021 13:35:13 +0000",
+        "status": status
+    } for i in range(n_events)]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = _render_uncached(rss_template, item_template, dict(input_data), history)
+    uncached = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    rss = RSSManager.RSS(rss_template, item_template, known_fields=input_data.keys())
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        output = rss.render_channel({**input_data, **{"rss_items": rss.build_item_nodes(input_data, history=history)}})
+    cached = (time.perf_counter() - start) / repeat
+
+    print(f"Events per feed: {n_events}")
+    print(f"Output identical: {output == expected}")
+    print(f"Template load and parse (once): {load_time * 1000:.2f} ms")
+    print(f"Per-feed render, templates read per event: {uncached * 1000:.2f} ms")
+    print(f"Per-feed render, cached templates: {cached * 1000:.2f} ms")
+    print(f"Speedup: {uncached / cached:.1f}x")
+    print(f"Comment section cache: {rss.comments_cache_hits} hits, {rss.comments_cache_misses} misses")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,29 @@
 """ """
-import arcgis
 import dump as dump
 import json
+import MetricsUtils as MetricsUtils
 import re
 import requests
 import threading
+import time
 from requests import Session
 from RetryUtils import retry
 from RetryUtils import get_retry_output
-from urllib.parse import urlencode
+from RetryUtils import request_item
+from requests.adapters import DEFAULT_POOLSIZE
+from urllib.parse import urlencode, urlparse
 
 
 # debugging flag
 DEBUG = False
 
+# Sessions kept open between requests, so the connections to each host are reused by all the items on the host
+# (host, retries, timeout) -> session
+_sessions = {}
+_sessions_lock = threading.Lock()
+# Maximum number of connections kept open per host and session (see set_pool_size)
+_pool_size = DEFAULT_POOLSIZE
+
 # TODO: Remove strings
 ERROR_CODES = {
     "HTTPError": {
@@ -45,6 +55,54 @@ def _format_url(url):
     return url
 
 
+def _get_session(host: str = "", retries: int = 5, timeout: int = 5) -> Session:
+    """
+    Return the session used for the requests to a host, creating it on first use.
+    :param host: The host (and port)
+    :param retries: Maximum number of retries
+    :param timeout: Timeout (in seconds)
+    :return: Session
+    """
+    key = (host, retries, timeout)
+    with _sessions_lock:
+        current_session = _sessions.get(key)
+        MetricsUtils.record_cache(name="httpSessions", hit=current_session is not None)
+        if current_session is None:
+            # The Session object allows you to persist certain parameters across requests.
+            # It also persists cookies across all requests made from the Session instance, and keeps the connections
+            # open (connection pooling)
+            session = requests.Session()
+            current_session = retry(session, retries=retries, backoff_factor=0.2, timeout=timeout,
+                                    pool_maxsize=_pool_size)
+            _sessions[key] = current_session
+    return current_session
+
+
+def set_pool_size(pool_size: int = DEFAULT_POOLSIZE):
+    """
+    Set the maximum number of connections kept open per host, e.g. to the number of items checked at the same time.
+    The open sessions are closed when the size changes, the next requests open new ones.
+    :param pool_size: Number of connections, at least DEFAULT_POOLSIZE (10)
+    :return: None
+    """
+    global _pool_size
+    pool_size = max(DEFAULT_POOLSIZE, pool_size)
+    if pool_size != _pool_size:
+        close_sessions()
+        _pool_size = pool_size
+
+
+def close_sessions():
+    """
+    Close the sessions (and their pooled connections)
+    :return: None
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
 def check_request(path: str = "", params=None, **kwargs) -> dict:
     """
     Make a request and return a dictionary indicating success, failure, and the response object
@@ -94,16 +152,16 @@ def check_request(path: str = "", params=None, **kwargs) -> dict:
     response_dict.setdefault("response", {})
     response_dict.setdefault("retryCount", {})
 
+    request_started = time.perf_counter()
+    response_size = 0
     try:
         print(f"\nChecking URL: {url}")
         print(f"--- parameters (RequestUtils) ---")
         print(f"retry: {retries}")
         print(f"timeout: {timeout}\n")
-        # The Session object allows you to persist certain parameters across requests.
-        # It also persists cookies across all requests made from the Session instance
-        session = requests.Session()
-        current_session = retry(session, retries=retries, backoff_factor=0.2, id=item_id, timeout=timeout)
-        response = current_session.get(url, timeout=timeout)
+        current_session = _get_session(urlparse(path).netloc, retries, timeout)
+        with request_item(item_id):
+            response = current_session.get(url, timeout=timeout)
     except requests.exceptions.HTTPError as http_error:
         response_dict["error_message"].append(ERROR_CODES["HTTPError"])
         response_dict["error_message"].append(http_error)
@@ -122,11 +180,16 @@ def check_request(path: str = "", params=None, **kwargs) -> dict:
     else:
         response_dict["success"] = True
         response_dict["response"] = response
+        response_size = len(response.content)
         if DEBUG:
             data = dump.dump_response(response)
             print(data.decode('utf-8'))
             print("------------------------------------------------------------------\n")
     finally:
+        MetricsUtils.record_request(host=urlparse(path).netloc,
+                                    seconds=time.perf_counter() - request_started,
+                                    size=response_size,
+                                    success=response_dict["success"])
         tmp_retry_output = get_retry_output()
         retry_count = {}
         for rc in tmp_retry_output:
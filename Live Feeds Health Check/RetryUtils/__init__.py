@@ -1,9 +1,11 @@
 """ """
+import contextlib
+import threading
 from datetime import datetime, timedelta
 from typing import Optional, Tuple, TypeVar, Union
 
 import requests
-from requests.adapters import HTTPAdapter
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 from urllib3 import Retry
 
 import http.client
@@ -20,6 +22,21 @@ T = TypeVar("T", bound=requests.Session)
 
 retry_output = []
 
+# The item of the request being made by each thread, the sessions are shared by the items of a host so the retries are
+# attributed to the item of the request rather than to the session
+_request_item = threading.local()
+
+
+@contextlib.contextmanager
+def request_item(item_id=None):
+    """ Attribute the retries of the requests made in the block (by the calling thread) to the item """
+    previous_item_id = getattr(_request_item, "id", None)
+    _request_item.id = item_id
+    try:
+        yield
+    finally:
+        _request_item.id = previous_item_id
+
 
 def _patch_send():
     """ Debugging: Represents one transaction with an HTTP server """
@@ -101,13 +118,18 @@ class CallbackRetry(Retry):
         return super(CallbackRetry, self).new(**kw)
 
     def increment(self, method, url, *args, **kwargs):
-        self._counter += 1
+        # the Retry object mounted on a session is shared by all of its requests, leave it untouched and only pass the
+        # count on to the new Retry object
+        counter = self._counter + 1
         if self._callback:
             try:
-                self._callback(url, self._id, self._counter, self._start_time)
+                item_id = getattr(_request_item, "id", None)
+                self._callback(url, self._id if item_id is None else item_id, counter, self._start_time)
             except Exception:
                 print("Callback raised an exception, ignoring")
-        return super(CallbackRetry, self).increment(method, url, *args, **kwargs)
+        new_retry = super(CallbackRetry, self).increment(method, url, *args, **kwargs)
+        new_retry._counter = counter
+        return new_retry
 
 
 def retry_callback(url, item_id, counter, start_time):
@@ -129,6 +151,11 @@ def get_retry_output():
     return retry_output
 
 
+def clear_retry_output():
+    """ Forget the retry counts of the previous run """
+    retry_output.clear()
+
+
 def retry(
         session: Optional[T] = None,
         retries: int = 3,
@@ -163,6 +190,8 @@ def retry(
     """
     item_id = kwargs.pop("id", False)
     timeout = kwargs.pop("timeout", False)
+    # maximum number of connections kept open per host
+    pool_maxsize = kwargs.pop("pool_maxsize", DEFAULT_POOLSIZE)
 
     session = session or RetrySession()
 
@@ -196,5 +225,5 @@ def retry(
         # server. By default, Requests does not retry failed connections. For more granular control over the conditions
         # under which we retry a request, I import urllib3’s Retry class and pass that instead (as recommended by the
         # documentation for the HTTPAdapter).
-        session.mount(prefix, HTTPAdapter(max_retries=max_retry_count))
+        session.mount(prefix, HTTPAdapter(max_retries=max_retry_count, pool_maxsize=pool_maxsize))
     return session
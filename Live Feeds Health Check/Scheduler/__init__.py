@@ -0,0 +1,248 @@
+""" Scheduling of the health check when the script runs as a long-running daemon """
+import heapq
+import os
+import signal
+import threading
+import time
+import traceback
+
+# Default number of minutes between the start of two runs
+DEFAULT_INTERVAL_MINUTES = 5
+
+# Default number of seconds between two checks of the watched files
+DEFAULT_POLL_SECONDS = 5
+
+
+class Daemon:
+    """
+    Run a task on a fixed schedule until stopped.
+
+    Runs start every `interval` seconds measured from the start of the previous run.  A run that takes longer than the
+    interval is followed immediately by the next one (missed runs are not queued up).  With `next_due` (e.g.
+    :meth:`CheckPlanner.next_due`), the next run starts as soon as the next item is due if that comes first; items
+    already overdue after a run (left over by the request budget) wait for the interval.  While waiting, the watched
+    files are checked for changes and the reload callback is invoked when any of them is modified.  An exception raised
+    by a run or a reload is printed and the daemon carries on with the previous state.
+    """
+
+    def __init__(self, run=None, interval: float = DEFAULT_INTERVAL_MINUTES * 60, watched_files=None, reload=None,
+                 poll_interval: float = DEFAULT_POLL_SECONDS, next_due=None):
+        """
+        :param run: Callable running one check
+        :param interval: Seconds between the start of two runs
+        :param watched_files: Callable returning the paths of the files that trigger a reload when modified
+        :param reload: Callable reloading the configuration
+        :param poll_interval: Seconds between two checks of the watched files
+        :param next_due: Callable returning the time (seconds since epoch) the next item is due, None if unknown
+        """
+        self.run = run
+        self.interval = interval
+        self.watched_files = watched_files or (lambda: [])
+        self.reload = reload
+        self.poll_interval = poll_interval
+        self.next_due = next_due
+        self.run_count = 0
+        self.reload_count = 0
+        self.last_run_seconds = 0
+        self._stop_event = threading.Event()
+        self._mtimes = {}
+
+    def start(self) -> None:
+        """ Run the task on schedule, blocks until :meth:`stop` is called (or SIGINT/SIGTERM is received) """
+        self._install_signal_handlers()
+        self._mtimes = self._get_mtimes()
+        next_run = time.monotonic()
+        while not self._stop_event.is_set():
+            remaining = next_run - time.monotonic()
+            if remaining > 0:
+                self._stop_event.wait(min(remaining, self.poll_interval))
+                if not self._stop_event.is_set() and self._files_changed():
+                    self._reload()
+                continue
+            started = time.monotonic()
+            try:
+                self.run()
+            except Exception:
+                print(f"ERROR: The health check failed\n{traceback.format_exc()}")
+            self.run_count += 1
+            self.last_run_seconds = time.monotonic() - started
+            next_run = max(started + self.interval, time.monotonic())
+            next_run = min(next_run, self._next_due_run())
+            if not self._stop_event.is_set():
+                print(f"\nRun {self.run_count} completed in {round(self.last_run_seconds, 1)} seconds, "
+                      f"next run in {round(next_run - time.monotonic())} seconds")
+
+    def stop(self, *args) -> None:
+        """ Stop the daemon once the current run (if any) completes """
+        if not self._stop_event.is_set():
+            print("\nStopping, waiting for the current run to complete")
+        self._stop_event.set()
+
+    def _next_due_run(self) -> float:
+        """ Return when (monotonic time) the next item is due, infinity if unknown or already overdue """
+        if self.next_due is None:
+            return float("inf")
+        try:
+            next_due = self.next_due()
+        except Exception:
+            print(f"ERROR: Unable to get the next due time\n{traceback.format_exc()}")
+            return float("inf")
+        remaining = next_due - time.time() if next_due is not None else 0
+        return time.monotonic() + remaining if remaining > 0 else float("inf")
+
+    def _reload(self):
+        print("\n=================================================================")
+        print("Configuration changed, reloading")
+        print("=================================================================")
+        try:
+            self.reload()
+            self.reload_count += 1
+        except Exception:
+            print(f"ERROR: Unable to reload, keeping the current configuration\n{traceback.format_exc()}")
+
+    def _files_changed(self) -> bool:
+        mtimes = self._get_mtimes()
+        changed = mtimes != self._mtimes
+        self._mtimes = mtimes
+        return changed
+
+    def _get_mtimes(self) -> dict:
+        mtimes = {}
+        for path in self.watched_files():
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _install_signal_handlers(self):
+        install_stop_handlers(self.stop)
+
+
+def install_stop_handlers(stop=None) -> None:
+    """
+    Call `stop` on SIGINT, SIGTERM (and SIGBREAK on Windows).  Signal handlers can only be installed from the main
+    thread, elsewhere this does nothing.
+
+    :param stop: Signal handler, called with the signal number and the frame
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for signal_name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, signal_name):
+            signal.signal(getattr(signal, signal_name), stop)
+
+
+class CheckPlanner:
+    """
+    Priority queue of the items ordered by the time their next check is due.
+
+    Each item is checked at a cadence derived from how often its feed updates and from its health: degraded items are
+    checked every `degraded_interval`, healthy items every `update_interval_factor` x their average update interval,
+    bounded by `min_interval` and `max_interval`.  Each run takes the most overdue items first, up to the request
+    budget, items left over stay due and go first in the next run.
+    """
+
+    def __init__(self, min_interval: float = 120, max_interval: float = 3600, degraded_interval: float = 120,
+                 update_interval_factor: float = 0.5, request_budget: int = 0):
+        """
+        :param min_interval: Shortest interval (seconds) between two checks of a healthy item, also used for items
+        whose update interval is unknown
+        :param max_interval: Longest interval (seconds) between two checks of an item
+        :param degraded_interval: Interval (seconds) between two checks of a degraded item
+        :param update_interval_factor: Fraction of the feed's average update interval between two checks
+        :param request_budget: Maximum number of requests per run, 0 for no limit
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.degraded_interval = degraded_interval
+        self.update_interval_factor = update_interval_factor
+        self.request_budget = request_budget
+        # heap of (due time, item ID), an entry is stale if the due time no longer matches _due
+        self._heap = []
+        # item ID -> due time
+        self._due = {}
+        # item ID -> estimated number of requests of a check
+        self._requests = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def configure(self, **settings) -> None:
+        """ Update the cadence settings (see :meth:`__init__`), the items keep their due times """
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+    def sync(self, item_ids=None, now: float = None) -> None:
+        """
+        Add the items not yet scheduled (due immediately) and drop the items no longer configured.
+
+        :param item_ids: IDs of the configured items
+        :param now: Current time (seconds since epoch)
+        """
+        item_ids = set(item_ids or [])
+        for item_id in list(self._due):
+            if item_id not in item_ids:
+                del self._due[item_id]
+                self._requests.pop(item_id, None)
+        for item_id in item_ids - self._due.keys():
+            self._push(item_id, now)
+
+    def due_items(self, now: float = None) -> list:
+        """
+        Take the items due for a check, the most overdue first, within the request budget.  The items are removed
+        from the queue until they are rescheduled with :meth:`reschedule` (or re-added by :meth:`sync`).
+
+        :param now: Current time (seconds since epoch)
+        :return: List of item IDs
+        """
+        due_items = []
+        requests = 0
+        while self._heap and self._heap[0][0] <= now:
+            due, item_id = self._heap[0]
+            if self._due.get(item_id) != due:
+                heapq.heappop(self._heap)
+                continue
+            item_requests = self._requests.get(item_id, 1)
+            if self.request_budget > 0 and due_items and requests + item_requests > self.request_budget:
+                break
+            heapq.heappop(self._heap)
+            del self._due[item_id]
+            due_items.append(item_id)
+            requests += item_requests
+        return due_items
+
+    def reschedule(self, item_id: str = "", now: float = None, update_interval_mins: float = 0,
+                   healthy: bool = True, requests: int = 1) -> float:
+        """
+        Schedule the next check of an item.
+
+        :param item_id: The item ID
+        :param now: Time of the check (seconds since epoch)
+        :param update_interval_mins: The feed's average update interval in minutes, 0 if unknown
+        :param healthy: False if the item is degraded
+        :param requests: Number of requests the check made
+        :return: Seconds until the next check
+        """
+        if not healthy:
+            interval = self.degraded_interval
+        elif update_interval_mins > 0:
+            interval = min(max(update_interval_mins * 60 * self.update_interval_factor, self.min_interval),
+                           self.max_interval)
+        else:
+            interval = self.min_interval
+        self._requests[item_id] = max(requests, 1)
+        self._push(item_id, now + interval)
+        return interval
+
+    def next_due(self):
+        """ Return the earliest due time, None if no item is scheduled """
+        return min(self._due.values(), default=None)
+
+    def _push(self, item_id, due):
+        self._due[item_id] = due
+        heapq.heappush(self._heap, (due, item_id))
+        # drop the stale entries once they outnumber the live ones
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due, item_id) for item_id, due in self._due.items()]
+            heapq.heapify(self._heap)
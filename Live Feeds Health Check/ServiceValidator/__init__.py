@@ -41,12 +41,13 @@ Success -   Obtain feature counts
 Error   -   Use feature counts from previous run (do not over-write data model)
 
 """
-import arcgis
-import json
+import JsonUtils as JsonUtils
+import MetricsUtils as MetricsUtils
 import RequestUtils as RequestUtils
+from urllib.parse import urlparse
 
 
-def validate_items(gis: arcgis.gis.GIS = None, data_model=None) -> dict:
+def validate_items(gis=None, data_model=None) -> dict:
     """
     Accepts a dict of items and retrieves the item in ArcGIS Online.
     If the item is accessible the title and snippet are updated to reflect any changes that occurred in AGOL
@@ -54,6 +55,9 @@ def validate_items(gis: arcgis.gis.GIS = None, data_model=None) -> dict:
     Validation Rule:
     1) Is the item ID a valid ID
     2) Is the item accessible
+
+    :param gis: The arcgis.GIS the items are retrieved from
+    :param data_model: The data model of the items (item ID -> DataModel.ItemRecord)
     """
     if data_model is None:
         data_model = {}
@@ -62,51 +66,40 @@ def validate_items(gis: arcgis.gis.GIS = None, data_model=None) -> dict:
         """
         Validate an item's ID and retrieve its meta-data.  If the item is not accessible and it's already in the
         previous run then propagate the meta-data from the previous run.
-        :param current_item: The current item ID
-        :return: Dictionary
+        :param current_item: The current item ID and its DataModel.ItemRecord
+        :return: The item ID and its record
         """
-        # the item ID
         item_id = current_item[0]
-        # the item ID params from the config file and the content from the previous run (if it exist)
-        item_content = current_item[1]
+        # the item's config and the content from the previous run (if it exist)
+        record = current_item[1]
         # initialize the values
-        title = item_content.get("title", "")
-        snippet = item_content.get("snippet", "")
-        service_url = item_content.get("service_url", "")
-        validated_item_dict = {
-            "title": title,
-            "snippet": snippet,
-            "service_url": service_url,
-            "agolItem": None,
-            "itemIsValid": False
-        }
-        print(f"{item_id}\t{title}")
+        if record.title is None:
+            record.title = ""
+        if record.snippet is None:
+            record.snippet = ""
+        record.service_url = record.config.service_url
+        record.agol_item = None
+        record.item_is_valid = False
+        print(f"{item_id}\t{record.title}")
         try:
-            agol_item = gis.content.get(item_id)
+            with MetricsUtils.timed_request(host=urlparse(gis.url).netloc):
+                agol_item = gis.content.get(item_id)
             if agol_item is None:
                 # The item ID is invalid
-                current_item[1].update(validated_item_dict)
                 print(f"{item_id} is invalid.")
         except Exception as e:
             # The item ID is valid, however, not accessible
-            current_item[1].update(validated_item_dict)
             print(f"{item_id} is inaccessible: {e}")
         else:
             # The item is a valid accessible item in ArcGIS Online
             # Fetch the item's title and snippet
-            title = agol_item["title"]
-            snippet = agol_item["snippet"]
-            service_url = agol_item["url"]
-            validated_item_dict.update({
-                "title": title,
-                "snippet": snippet,
-                "service_url": service_url,
-                "agolItem": agol_item,
-                "itemIsValid": True
-            })
-            current_item[1].update(validated_item_dict)
+            record.title = agol_item["title"]
+            record.snippet = agol_item["snippet"]
+            record.service_url = agol_item["url"]
+            record.agol_item = agol_item
+            record.item_is_valid = True
         finally:
-            return current_item[0], current_item[1]
+            return current_item
 
     return dict(map(validate_item, data_model.items()))
 
@@ -124,31 +117,28 @@ def validate_services(data_model=None) -> dict:
         """
         Validate a single service
         :param current_item: Input item/service
-        :return: Dictionary of results
+        :return: The item ID and its record
         """
         item_id = current_item[0]
-        item_content = current_item[1]
-        item = item_content['agolItem']
+        record = current_item[1]
+        item = record.agol_item
         type_keywords = item['typeKeywords']
         require_token = _requires_token("Requires Subscription", type_keywords)
-        print(f"{item_id}\t{item_content['title']}")
-        print(f"default retry count threshold: {item_content['default_retry_count']}")
-        print(f"default timeout threshold: {item_content['default_timeout']}")
-        print(f"service url: {item_content['service_url']}")
+        print(f"{item_id}\t{record.title}")
+        print(f"default retry count threshold: {record.config.default_retry_count}")
+        print(f"default timeout threshold: {record.config.default_timeout}")
+        print(f"service url: {record.service_url}")
         print(f"requires token: {require_token}")
-        response = RequestUtils.check_request(path=item_content["service_url"],
-                                              params={},
-                                              try_json=True,
-                                              add_token=require_token,
-                                              retry_factor=item_content["default_retry_count"],
-                                              timeout_factor=item_content["default_timeout"],
-                                              token=item_content["token"],
-                                              id=item_id)
+        record.service_response = RequestUtils.check_request(path=record.service_url,
+                                                             params={},
+                                                             try_json=True,
+                                                             add_token=require_token,
+                                                             retry_factor=record.config.default_retry_count,
+                                                             timeout_factor=record.config.default_timeout,
+                                                             token=record.token,
+                                                             id=item_id)
         print("\n")
-        return current_item[0], {
-            **current_item[1],
-            **{"serviceResponse": response}
-        }
+        return current_item
 
     return dict(map(validate_service, data_model.items()))
 
@@ -165,28 +155,27 @@ def validate_layers(data_model=None) -> dict:
     def validate_service_layers(current_item):
         """
         :param current_item: The current item
-        :return: Dictionary of validated layers
+        :return: The item ID and its record, with the validated layers
         """
         item_id = current_item[0]
-        item_content = current_item[1]
-        item_title = item_content['title']
-        item = item_content['agolItem']
+        record = current_item[1]
+        item = record.agol_item
         type_keywords = item['typeKeywords']
         require_token = _requires_token("Requires Subscription", type_keywords)
-        default_timeout = item_content['default_timeout']
-        default_retry_count = item_content['default_retry_count']
+        default_timeout = record.config.default_timeout
+        default_retry_count = record.config.default_retry_count
 
-        print(f"\n{item_id}\t{item_title}")
+        print(f"\n{item_id}\t{record.title}")
         print(f"requires token: {require_token}")
 
         layers = []
 
         # Check if the item is valid.  An item is considered valid only if we can access the item in AGOL so that we can
         # access the item's layers.  Otherwise, we need to access the service and retrieve the layers.
-        if item_content["itemIsValid"]:
+        if record.item_is_valid:
             # item is valid
             try:
-                for i, layer in enumerate(item_content["agolItem"].layers):
+                for i, layer in enumerate(record.agol_item.layers):
                     print(f" {layer.properties['name']}")
                     layers.append({
                         "id": item_id,
@@ -196,7 +185,7 @@ def validate_layers(data_model=None) -> dict:
                         "retryCount": default_retry_count,
                         "success": True,
                         "timeout": default_timeout,
-                        "token": item_content["token"],
+                        "token": record.token,
                         "url": layer.url
                     })
             except Exception as e:
@@ -207,25 +196,11 @@ def validate_layers(data_model=None) -> dict:
                     "success": False,
                     "message": e
                 })
-                layer_query_params = _prepare_layer_query_params(layers)
-                layers_are_valid = _check_all_layers(layers)
-                return current_item[0], {**current_item[1], **{"allLayersAreValid": layers_are_valid},
-                                         **{"layers": layers},
-                                         **{"layerQueryParams": layer_query_params}}
-            else:
-                layer_query_params = _prepare_layer_query_params(layers)
-                layers_are_valid = _check_all_layers(layers)
-                return current_item[0], {
-                    **current_item[1],
-                    **{"allLayersAreValid": layers_are_valid},
-                    **{"layers": layers},
-                    **{"layerQueryParams": layer_query_params}
-                }
         else:
             # item is not valid or not accessible, use the url on file
-            if item_content["serviceResponse"]["success"]:
+            if record.service_response["success"]:
                 # check if we received a successful response from using the service url on file
-                response = json.loads(item_content["serviceResponse"]["response"].content.decode('utf-8'))
+                response = JsonUtils.loads(record.service_response["response"].content)
                 # Check if the response throws and error
                 error = response.get("error")
                 if error is None:
@@ -234,17 +209,15 @@ def validate_layers(data_model=None) -> dict:
                         print(f" {layer['name']}")
                         layers.append({
                             "id": item_id,
-                            "layerId": layer.properties["id"],
+                            "layerId": layer["id"],
                             "addToken": require_token,
                             "name": layer["name"],
                             "retryCount": default_retry_count,
                             "success": True,
                             "timeout": default_timeout,
-                            "token": current_item[1]["token"],
-                            "url": item_content["service_url"] + "/" + str(layer["id"])
+                            "token": record.token,
+                            "url": record.service_url + "/" + str(layer["id"])
                         })
-                    layer_query_params = _prepare_layer_query_params(layers)
-                    layers_are_valid = _check_all_layers(layers)
                 else:
                     # There was an error returned in the response
                     layers.append({
@@ -252,14 +225,6 @@ def validate_layers(data_model=None) -> dict:
                         "success": False,
                         "message": f" The item {item_id} service url is having issues: {error['message']}"
                     })
-                    layer_query_params = _prepare_layer_query_params(layers)
-                    layers_are_valid = _check_all_layers(layers)
-                return current_item[0], {
-                    **current_item[1],
-                    **{"allLayersAreValid": layers_are_valid},
-                    **{"layers": layers},
-                    **{"layerQueryParams": layer_query_params}
-                }
             else:
                 # we have a failed response
                 print(f" The item {item_id} not inaccessible or not valid and the service url is not accessible.")
@@ -269,14 +234,10 @@ def validate_layers(data_model=None) -> dict:
                     "message": f" The item {item_id} is either inaccessible or not valid and the service url is not "
                                f"accessible. "
                 })
-                layer_query_params = _prepare_layer_query_params(layers)
-                layers_are_valid = _check_all_layers(layers)
-                return current_item[0], {
-                    **current_item[1],
-                    **{"allLayersAreValid": layers_are_valid},
-                    **{"layers": layers},
-                    **{"layerQueryParams": layer_query_params}
-                }
+        record.layers = layers
+        record.layer_query_params = _prepare_layer_query_params(layers)
+        record.all_layers_are_valid = _check_all_layers(layers)
+        return current_item
 
     def _prepare_layer_query_params(layers):
         """
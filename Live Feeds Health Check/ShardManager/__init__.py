@@ -0,0 +1,117 @@
+""" Sharded execution of the health check across worker processes """
+import concurrent.futures
+import hashlib
+import heapq
+import time
+import traceback
+import StatusManager as StatusManager
+
+
+def shard_of(item_id: str = "", shard_count: int = 1) -> int:
+    """
+    Return the shard an item belongs to.  The hash is stable across processes and runs (unlike hash()), so an item
+    always lands in the same shard, and its shard's state files, for a given number of shards.
+
+    :param item_id: The item ID
+    :param shard_count: Number of shards
+    :return: Shard index, 0 to shard_count - 1
+    """
+    return int(hashlib.md5(item_id.encode("utf-8")).hexdigest(), 16) % shard_count
+
+
+def run_shards(worker=None, shard_count: int = 1, *args) -> list:
+    """
+    Run the worker once per shard, each in its own process.
+
+    :param worker: Module level function called as worker(*args, shard_index, shard_count), returning a summary
+    dictionary
+    :param shard_count: Number of shards (and processes)
+    :param args: Arguments passed to the worker before the shard index
+    :return: List of the shard summaries, in shard order.  The summary of a shard that failed has an "error" property
+    """
+    summaries = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=shard_count) as executor:
+        futures = [executor.submit(worker, *args, shard_index, shard_count) for shard_index in range(shard_count)]
+        for shard_index, future in enumerate(futures):
+            try:
+                summary = future.result() or {}
+            except Exception:
+                summary = {"error": traceback.format_exc()}
+                print(f"ERROR: Shard {shard_index} failed\n{summary['error']}")
+            summaries.append({**summary, **{"shard": shard_index}})
+    return summaries
+
+
+def merge_status_outputs(status_outputs=None, item_ids=None, previous_status_output=None) -> dict:
+    """
+    Merge the status outputs of the shards into a single status output, with the items in the order of the config
+    file.  An item missing from the shard outputs (e.g. its shard failed) keeps its record from the previous run.
+
+    :param status_outputs: The status outputs of the shards ({"statusPreparedOn": ..., "items": [...]})
+    :param item_ids: The configured item IDs, in order
+    :param previous_status_output: StatusManager.PreviousStatusIndex of the previous (merged) run
+    :return: The merged status output
+    """
+    if previous_status_output is None:
+        previous_status_output = StatusManager.PreviousStatusIndex()
+    records = {}
+    status_prepared_on = 0
+    for status_output in status_outputs or []:
+        status_prepared_on = max(status_prepared_on, status_output.get("statusPreparedOn") or 0)
+        for record in status_output.get("items", []):
+            records[record["id"]] = record
+    output_file = {
+        "statusPreparedOn": status_prepared_on or int(time.time()),
+        "items": []
+    }
+    # the records of the previous run are only read back for the items missing from the shard outputs
+    previous_records = previous_status_output.full_records(
+        [item_id for item_id in item_ids or [] if item_id not in records])
+    for item_id in item_ids or []:
+        record = records.get(item_id, previous_records.get(item_id))
+        if record is not None:
+            output_file["items"].append(record)
+    return output_file
+
+
+def merge_summaries(summaries=None) -> dict:
+    """
+    Combine the shard summaries, numbers are summed (durations, maximums and high-water marks take the highest shard)
+    and nested dictionaries are merged the same way.
+
+    :param summaries: List of shard summaries
+    :return: Dictionary with the combined totals and the summary of each shard
+    """
+    summaries = summaries or []
+    totals = {}
+    for summary in summaries:
+        _add_totals(totals, {key: value for key, value in summary.items() if key not in ("shard", "error")})
+    return {
+        "shards": len(summaries),
+        "failedShards": [summary["shard"] for summary in summaries if "error" in summary],
+        "totals": totals,
+        "shardSummaries": summaries
+    }
+
+
+def merge_event_streams(event_streams=None):
+    """
+    Merge the event streams (oldest first) of the shard event logs into a single stream, oldest first.
+
+    :param event_streams: Iterables of events, each ordered by pubEventDate
+    :return: Generator of events
+    """
+    return heapq.merge(*(event_streams or []), key=lambda event: event.get("pubEventDate", 0))
+
+
+def _add_totals(totals, summary):
+    for key, value in summary.items():
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, dict):
+            _add_totals(totals.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)):
+            if key.endswith("Seconds") or key.startswith("max") or key.endswith("HighWaterMark"):
+                totals[key] = max(totals.get(key, 0), value)
+            else:
+                totals[key] = totals.get(key, 0) + value
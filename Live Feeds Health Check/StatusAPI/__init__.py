@@ -0,0 +1,214 @@
+""" HTTP API serving the latest status, event histories and RSS feeds from memory (daemon mode) """
+import gzip
+import hashlib
+import http.server
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types of the resources
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+RSS_CONTENT_TYPE = "application/rss+xml; charset=utf-8"
+
+# Bodies smaller than this are not compressed, the headers would outweigh the saving
+MIN_COMPRESSED_SIZE = 256
+
+# Brotli quality (0-11), the higher qualities cost far more time than they save bytes on JSON and RSS
+BROTLI_QUALITY = 5
+
+
+class Resource:
+    """
+    A response body with its strong ETag.  Each encoding is a different representation and has its own ETag (the
+    identity ETag with a -gzip/-br suffix).  A body is compressed on the first request that accepts the encoding, and
+    kept for the next ones, so the encodings no client asks for are never computed.
+    """
+    __slots__ = ("body", "content_type", "etag", "gzip_body", "brotli_body")
+
+    def __init__(self, body: bytes = b"", content_type: str = JSON_CONTENT_TYPE):
+        self.body = body
+        self.content_type = content_type
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.gzip_body = None
+        self.brotli_body = None
+
+    def representation(self, accept_encoding: str = ""):
+        """
+        Choose the representation for the Accept-Encoding header
+        :param accept_encoding: The Accept-Encoding request header
+        :return: (body, content encoding or None, ETag)
+        """
+        if len(self.body) < MIN_COMPRESSED_SIZE:
+            return self.body, None, f'"{self.etag}"'
+        encodings = _parse_accept_encoding(accept_encoding)
+        # two requests compressing at the same time both produce the same body, either one is kept
+        if brotli is not None and "br" in encodings:
+            if self.brotli_body is None:
+                self.brotli_body = brotli.compress(self.body, quality=BROTLI_QUALITY)
+            return self.brotli_body, "br", f'"{self.etag}-br"'
+        if "gzip" in encodings:
+            if self.gzip_body is None:
+                # mtime=0 keeps the output identical for identical input
+                self.gzip_body = gzip.compress(self.body, compresslevel=9, mtime=0)
+            return self.gzip_body, "gzip", f'"{self.etag}-gzip"'
+        return self.body, None, f'"{self.etag}"'
+
+
+class StatusSnapshot:
+    """
+    The resources of the API at the end of a run, by path.  A snapshot is never modified, each run publishes a new one,
+    so a request always sees the resources of a single run.
+    """
+
+    def __init__(self, resources=None, status_prepared_on: int = 0):
+        """
+        :param resources: Dictionary of path -> Resource
+        :param status_prepared_on: Timestamp of the run
+        """
+        self.resources = resources or {}
+        self.status_prepared_on = status_prepared_on
+
+    def get(self, path: str = ""):
+        return self.resources.get(path)
+
+    def update(self, bodies=None, keep=None, status_prepared_on: int = 0):
+        """
+        Build the next snapshot.  A body identical to the current one keeps its Resource (and its compressed bodies), so
+        only the resources that changed are compressed again.
+        :param bodies: Dictionary of path -> (body bytes, content type) of the resources built by the run
+        :param keep: Callable returning True for the paths of the current snapshot to carry over when not in bodies
+        :param status_prepared_on: Timestamp of the run
+        :return: The new StatusSnapshot
+        """
+        resources = {path: resource for path, resource in self.resources.items() if keep is not None and keep(path)}
+        for path, (body, content_type) in (bodies or {}).items():
+            resource = self.resources.get(path)
+            if resource is None or resource.body != body or resource.content_type != content_type:
+                resource = Resource(body=body, content_type=content_type)
+            resources[path] = resource
+        return StatusSnapshot(resources=resources, status_prepared_on=status_prepared_on)
+
+
+def _parse_accept_encoding(accept_encoding):
+    encodings = set()
+    for token in (accept_encoding or "").split(","):
+        name, _, parameters = token.strip().partition(";")
+        quality = parameters.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison (RFC 7232), an ETag of any representation of the resource matches
+    base_etag = etag.strip('"').rsplit("-", 1)[0] if etag.endswith(('-gzip"', '-br"')) else etag.strip('"')
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate in (base_etag, base_etag + "-gzip", base_etag + "-br"):
+            return True
+    return False
+
+
+class StatusServer:
+    """
+    HTTP server of the API, from a background thread.
+
+        GET /status             status of all the items (status.json)
+        GET /status/{item id}   status of an item
+        GET /events/{item id}   event history of an item, oldest first
+        GET /rss/{item id}      RSS feed of an item
+        GET /changes/{N}        items changed since sequence number N, 404 when N is outside the delta window
+
+    Responses carry a strong ETag, a request with a matching If-None-Match gets a 304.  Bodies are served gzip or
+    brotli compressed when the client accepts it.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080):
+        """
+        :param host: Address to listen on
+        :param port: Port to listen on
+        """
+        self.host = host
+        self.port = port
+        self.snapshot = StatusSnapshot()
+        self.requests = 0
+        self.not_modified = 0
+        self._server = None
+        self._thread = None
+
+    def publish(self, snapshot: StatusSnapshot = None) -> None:
+        """ Serve the snapshot from now on """
+        self.snapshot = snapshot
+
+    def start(self) -> None:
+        status_server = self
+
+        class StatusHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._respond(send_body=True)
+
+            def do_HEAD(self):
+                self._respond(send_body=False)
+
+            def _respond(self, send_body):
+                status_server.requests += 1
+                resource = status_server.snapshot.get(self.path.split("?", 1)[0].rstrip("/"))
+                if resource is None:
+                    self.send_error(404)
+                    return
+                body, content_encoding, etag = resource.representation(self.headers.get("Accept-Encoding", ""))
+                if_none_match = self.headers.get("If-None-Match")
+                if if_none_match is not None and _etag_matches(if_none_match, etag):
+                    status_server.not_modified += 1
+                    self.send_response(304)
+                    # no Content-Length, a 304 has no body and the length would be taken for that of the resource
+                    self._send_common_headers(etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self._send_common_headers(etag)
+                self.send_header("Content-Type", resource.content_type)
+                if content_encoding is not None:
+                    self.send_header("Content-Encoding", content_encoding)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def _send_common_headers(self, etag):
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Vary", "Accept-Encoding")
+                self.send_header("Access-Control-Allow-Origin", "*")
+
+            def log_message(self, *args):
+                # requests are not logged
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port), StatusHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="status-api", daemon=True)
+        self._thread.start()
+        print(f"Serving the status API on http://{self.host}:{self._server.server_port}/status")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
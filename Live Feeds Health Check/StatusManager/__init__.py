@@ -2,6 +2,485 @@
 This module is responsible for returning a status code and a set of details
 related to the status code
 """
+import hashlib
+import operator
+import time
+import FileManager as FileManager
+import JsonUtils as JsonUtils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Facts about an item that status rules can test (see build_rule_facts)
+RULE_FACTS = frozenset([
+    "itemIsValid",
+    "serviceIsValid",
+    "layersAreValid",
+    "lastUpdateMinutes",
+    "lastRunMinutes",
+    "avgUpdateIntervalMins",
+    "avgFeedIntervalMins",
+    "alfpLastStatus",
+    "consecutiveFailures",
+    "serviceRetryCount",
+    "totalElapsedTime"
+])
+
+# Comparison operators available to status rules
+RULE_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le
+}
+
+# Types the rule parameters (config file values) are parsed to
+RULE_PARAM_TYPES = {
+    "int": int,
+    "float": float
+}
+
+# Batches of at least this many items are evaluated with numpy (when it is installed)
+VECTORIZE_MIN_BATCH = 256
+
+# Number of deltas kept in the delta feed
+DEFAULT_DELTA_WINDOW = 100
+
+# Fields of an item's record in the status output file (see DataModel.ItemRecord.to_status_record)
+STATUS_RECORD_FIELDS = ("id", "title", "snippet", "comments", "lastUpdateTime", "updateRate", "featureCount", "usage",
+                        "status")
+
+# The fields of the previous run's status records kept in memory, those the checks fall back on (see
+# DataModel.ItemRecord.merge_previous)
+PREVIOUS_RECORD_FIELDS = ("id", "title", "snippet", "featureCount", "usage")
+
+
+class RuleDefinitionError(Exception):
+    """Exception raised for errors in the status rules file
+
+        Attributes:
+            rule -- the rule (or section of the rules file) with the error
+            message -- explanation of the error
+    """
+
+    def __init__(self, rule, message="Invalid rule"):
+        self.rule = rule
+        self.message = message
+
+    def __str__(self):
+        return f"\n{self.message}\nRule: {self.rule}"
+
+
+class RuleEngine:
+    """
+    Evaluates the status rules of the status rules file (statusRules.json) over a batch of items.
+
+    The rules are listed in order of precedence, the first rule whose conditions all hold gives an item its status
+    code, and items that match no rule get the default code.  At construction the rules are checked against the
+    status codes and facts and compiled into an evaluation plan.  A batch of items is evaluated as a table with one
+    column per fact and parameter, so each condition is evaluated once per column rather than once per item (with
+    numpy for large batches when it is installed).
+    """
+
+    def __init__(self, rules=None, status_codes_data_model=None):
+        """
+        :param rules: The content of the status rules file
+        :param status_codes_data_model: The status codes (statusCodes.json), used to validate the rule codes
+        """
+        if rules is None:
+            rules = {}
+        if status_codes_data_model is None:
+            status_codes_data_model = {}
+        self.default_code = rules.get("default", "000")
+        if self.default_code not in status_codes_data_model:
+            raise RuleDefinitionError(self.default_code, "The default status code is not in the status codes file")
+        self.params = {}
+        for name, type_name in rules.get("params", {}).items():
+            if type_name not in RULE_PARAM_TYPES:
+                raise RuleDefinitionError(name, f"Unknown parameter type: {type_name}")
+            self.params[name] = RULE_PARAM_TYPES[type_name]
+        # evaluation plan, list of (code, [(fact, operator function, operand), ...])
+        self.plan = []
+        for rule in rules.get("rules", []):
+            if rule.get("code") not in status_codes_data_model:
+                raise RuleDefinitionError(rule, "The status code is not in the status codes file")
+            clauses = []
+            for clause in rule.get("when", []):
+                if len(clause) != 3:
+                    raise RuleDefinitionError(rule, f"Conditions must be [fact, operator, operand]: {clause}")
+                fact, op, operand = clause
+                self._check_fact(rule, fact)
+                if op not in RULE_OPERATORS:
+                    raise RuleDefinitionError(rule, f"Unknown operator: {op}")
+                if isinstance(operand, dict):
+                    if operand.get("param") not in self.params:
+                        raise RuleDefinitionError(rule, f"Unknown parameter: {operand.get('param')}")
+                    if "times" in operand:
+                        self._check_fact(rule, operand["times"])
+                clauses.append((fact, RULE_OPERATORS[op], operand))
+            self.plan.append((rule["code"], clauses))
+        # raw config value -> parsed value, per type
+        self._parsed_params = {}
+        self.hits = {code: 0 for code, _ in self.plan}
+        self.hits[self.default_code] = self.hits.get(self.default_code, 0)
+        self.items_evaluated = 0
+        self.evaluation_seconds = 0
+        self.vectorized_batches = 0
+
+    def evaluate_batch(self, rows=None) -> list:
+        """
+        Evaluate the rules over a batch of items.
+
+        :param rows: List of dictionaries of facts (see :func:`build_rule_facts`) and rule parameters, one per item
+        :return: List of status codes, in the order of the rows
+        """
+        if rows is None:
+            rows = []
+        start = time.perf_counter()
+        n_rows = len(rows)
+        vectorize = numpy is not None and n_rows >= VECTORIZE_MIN_BATCH
+        # columnar table of the facts and parsed parameters
+        table = {fact: [row[fact] for row in rows] for fact in RULE_FACTS}
+        for name, parse in self.params.items():
+            table[name] = [self._parse_param(name, parse, row[name]) for row in rows]
+        if vectorize:
+            self.vectorized_batches += 1
+            table = {name: numpy.asarray(column) for name, column in table.items()}
+        codes = [None] * n_rows
+        unassigned = n_rows
+        for code, clauses in self.plan:
+            if unassigned == 0:
+                break
+            mask = None
+            for fact, compare, operand in clauses:
+                clause_mask = self._evaluate_clause(table, fact, compare, operand, vectorize)
+                mask = clause_mask if mask is None else (mask & clause_mask if vectorize else
+                                                         [a and b for a, b in zip(mask, clause_mask)])
+            if mask is None:
+                continue
+            for index, matched in enumerate(mask.tolist() if vectorize else mask):
+                if matched and codes[index] is None:
+                    codes[index] = code
+                    unassigned -= 1
+                    self.hits[code] += 1
+        for index in range(n_rows):
+            if codes[index] is None:
+                codes[index] = self.default_code
+                self.hits[self.default_code] += 1
+        self.items_evaluated += n_rows
+        self.evaluation_seconds += time.perf_counter() - start
+        return codes
+
+    def get_stats(self) -> dict:
+        """ Return the number of items each rule matched and the evaluation time """
+        return {
+            "itemsEvaluated": self.items_evaluated,
+            "evaluationSeconds": self.evaluation_seconds,
+            "vectorizedBatches": self.vectorized_batches,
+            "ruleHits": [{"code": code, "hits": self.hits[code]} for code, _ in self.plan] +
+                        [{"code": self.default_code, "hits": self.hits[self.default_code], "default": True}]
+        }
+
+    def _evaluate_clause(self, table, fact, compare, operand, vectorize):
+        column = table[fact]
+        if isinstance(operand, dict):
+            other = table[operand["param"]]
+            if "times" in operand:
+                other = other * table[operand["times"]] if vectorize else \
+                    [a * b for a, b in zip(other, table[operand["times"]])]
+        else:
+            other = operand
+        if vectorize:
+            return compare(column, other)
+        if isinstance(other, list):
+            return [compare(a, b) for a, b in zip(column, other)]
+        return [compare(a, other) for a in column]
+
+    def _parse_param(self, name, parse, raw_value):
+        # the same few config values repeat across items, parse each distinct value once
+        key = (name, raw_value)
+        if key not in self._parsed_params:
+            try:
+                self._parsed_params[key] = raw_value if isinstance(raw_value, (int, float)) else parse(raw_value)
+            except (TypeError, ValueError):
+                raise RuleDefinitionError(name, f"Invalid value for the rule parameter: {raw_value}")
+        return self._parsed_params[key]
+
+    @staticmethod
+    def _check_fact(rule, fact):
+        if fact not in RULE_FACTS:
+            raise RuleDefinitionError(rule, f"Unknown fact: {fact}")
+
+
+def load_rule_engine(path: str = "", status_codes_data_model=None) -> RuleEngine:
+    """
+    Load and compile the status rules file.
+
+    :param path: Path to the status rules file
+    :param status_codes_data_model: The status codes (statusCodes.json)
+    :return: RuleEngine
+    """
+    return RuleEngine(rules=FileManager.open_file(path=path), status_codes_data_model=status_codes_data_model)
+
+
+def build_rule_facts(item=None, timestamp: int = 0, service_retry_count: int = 0, total_elapsed_time: float = 0) -> dict:
+    """
+    Build the facts the status rules are evaluated against for an item.
+
+    :param item: The item's DataModel.ItemRecord
+    :param timestamp: The timestamp of the current run
+    :param service_retry_count: The number of retries of the service request
+    :param total_elapsed_time: The average of the service and layers elapsed times
+    :return: Dictionary of facts
+    """
+    return {
+        "itemIsValid": bool(item.item_is_valid),
+        "serviceIsValid": bool(item.service_response["success"]),
+        "layersAreValid": bool(item.all_layers_are_valid),
+        # elapsed time between now and the last updated time of the feed
+        "lastUpdateMinutes": (timestamp - item.last_update_timestamp) / 60,
+        # elapsed time between now and the last run time of the feed
+        "lastRunMinutes": (timestamp - item.last_run_timestamp) / 60,
+        "avgUpdateIntervalMins": item.avg_update_interval_mins,
+        "avgFeedIntervalMins": item.avg_feed_interval_mins,
+        "alfpLastStatus": item.alfp_last_status,
+        "consecutiveFailures": item.consecutive_failures,
+        "serviceRetryCount": service_retry_count,
+        "totalElapsedTime": total_elapsed_time
+    }
+
+
+class PreviousStatusIndex:
+    """
+    The item statuses of the previous run (the status output file), indexed by item ID.
+
+    Built once per run and used for keyed lookups instead of scanning the list of items.  Only what the run compares
+    against is kept in memory for each item: the content hash of its status record (so items whose status output has
+    not changed can be skipped), its status code and the fields the checks fall back on (PREVIOUS_RECORD_FIELDS).  The
+    full records of the items carried over without a check are read back from the status output file.
+    """
+
+    def __init__(self, status_output=None, path: str = None):
+        """
+        :param status_output: The content of the status output file ({"statusPreparedOn": ..., "items": [...]})
+        :param path: Path to the status output file the full records are read back from, None if there is none
+        """
+        if status_output is None:
+            status_output = {}
+        self.path = path
+        # item id -> fields of PREVIOUS_RECORD_FIELDS
+        self._items = {}
+        # item id -> status code
+        self._codes = {}
+        # item id -> content hash
+        self._hashes = {}
+        # the items first, a streamed status output only has the members after the items once they are read
+        for item in status_output.get("items", []):
+            item_id = item["id"]
+            self._items[item_id] = {field: item[field] for field in PREVIOUS_RECORD_FIELDS if field in item}
+            self._codes[item_id] = item["status"]["code"]
+            self._hashes[item_id] = hash_status_record(item)
+        self.status_prepared_on = status_output.get("statusPreparedOn")
+        # Sequence number of the run (see StatusDeltaFeed), 0 for status files written before the delta feed
+        self.sequence = status_output.get("sequence", 0)
+
+    @classmethod
+    def from_file(cls, path: str = ""):
+        """
+        Build the index from a status output file.  A missing file gives an empty index.  The file is streamed, one
+        item at a time.
+
+        :param path: Path to the status output file
+        :return: PreviousStatusIndex
+        """
+        if not FileManager.check_file_exist_by_pathlib(path=path):
+            return cls()
+        return cls(FileManager.open_file_streaming(path=path, fields=STATUS_RECORD_FIELDS), path=path)
+
+    def __contains__(self, item_id):
+        return item_id in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def get(self, item_id: str = "", default=None) -> dict:
+        """
+        Return the fields of an item's status record from the previous run the checks fall back on (see
+        PREVIOUS_RECORD_FIELDS), use :meth:`full_records` for the whole record.
+
+        :param item_id: The item ID
+        :param default: Returned if the item was not in the previous run
+        :return: The fields of the status record
+        """
+        return self._items.get(item_id, default)
+
+    def full_records(self, item_ids=None) -> dict:
+        """
+        Read the full status records of some of the items back from the status output file, in a single pass.
+
+        :param item_ids: The item IDs
+        :return: Dictionary of item ID -> status record, of the items that were in the previous run
+        """
+        item_ids = {item_id for item_id in item_ids or [] if item_id in self._items}
+        if not item_ids or self.path is None or not FileManager.check_file_exist_by_pathlib(path=self.path):
+            return {}
+        status_output = FileManager.open_file_streaming(path=self.path, fields=STATUS_RECORD_FIELDS)
+        return {item["id"]: item for item in status_output.get("items", []) if item["id"] in item_ids}
+
+    def status_code(self, item_id: str = ""):
+        """
+        Return an item's status code from the previous run, None if the item was not in the previous run.
+
+        :param item_id: The item ID
+        :return: The status code
+        """
+        return self._codes.get(item_id)
+
+    def content_hash(self, item_id: str = ""):
+        """
+        Return the content hash of an item's status record from the previous run (see :func:`hash_status_record`),
+        None if the item was not in the previous run.
+
+        :param item_id: The item ID
+        :return: The content hash
+        """
+        return self._hashes.get(item_id)
+
+
+class StatusDeltaFeed:
+    """
+    The items whose status record changed in each run, for clients polling the status without downloading the whole
+    status file.
+
+    Every run gets the next sequence number, written to the status file as "sequence".  A delta lists the records that
+    changed (or were added) since the previous run and the IDs of the items removed from the config.  The last
+    `window` deltas are kept, a client that has seen sequence N asks for the changes since N, and falls back to the
+    status file when N is older than the window.
+    """
+
+    def __init__(self, sequence: int = 0, deltas=None, window: int = DEFAULT_DELTA_WINDOW):
+        """
+        :param sequence: Sequence number of the last run
+        :param deltas: The deltas kept, oldest first
+        :param window: Number of deltas to keep
+        """
+        self.sequence = sequence
+        self.deltas = list(deltas or [])
+        self.window = window
+
+    @classmethod
+    def from_file(cls, path: str = "", window: int = DEFAULT_DELTA_WINDOW, sequence: int = 0):
+        """
+        Load the delta feed from its file.  A missing file gives an empty feed starting after the sequence number.
+
+        :param path: Path to the delta feed file
+        :param window: Number of deltas to keep
+        :param sequence: Sequence number of the status file, used when the delta feed file is missing or behind it
+        :return: StatusDeltaFeed
+        """
+        if not FileManager.check_file_exist_by_pathlib(path=path):
+            return cls(sequence=sequence, window=window)
+        data = FileManager.open_file(path=path)
+        if data.get("sequence", 0) < sequence:
+            # the deltas do not cover the last runs, keep the sequence numbers increasing and drop them
+            return cls(sequence=sequence, window=window)
+        return cls(sequence=data.get("sequence", 0), deltas=data.get("deltas"), window=window)
+
+    @property
+    def oldest_sequence(self) -> int:
+        """ The oldest sequence number changes can be asked since """
+        if len(self.deltas) == 0:
+            return self.sequence
+        return self.deltas[0]["sequence"] - 1
+
+    def record(self, status_output=None, previous_status_output=None) -> dict:
+        """
+        Add the delta of a run, and set the run's sequence number in its status output.
+
+        :param status_output: The status output of the run
+        :param previous_status_output: PreviousStatusIndex of the previous run
+        :return: The delta
+        """
+        if previous_status_output is None:
+            previous_status_output = PreviousStatusIndex()
+        changed = [record for record in status_output["items"]
+                   if hash_status_record(record) != previous_status_output.content_hash(record["id"])]
+        item_ids = {record["id"] for record in status_output["items"]}
+        removed = [record["id"] for record in previous_status_output if record["id"] not in item_ids]
+        self.sequence += 1
+        delta = {
+            "sequence": self.sequence,
+            "statusPreparedOn": status_output["statusPreparedOn"],
+            "changed": changed,
+            "removed": removed
+        }
+        self.deltas.append(delta)
+        del self.deltas[:max(0, len(self.deltas) - self.window)]
+        status_output["sequence"] = self.sequence
+        return delta
+
+    def changes_since(self, sequence: int = 0):
+        """
+        Merge the deltas after a sequence number into a single delta, with the latest record of each changed item.
+
+        :param sequence: The last sequence number the client has seen
+        :return: The delta ({"since": ..., "sequence": ..., "changed": [...], "removed": [...]}), None if the sequence
+        number is older than the window (or newer than the last run) and the client has to read the status file
+        """
+        if sequence < self.oldest_sequence or sequence > self.sequence:
+            return None
+        changed = {}
+        removed = {}
+        status_prepared_on = self.deltas[-1]["statusPreparedOn"] if len(self.deltas) > 0 else None
+        for delta in self.deltas:
+            if delta["sequence"] <= sequence:
+                continue
+            for record in delta["changed"]:
+                changed[record["id"]] = record
+                removed.pop(record["id"], None)
+            for item_id in delta["removed"]:
+                changed.pop(item_id, None)
+                removed[item_id] = True
+        return {
+            "since": sequence,
+            "sequence": self.sequence,
+            "statusPreparedOn": status_prepared_on,
+            "changed": list(changed.values()),
+            "removed": list(removed)
+        }
+
+    def save(self, path: str = "", delta_path: str = "", precompress: bool = False) -> None:
+        """
+        Write the delta feed, and the last delta on its own.
+
+        :param path: Path to the delta feed file
+        :param delta_path: Path to the last delta file
+        :param precompress: Also write pre-compressed siblings of the files
+        :return: None
+        """
+        FileManager.save(data={"sequence": self.sequence, "oldestSequence": self.oldest_sequence,
+                               "deltas": self.deltas},
+                         path=path,
+                         precompress=precompress)
+        if len(self.deltas) > 0:
+            FileManager.save(data=self.deltas[-1], path=delta_path, precompress=precompress)
+
+
+def hash_status_record(record=None) -> str:
+    """
+    Return a hash of the content of a status record.  Equal records have equal hashes regardless of key order.
+
+    :param record: The status record
+    :return: Hex digest
+    """
+    return hashlib.sha1(JsonUtils.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
 
 
 def get_status_code(status_code_key: str = "", input_config=None) -> dict:
@@ -25,38 +504,34 @@ def update_rss_feed(previous_status_output=None, item=None, status_codes_data_mo
     Determine whether or not we need to update the feed.  The update is based on not the status, but rather the status
     comment.  An item's status code could have changed, however.
 
-    :param previous_status_output: The output status file from the previous run
-    :param item: The current status dict from the current item
+    :param previous_status_output: The PreviousStatusIndex of the previous run (a list of status records is also
+    accepted)
+    :param item: The item's DataModel.ItemRecord, with its current status
     :param status_codes_data_model: The status codes model to reference in order to obtain the comments
     :return: Boolean indicating whether or not there was a change in the status
     """
+    if not isinstance(previous_status_output, PreviousStatusIndex):
+        previous_status_output = PreviousStatusIndex({"items": previous_status_output or []})
     # item ID
-    item_id = item["id"]
+    item_id = item.id
     # status code
-    status_code = item["status"]["code"]
-    # bool flag used to indicate whether or not there was an update since we last ran the script
-    update = False
-    # TODO Should have used a dict with item ID's as the keys
-    for previous_status in previous_status_output:
-        # item id on file (from the status file)
-        previous_item_id = previous_status["id"]
-        # status code on file
-        previous_item_status_code = previous_status["status"]["code"]
-        if item_id == previous_item_id:
-            # compare the status codes from the current run to the previous run
-            if status_code is not previous_item_status_code:
-                # obtain comment from the previous and current status code
-                # if the comments are the same, do not update the rss feed
-                # if the comments are different, update the feed
-                previous_status_comment = get_status_code(previous_item_status_code,
-                                                          status_codes_data_model)["statusDetails"]["Comment"]
-                current_status_comment = get_status_code(status_code,
-                                                         status_codes_data_model)["statusDetails"]["Comment"]
-                if previous_status_comment == current_status_comment:
-                    print(f"Do not update RSS Feed for: {item_id}")
-                else:
-                    # If we reach this point, the status has changed since the previous run
-                    print(f"Update RSS Feed for: {item_id}")
-                    # comments are different, update the feed
-                    update = True
-    return update
+    status_code = item.status["code"]
+    # status code on file
+    previous_item_status_code = previous_status_output.status_code(item_id)
+    # compare the status codes from the current run to the previous run
+    if previous_item_status_code is None or status_code == previous_item_status_code:
+        return False
+    # obtain comment from the previous and current status code
+    # if the comments are the same, do not update the rss feed
+    # if the comments are different, update the feed
+    previous_status_comment = get_status_code(previous_item_status_code,
+                                              status_codes_data_model)["statusDetails"]["Comment"]
+    current_status_comment = get_status_code(status_code,
+                                             status_codes_data_model)["statusDetails"]["Comment"]
+    if previous_status_comment == current_status_comment:
+        print(f"Do not update RSS Feed for: {item_id}")
+        return False
+    # If we reach this point, the status has changed since the previous run
+    print(f"Update RSS Feed for: {item_id}")
+    # comments are different, update the feed
+    return True
@@ -9,9 +9,23 @@ This file can also be imported as a module and contains the following
 functions:
 
     * getCurrentTimestamp
+    * is_now_excluded
+    * get_exclusion_calendar
+    * parse_timezone
+    * parse_time_ranges
+    * parse_days
+    * parse_dates
 """
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import math
+import MetricsUtils as MetricsUtils
+import zoneinfo
+
+# Number of minutes in a day
+MINUTES_PER_DAY = 1440
+
+# Compiled exclusion calendars by their exclusion parameters
+_exclusion_calendars = {}
 
 
 def get_current_time_and_date():
@@ -62,56 +76,154 @@ def is_now_excluded(excluded_time_ranges=None, excluded_days=None, excluded_date
     :return: A boolean value indicating whether or not the current timestamp is within the range of ANY of the input
     time parameters
     """
+    calendar = get_exclusion_calendar(excluded_time_ranges or "", excluded_days or "", excluded_dates or "")
+    return calendar.is_excluded(ct if ct is not None else datetime.timestamp(datetime.now()))
 
-    # check if the current time range is excluded
-    if excluded_time_ranges:
-        excluded_time_ranges_list = excluded_time_ranges.split(",")
-        if excluded_time_ranges_list:
-            time_now = datetime.strptime(datetime.strftime(datetime.now(), "%I:%M%p"), "%I:%M%p")
-            for excluded_time_range in excluded_time_ranges_list:
-                ts, te = excluded_time_range.split(" - ")
-                time_start = datetime.strptime(ts, "%I:%M%p")
-                time_end = datetime.strptime(te, "%I:%M%p")
-
-                if _is_now_in_time_range(time_start, time_end, time_now):
-                    return True
-
-    # iterate through the days of the week to determine if today is excluded
-    today = _get_day_of_week(ct)
-    if excluded_days:
-        # get a list of the excluded days
-        excluded_days_list = excluded_days.split(",")
-        # check if there are any values in the list
-        if excluded_days_list:
-            # iterate through the list
-            for excluded_day in excluded_days_list:
-                if int(today) == int(excluded_day):
-                    return True
-
-    # iterate through the excluded dates (if any) and check to see if today is to be excluded
-    # if today is excluded then we return True
-    if excluded_dates:
-        excluded_dates_list = excluded_dates.split(",")
-        for excluded_date in excluded_dates_list:
-            excluded_date_string = datetime.strptime(excluded_date, "%m/%d/%Y")
-            if (datetime.today() - excluded_date_string).days == 0:
-                return True
-
-    return False
-
-
-def _is_now_in_time_range(start_time=None, end_time=None, now_time=None):
-    """
-    Determine if the input time is within (inclusive) of the start and end times
-    :param start_time:
-    :param end_time:
-    :param now_time:
-    :return:
+
+class ExclusionCalendar:
+    """
+    The exclusion time ranges, days and dates of an item compiled into a minute-of-week bitmap and a set of dates, so
+    checking if a timestamp is excluded is a lookup rather than parsing and comparing every range.
+
+    Timestamps are converted to the calendar's time zone (local time if none) before the lookup.
+    """
+
+    __slots__ = ("minutes", "dates", "tz", "is_empty")
+
+    def __init__(self, time_ranges=(), days=frozenset(), dates=frozenset(), tz=None):
+        """
+        :param time_ranges: Tuple of (start, end) minutes of the day (see :func:`parse_time_ranges`), inclusive, a
+        range that does not end after it starts spans midnight
+        :param days: Set of days of the week, Sunday is 0 (see :func:`parse_days`)
+        :param dates: Set of dates (see :func:`parse_dates`)
+        :param tz: Time zone (tzinfo) of the ranges, days and dates, None for local time
+        """
+        day_minutes = bytearray(MINUTES_PER_DAY)
+        for time_start, time_end in time_ranges:
+            if time_start < time_end:
+                day_minutes[time_start:time_end + 1] = b"\x01" * (time_end + 1 - time_start)
+            else:  # Over midnight
+                day_minutes[time_start:] = b"\x01" * (MINUTES_PER_DAY - time_start)
+                day_minutes[:time_end + 1] = b"\x01" * (time_end + 1)
+        self.minutes = bytearray()
+        for day in range(7):
+            self.minutes += b"\x01" * MINUTES_PER_DAY if day in days else day_minutes
+        self.dates = frozenset(date.toordinal() for date in dates)
+        self.tz = tz
+        self.is_empty = not any(self.minutes) and not self.dates
+
+    def is_excluded(self, timestamp=None) -> bool:
+        """
+        :param timestamp: Timestamp (seconds since epoch)
+        :return: True if the timestamp is within ANY of the exclusions
+        """
+        if self.is_empty:
+            return False
+        dt = datetime.fromtimestamp(timestamp, self.tz)
+        # isoweekday() is 1 (Monday) to 7 (Sunday), Sunday is the first day of the bitmap
+        minute_of_week = (dt.isoweekday() % 7) * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+        return self.minutes[minute_of_week] == 1 or dt.toordinal() in self.dates
+
+    def are_excluded(self, timestamps=None) -> list:
+        """
+        :param timestamps: Iterable of timestamps (seconds since epoch)
+        :return: List of booleans, True for each timestamp within ANY of the exclusions
+        """
+        if self.is_empty:
+            return [False for _ in timestamps]
+        return [self.is_excluded(timestamp) for timestamp in timestamps]
+
+
+def get_exclusion_calendar(excluded_time_ranges: str = "", excluded_days: str = "", excluded_dates: str = "",
+                           timezone_name: str = "") -> ExclusionCalendar:
+    """
+    Return the exclusion calendar of the exclusion parameters.  Calendars are compiled once per distinct set of
+    parameters and shared by all the items that use them.
+
+    :param excluded_time_ranges: See :func:`parse_time_ranges`
+    :param excluded_days: See :func:`parse_days`
+    :param excluded_dates: See :func:`parse_dates`
+    :param timezone_name: See :func:`parse_timezone`
+    :return: ExclusionCalendar
+    """
+    key = (excluded_time_ranges, excluded_days, excluded_dates, timezone_name)
+    calendar = _exclusion_calendars.get(key)
+    MetricsUtils.record_cache(name="exclusionCalendars", hit=calendar is not None)
+    if calendar is None:
+        calendar = ExclusionCalendar(time_ranges=parse_time_ranges(excluded_time_ranges),
+                                     days=parse_days(excluded_days),
+                                     dates=parse_dates(excluded_dates),
+                                     tz=parse_timezone(timezone_name))
+        _exclusion_calendars[key] = calendar
+    return calendar
+
+
+def parse_timezone(timezone_name: str = ""):
+    """
+    Parse an IANA time zone name (e.g. America/Los_Angeles, UTC)
+
+    :param timezone_name: The time zone name, empty for local time
+    :return: tzinfo, or None for local time
+    """
+    timezone_name = timezone_name.strip()
+    if not timezone_name:
+        return None
+    if timezone_name.upper() == "UTC":
+        return timezone.utc
+    try:
+        return zoneinfo.ZoneInfo(timezone_name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone: {timezone_name}")
+
+
+def parse_time_ranges(excluded_time_ranges: str = "") -> tuple:
+    """
+    Parse a comma separated list of time ranges in the format of hh:mm AM/PM - hh:mm AM/PM
+
+    :param excluded_time_ranges: The time ranges
+    :return: Tuple of (start, end) minutes of the day
+    """
+    time_ranges = []
+    for excluded_time_range in filter(None, map(str.strip, excluded_time_ranges.split(","))):
+        try:
+            ts, te = excluded_time_range.split(" - ")
+            time_start = datetime.strptime(ts.strip(), "%I:%M%p")
+            time_end = datetime.strptime(te.strip(), "%I:%M%p")
+        except ValueError:
+            raise ValueError(f"Invalid time range (hh:mmAM - hh:mmPM): {excluded_time_range}")
+        time_ranges.append((time_start.hour * 60 + time_start.minute, time_end.hour * 60 + time_end.minute))
+    return tuple(time_ranges)
+
+
+def parse_days(excluded_days: str = "") -> frozenset:
+    """
+    Parse a comma separated list of days of the week, Sunday is 0 and Saturday is 6
+
+    :param excluded_days: The days of the week
+    :return: Set of days
+    """
+    days = set()
+    for excluded_day in filter(None, map(str.strip, excluded_days.split(","))):
+        if not excluded_day.isdigit() or int(excluded_day) > 6:
+            raise ValueError(f"Invalid day of the week (0-6): {excluded_day}")
+        days.add(int(excluded_day))
+    return frozenset(days)
+
+
+def parse_dates(excluded_dates: str = "") -> frozenset:
+    """
+    Parse a comma separated list of dates in the format of mm/dd/yyyy
+
+    :param excluded_dates: The dates
+    :return: Set of dates
     """
-    if start_time < end_time:
-        return now_time >= start_time and now_time <= end_time
-    else:  # Over midnight
-        return now_time >= start_time or now_time <= end_time
+    dates = set()
+    for excluded_date in filter(None, map(str.strip, excluded_dates.split(","))):
+        try:
+            dates.add(datetime.strptime(excluded_date, "%m/%d/%Y").date())
+        except ValueError:
+            raise ValueError(f"Invalid date (mm/dd/yyyy): {excluded_date}")
+    return frozenset(dates)
 
 
 def _get_day_of_week(utc_timestamp=None):